@@ -0,0 +1,6 @@
+"""Benchmarks of the AGWA hot paths on synthetic watersheds, runnable without ArcGIS Pro.
+
+    python -m benchmarks --elements 1000 10000 100000 1000000
+
+run from code/pyt_version. Results are appended to benchmarks/history.json, which is not versioned (see --history),
+and a result slower than its median of the last runs on the same machine is reported as a regression."""
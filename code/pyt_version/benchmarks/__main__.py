@@ -0,0 +1,5 @@
+import sys
+
+from benchmarks import run_benchmarks
+
+sys.exit(run_benchmarks.main())
@@ -0,0 +1,40 @@
+import sys
+import types
+
+
+class ArcpyUnavailable(types.ModuleType):
+    """Placeholder for arcpy and its submodules when ArcGIS Pro is not installed, so the AGWA modules can be imported
+    to benchmark their pure-Python functions. Messages are discarded and extension checkouts report Unavailable; any
+    other use of arcpy raises, so a benchmark that reaches arcpy fails instead of timing something else."""
+
+    def __getattr__(self, name):
+        if name.startswith("__"):
+            raise AttributeError(name)
+        raise AttributeError(f"arcpy is not available, {self.__name__}.{name} cannot be used outside ArcGIS Pro")
+
+
+class UnavailableTable(object):
+    def __init__(self, *args, **kwargs):
+        raise RuntimeError("arcpy is not available, arcpy._mp.Table cannot be used outside ArcGIS Pro")
+
+
+def install():
+    """Register the placeholder as arcpy if arcpy cannot be imported. Returns True if arcpy is the real one."""
+
+    try:
+        import arcpy  # noqa: F401
+        return not isinstance(sys.modules["arcpy"], ArcpyUnavailable)
+    except ImportError:
+        pass
+
+    arcpy = ArcpyUnavailable("arcpy")
+    arcpy.AddMessage = arcpy.AddWarning = lambda message: None
+    arcpy.GetMessages = lambda severity=0: ""
+    arcpy.CheckOutExtension = arcpy.CheckInExtension = lambda code: "Unavailable"
+    sys.modules["arcpy"] = arcpy
+    for name in ["analysis", "conversion", "da", "management", "sa", "_mp"]:
+        submodule = ArcpyUnavailable(f"arcpy.{name}")
+        setattr(arcpy, name, submodule)
+        sys.modules[f"arcpy.{name}"] = submodule
+    arcpy._mp.Table = UnavailableTable
+    return False
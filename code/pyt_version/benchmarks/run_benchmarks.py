@@ -0,0 +1,341 @@
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import tempfile
+import statistics
+import subprocess
+from datetime import datetime
+
+import numpy as np
+import pandas as pd
+
+BENCHMARKS_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+SOURCE_DIRECTORY = os.path.join(os.path.dirname(BENCHMARKS_DIRECTORY), "src")
+if BENCHMARKS_DIRECTORY not in sys.path:
+    sys.path.insert(0, BENCHMARKS_DIRECTORY)
+if SOURCE_DIRECTORY not in sys.path:
+    sys.path.insert(0, SOURCE_DIRECTORY)
+
+import arcpy_unavailable
+import synthetic_watershed
+
+HAS_ARCPY = arcpy_unavailable.install()
+
+import agwa_channel_network
+import agwa_d8
+import agwa_depressions
+import agwa_tiles
+import code_import_results
+import code_parameterize_elements
+import code_parameterize_land_cover_and_soils
+import code_write_k2_parameter_file
+
+# the tools report their progress with tweet, which also prints: keep it out of the benchmark output
+for module in [code_import_results, code_parameterize_elements, code_parameterize_land_cover_and_soils,
+               code_write_k2_parameter_file]:
+    module.tweet = lambda msg: None
+
+DEFAULT_ELEMENTS = [1000, 10000]
+DEFAULT_HISTORY = os.path.join(BENCHMARKS_DIRECTORY, "history.json")
+REGRESSION_THRESHOLD = 1.25
+
+
+class Benchmark(object):
+    """A timed hot path. setup(watershed, directory) prepares the inputs outside the timing and returns the
+    function to time. Scales above max_elements are skipped unless limits are disabled, for paths whose running time
+    grows too fast to run at every scale."""
+
+    def __init__(self, name, setup, max_elements=None):
+        self.name = name
+        self.setup = setup
+        self.max_elements = max_elements
+
+
+def setup_contributing_channels(watershed, directory):
+    def run():
+        network = agwa_channel_network.ChannelNetwork.from_nodes(watershed.channel_ids, watershed.from_nodes,
+                                                                 watershed.to_nodes)
+        return network.contributing_pairs()
+
+    return run
+
+
+def setup_d8_kernel(watershed, directory):
+    dem, flow_direction = watershed.grids()
+    flow_accumulation = agwa_d8.flow_accumulation(flow_direction)
+    channels = flow_accumulation >= 100
+
+    def run():
+        stream_links = agwa_d8.stream_link(channels, flow_direction)
+        first_order_channels = agwa_d8.shreve_order(channels, flow_direction) == 1
+        link_heads = agwa_d8.zone_minimum(stream_links, flow_accumulation) == flow_accumulation
+        pour_points = np.where(channels, stream_links * 10 + (first_order_channels & link_heads), 0)
+        agwa_d8.downstream_flow_length(np.where(channels, 0, flow_direction), 30.0, 30.0)
+        return agwa_d8.watershed(flow_direction, pour_points)
+
+    return run
+
+
+def setup_tiled_terrain(watershed, directory):
+    dem, flow_direction = watershed.grids()
+    dem = dem.astype(np.float64)
+    grid = agwa_tiles.TileGrid(dem.shape, 256)
+
+    def run():
+        filled = agwa_tiles.create_array(directory, "filled", dem.shape, np.float64, np.inf)
+        agwa_tiles.fill(dem, filled, grid)
+        directions = agwa_tiles.create_array(directory, "fd", dem.shape, np.uint8, 0)
+        flat_distance = agwa_tiles.create_array(directory, "flat_distance", dem.shape, np.int64, -1)
+        agwa_tiles.flow_direction(filled, directions, flat_distance, grid, 30.0, 30.0)
+        accumulation = agwa_tiles.create_array(directory, "fa", dem.shape, np.float32, -1)
+        agwa_tiles.flow_accumulation(directions, accumulation, grid)
+        return accumulation
+
+    return run
+
+
+def setup_depressions(watershed, directory):
+    dem, _ = watershed.grids()
+    dem = dem.astype(np.float64)
+
+    def run():
+        return agwa_depressions.find_depressions(dem, 900.0)
+
+    return run
+
+
+def setup_serpentine_fill(watershed, directory):
+    dem = watershed.serpentine_grid()
+
+    def run():
+        return agwa_d8.fill_depressions(dem)
+
+    return run
+
+
+def setup_sequence(watershed, directory):
+    channel_ids_down, channel_ids_up = watershed.contributing_channels
+
+    def run():
+        network = agwa_channel_network.ChannelNetwork(watershed.channel_ids, watershed.from_nodes,
+                                                      watershed.to_nodes, channel_ids_down, channel_ids_up)
+        return network.sequence()
+
+    return run
+
+
+def setup_contributing_area(watershed, directory):
+    network = agwa_channel_network.ChannelNetwork(watershed.channel_ids, watershed.from_nodes, watershed.to_nodes,
+                                                  *watershed.contributing_channels)
+    network.sequence()
+    df_hillslopes = watershed.df_hillslopes()
+    hillslope_ids, hillslope_areas = df_hillslopes.HillslopeID.values, df_hillslopes.Area.values
+
+    def run():
+        return code_parameterize_elements.accumulate_contributing_areas(network, hillslope_ids, hillslope_areas)
+
+    return run
+
+
+def setup_soil_horizon_parameters(watershed, directory):
+    soil_tables = watershed.soil_tables()
+    df_mapunit = soil_tables["intersection"].rename(columns={"MUKEY": "mukey"})[["mukey"]]
+
+    def run():
+        return code_parameterize_land_cover_and_soils.calculate_horizon_soil_parameters(
+            df_mapunit, soil_tables["component"], soil_tables["chorizon"], soil_tables["chtexturegrp"],
+            soil_tables["chtexture"], soil_tables["kin_lut"], 200, 0)
+
+    return run
+
+
+def setup_soil_horizon_weighting(watershed, directory):
+    df_horizons = synthetic_watershed.horizon_parameters(watershed.soil_tables())
+
+    def run():
+        return code_parameterize_land_cover_and_soils.calculate_weighted_hillslope_soil_parameters(df_horizons.copy())
+
+    return run
+
+
+def setup_soil_area_weighting(watershed, directory):
+    soil_tables = watershed.soil_tables()
+    df_horizons = synthetic_watershed.horizon_parameters(soil_tables)
+    df_soils = df_horizons.groupby("MapUnitKey", as_index=False)[synthetic_watershed.SOIL_PARAMETERS].mean()
+    df_intersections = soil_tables["intersection"]
+
+    def run():
+        return code_parameterize_land_cover_and_soils.weight_soil_parameters_by_area(df_intersections.copy(),
+                                                                                     df_soils.copy())
+
+    return run
+
+
+def setup_parfile_writing(watershed, directory):
+    df_hillslopes = watershed.df_hillslopes()
+    df_channels = watershed.df_channels()
+    df_contributing_channels = watershed.df_contributing_channels()
+    parfile = os.path.join(directory, "synthetic.par")
+
+    def run():
+        code_write_k2_parameter_file.write_file(parfile, "4.0", "4.0", synthetic_watershed.DELINEATION_NAME,
+                                                synthetic_watershed.DISCRETIZATION_NAME, df_hillslopes, df_channels,
+                                                df_contributing_channels, synthetic_watershed.PARAMETERIZATION_NAME)
+
+    return run
+
+
+def setup_result_parsing(watershed, directory):
+    simulation_directory = os.path.join(directory, "simulation")
+    watershed.write_k2_results(simulation_directory)
+
+    def run():
+        return code_import_results.read_simulation_results(
+            synthetic_watershed.DELINEATION_NAME, synthetic_watershed.DISCRETIZATION_NAME,
+            synthetic_watershed.PARAMETERIZATION_NAME, "synthetic_simulation", simulation_directory)
+
+    return run
+
+
+BENCHMARKS = [Benchmark("contributing_channels", setup_contributing_channels),
+              Benchmark("d8_kernel", setup_d8_kernel),
+              Benchmark("tiled_terrain", setup_tiled_terrain),
+              Benchmark("depressions", setup_depressions),
+              Benchmark("serpentine_fill", setup_serpentine_fill),
+              Benchmark("sequence", setup_sequence),
+              Benchmark("contributing_area", setup_contributing_area),
+              Benchmark("soil_horizon_parameters", setup_soil_horizon_parameters),
+              Benchmark("soil_horizon_weighting", setup_soil_horizon_weighting),
+              Benchmark("soil_area_weighting", setup_soil_area_weighting),
+              Benchmark("parfile_writing", setup_parfile_writing, max_elements=1000),
+              Benchmark("result_parsing", setup_result_parsing)]
+
+
+def time_function(function, repeat):
+    """Return the wall times of repeat calls of function."""
+    times = []
+    for _ in range(repeat):
+        start_time = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start_time)
+    return times
+
+
+def run(elements_list, names=None, repeat=3, seed=0, limits=True, message_function=print):
+    """Run the benchmarks at every scale in elements_list and return their results."""
+
+    results = []
+    for elements in elements_list:
+        start_time = time.perf_counter()
+        watershed = synthetic_watershed.SyntheticWatershed(elements, seed)
+        message_function(f"Synthetic watershed with {len(watershed)} elements ({watershed.channel_count} channels) "
+                         f"generated in {time.perf_counter() - start_time:.2f} s")
+        with tempfile.TemporaryDirectory() as directory:
+            for benchmark in BENCHMARKS:
+                if names and benchmark.name not in names:
+                    continue
+                result = {"benchmark": benchmark.name, "elements": elements, "actual_elements": len(watershed)}
+                if limits and benchmark.max_elements is not None and elements > benchmark.max_elements:
+                    result["skipped"] = f"above the limit of {benchmark.max_elements} elements"
+                else:
+                    times = time_function(benchmark.setup(watershed, directory), repeat)
+                    result.update({"best": min(times), "median": statistics.median(times), "times": times})
+                results.append(result)
+                message_function(format_result(result))
+    return results
+
+
+def format_result(result, previous=None):
+    if "skipped" in result:
+        return f"  {result['benchmark']:<24s} {result['elements']:>9d}   skipped, {result['skipped']}"
+    line = f"  {result['benchmark']:<24s} {result['elements']:>9d} {result['best']:10.4f} s"
+    if previous is not None:
+        line += f"   {result['best'] / previous:5.2f}x baseline"
+    return line
+
+
+def environment():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=BENCHMARKS_DIRECTORY,
+                                capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return {"commit": commit, "machine": platform.node(), "platform": platform.platform(),
+            "python": platform.python_version(), "numpy": np.__version__, "pandas": pd.__version__,
+            "arcpy": HAS_ARCPY}
+
+
+def read_history(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, "r") as f:
+        return json.load(f)
+
+
+def append_history(path, record):
+    history = read_history(path)
+    history.append(record)
+    temp_path = f"{path}.tmp"
+    with open(temp_path, "w") as f:
+        json.dump(history, f, indent=2)
+    os.replace(temp_path, path)
+
+
+def baseline(history, machine, benchmark, elements, runs=5):
+    """Return the median best time of a benchmark at a scale over the last runs on this machine, or None."""
+    best_times = [result["best"] for record in history if record["environment"]["machine"] == machine
+                  for result in record["results"]
+                  if result["benchmark"] == benchmark and result["elements"] == elements and "best" in result]
+    return statistics.median(best_times[-runs:]) if best_times else None
+
+
+def find_regressions(history, record, threshold=REGRESSION_THRESHOLD):
+    """Return the results of record that are slower than threshold times their baseline in history."""
+    regressions = []
+    for result in record["results"]:
+        if "best" not in result:
+            continue
+        previous = baseline(history, record["environment"]["machine"], result["benchmark"], result["elements"])
+        if previous is not None and result["best"] > threshold * previous:
+            regressions.append((result, previous))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m benchmarks",
+                                     description="Benchmark the AGWA hot paths on synthetic watersheds.")
+    parser.add_argument("--elements", type=int, nargs="+", default=DEFAULT_ELEMENTS,
+                        help="scales to run, in elements (hillslopes and channels), e.g. 1000 10000 100000 1000000")
+    parser.add_argument("--benchmarks", nargs="+", choices=[benchmark.name for benchmark in BENCHMARKS],
+                        help="benchmarks to run, all by default")
+    parser.add_argument("--repeat", type=int, default=3, help="timed runs per benchmark and scale")
+    parser.add_argument("--seed", type=int, default=0, help="seed of the synthetic watersheds")
+    parser.add_argument("--no-limits", action="store_true",
+                        help="also run benchmarks at scales above their element limit")
+    parser.add_argument("--history", default=DEFAULT_HISTORY, help="JSON file the results are appended to")
+    parser.add_argument("--no-history", action="store_true", help="do not record the results")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="a result slower than this factor times its baseline is a regression")
+    parser.add_argument("--fail-on-regression", action="store_true", help="exit with status 1 on a regression")
+    arguments = parser.parse_args(argv)
+
+    results = run(arguments.elements, arguments.benchmarks, arguments.repeat, arguments.seed,
+                  not arguments.no_limits)
+    record = {"date": datetime.now().isoformat(), "environment": environment(), "repeat": arguments.repeat,
+              "seed": arguments.seed, "results": results}
+
+    history = read_history(arguments.history)
+    regressions = find_regressions(history, record, arguments.threshold)
+    for result, previous in regressions:
+        print(f"Regression: {format_result(result, previous).strip()}")
+    if not arguments.no_history:
+        append_history(arguments.history, record)
+        print(f"Results appended to {arguments.history}")
+    return 1 if regressions and arguments.fail_on_regression else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,422 @@
+import os
+import numpy as np
+import pandas as pd
+
+
+# A discretization with C channels, half of them headwater channels, has 2 * C + C / 2 hillslopes
+ELEMENTS_PER_CHANNEL = 3.5
+
+DELINEATION_NAME = "synthetic_delineation"
+DISCRETIZATION_NAME = "synthetic_discretization"
+PARAMETERIZATION_NAME = "synthetic_parameterization"
+
+# D8 direction codes and the (row, column) offsets of the cells they point to
+D8_DIRECTIONS = [(1, (0, 1)), (2, (1, 1)), (4, (1, 0)), (8, (1, -1)),
+                 (16, (0, -1)), (32, (-1, -1)), (64, (-1, 0)), (128, (-1, 1))]
+
+# Soil textures with kin_lut-style parameters (Rawls et al., 1982)
+KIN_LUT = pd.DataFrame([
+    ("Sand", 210.0, 49.5, 0.437, 0.95, 1.29, 92.0, 5.0, 3.0, 0.694, 0.15, 7.26),
+    ("Loamy sand", 61.1, 61.3, 0.437, 0.92, 1.06, 82.0, 12.0, 6.0, 0.553, 0.17, 8.69),
+    ("Sandy loam", 25.9, 110.1, 0.453, 0.91, 0.89, 65.0, 25.0, 10.0, 0.378, 0.24, 14.66),
+    ("Fine sandy loam", 25.9, 110.1, 0.453, 0.91, 0.89, 65.0, 25.0, 10.0, 0.378, 0.24, 14.66),
+    ("Loam", 13.2, 88.9, 0.463, 0.87, 0.84, 42.0, 40.0, 18.0, 0.252, 0.30, 11.15),
+    ("Silt loam", 6.8, 166.8, 0.501, 0.87, 0.88, 20.0, 65.0, 15.0, 0.234, 0.38, 20.76),
+    ("Sandy clay loam", 4.3, 218.5, 0.398, 0.87, 0.75, 60.0, 13.0, 27.0, 0.319, 0.20, 28.08),
+    ("Clay loam", 2.3, 208.8, 0.464, 0.86, 0.73, 32.0, 34.0, 34.0, 0.242, 0.28, 25.89),
+    ("Silty clay loam", 1.5, 273.0, 0.471, 0.86, 0.73, 10.0, 56.0, 34.0, 0.177, 0.35, 32.56),
+    ("Sandy clay", 1.2, 239.0, 0.430, 0.85, 0.71, 52.0, 6.0, 42.0, 0.223, 0.17, 29.17),
+    ("Silty clay", 0.9, 292.2, 0.479, 0.85, 0.69, 6.0, 47.0, 47.0, 0.150, 0.30, 34.19),
+    ("Clay", 0.6, 316.3, 0.475, 0.84, 0.66, 22.0, 20.0, 58.0, 0.165, 0.25, 37.30)],
+    columns=["TextureName", "KS", "G", "POR", "SMAX", "CV", "SAND", "SILT", "CLAY", "DIST", "KFF", "BPressure"])
+
+SOIL_PARAMETERS = ["Ksat", "G", "Porosity", "Rock", "Sand", "Silt", "Clay", "Splash", "Cohesion", "Pave", "SMax", "CV",
+                   "Distribution", "BPressure"]
+
+
+class SyntheticWatershed(object):
+    """A synthetic AGWA discretization with about `elements` hillslopes and channels.
+
+    The channel network is a random binary tree: every channel is either a headwater channel or receives exactly
+    two channels, as stream links derived from a D8 grid do. Channels follow the AGWA id convention: a channel with
+    grid_code g has ChannelID g * 10 + 4, its lateral hillslopes have ChannelID - 1 and ChannelID - 2, and a
+    headwater channel also has an upland hillslope ChannelID - 3. Grid codes are shuffled, so ids carry no
+    information about the topology. All tables are generated from seed and are identical between runs.
+    """
+
+    def __init__(self, elements, seed=0):
+        self.elements = elements
+        self.seed = seed
+        self.rng = np.random.default_rng(seed)
+
+        channel_count = max(1, int(round(elements / ELEMENTS_PER_CHANNEL)))
+        if channel_count % 2 == 0:
+            channel_count += 1
+        self.downstream = random_channel_tree(channel_count, self.rng)
+
+        grid_codes = self.rng.permutation(channel_count) + 1
+        self.channel_ids = grid_codes.astype(np.int64) * 10 + 4
+        self.from_nodes = np.arange(1, channel_count + 1, dtype=np.int64)
+        self.to_nodes = np.where(self.downstream >= 0, self.from_nodes[self.downstream], channel_count + 1)
+
+        upstream_count = np.bincount(self.downstream[self.downstream >= 0], minlength=channel_count)
+        self.is_headwater = upstream_count == 0
+        self.sequence = upstream_first_sequence(self.downstream)
+
+        self._df_contributing_channels = None
+        self._df_hillslopes = None
+        self._df_channels = None
+        self._soil_tables = None
+
+    def __len__(self):
+        return self.channel_ids.size + self.hillslope_ids.size
+
+    @property
+    def channel_count(self):
+        return self.channel_ids.size
+
+    @property
+    def hillslope_ids(self):
+        headwater_ids = self.channel_ids[self.is_headwater]
+        return np.concatenate([self.channel_ids - 1, self.channel_ids - 2, headwater_ids - 3])
+
+    @property
+    def contributing_channels(self):
+        """Return the (ChannelID, ContributingChannel) pairs of the network in shuffled table order."""
+        upstream = np.flatnonzero(self.downstream >= 0)
+        upstream = upstream[np.random.default_rng(self.seed + 1).permutation(upstream.size)]
+        return self.channel_ids[self.downstream[upstream]], self.channel_ids[upstream]
+
+    def df_contributing_channels(self):
+        """Return the contributing_channels table of the discretization. Ids are text, as in the geodatabase."""
+        if self._df_contributing_channels is None:
+            channel_ids_down, channel_ids_up = self.contributing_channels
+            self._df_contributing_channels = pd.DataFrame({
+                "DelineationName": DELINEATION_NAME,
+                "DiscretizationName": DISCRETIZATION_NAME,
+                "ChannelID": channel_ids_down.astype(str),
+                "ContributingChannel": channel_ids_up.astype(str)})
+        return self._df_contributing_channels
+
+    def df_hillslopes(self):
+        """Return the parameters_hillslopes set of the discretization with element and soil/land cover fields."""
+        if self._df_hillslopes is None:
+            rng = np.random.default_rng(self.seed + 2)
+            count = self.hillslope_ids.size
+            width = rng.uniform(20.0, 400.0, count)
+            length = rng.uniform(20.0, 400.0, count)
+            df = pd.DataFrame({
+                "DelineationName": DELINEATION_NAME,
+                "DiscretizationName": DISCRETIZATION_NAME,
+                "ParameterizationName": PARAMETERIZATION_NAME,
+                "HillslopeID": self.hillslope_ids,
+                "Area": width * length,
+                "MeanElevation": rng.uniform(1000.0, 2500.0, count),
+                "MeanSlope": rng.uniform(0.5, 45.0, count),
+                "MeanAspect": rng.uniform(0.0, 360.0, count),
+                "MeanFlowLength": length * rng.uniform(0.3, 0.7, count),
+                "CentroidX": rng.uniform(400000.0, 500000.0, count),
+                "CentroidY": rng.uniform(3500000.0, 3600000.0, count),
+                "Width": width,
+                "Length": length,
+                "Manning": rng.uniform(0.02, 0.2, count),
+                "Interception": rng.uniform(0.0, 3.0, count),
+                "Canopy": rng.uniform(0.0, 80.0, count)})
+            self._df_hillslopes = pd.concat([df, random_soil_parameters(rng, count)], axis=1)
+        return self._df_hillslopes
+
+    def df_channels(self):
+        """Return the parameters_channels set of the discretization. Sequence numbers run from upstream to the
+        outlet."""
+        if self._df_channels is None:
+            rng = np.random.default_rng(self.seed + 3)
+            count = self.channel_count
+            sequence = np.empty(count, dtype=np.int64)
+            sequence[self.sequence] = np.arange(1, count + 1)
+            df = pd.DataFrame({
+                "DelineationName": DELINEATION_NAME,
+                "DiscretizationName": DISCRETIZATION_NAME,
+                "ParameterizationName": PARAMETERIZATION_NAME,
+                "ChannelID": self.channel_ids,
+                "Sequence": sequence,
+                "ChannelLength": rng.uniform(30.0, 2000.0, count),
+                "LateralArea": 0.0,
+                "UpstreamArea": 0.0,
+                "UpstreamElevation": rng.uniform(1500.0, 2500.0, count),
+                "DownstreamElevation": rng.uniform(1000.0, 1500.0, count),
+                "MeanSlope": rng.uniform(0.001, 0.2, count),
+                "CentroidX": rng.uniform(400000.0, 500000.0, count),
+                "CentroidY": rng.uniform(3500000.0, 3600000.0, count),
+                "SideSlope1": rng.uniform(0.5, 2.0, count),
+                "SideSlope2": rng.uniform(0.5, 2.0, count),
+                "UpstreamBankfullDepth": rng.uniform(0.1, 1.0, count),
+                "DownstreamBankfullDepth": rng.uniform(0.5, 2.0, count),
+                "UpstreamBankfullWidth": rng.uniform(1.0, 5.0, count),
+                "DownstreamBankfullWidth": rng.uniform(3.0, 20.0, count),
+                "UpstreamBottomWidth": rng.uniform(0.5, 4.0, count),
+                "DownstreamBottomWidth": rng.uniform(2.0, 15.0, count),
+                "Manning": rng.uniform(0.02, 0.06, count),
+                "Woolhiser": "Yes"})
+            self._df_channels = pd.concat([df, random_soil_parameters(rng, count)], axis=1)
+        return self._df_channels
+
+    def soil_tables(self):
+        """Return gSSURGO-like tables for the discretization as a dictionary of DataFrames: component, chorizon,
+        chtexturegrp, and chtexture with the fields AGWA reads, the kin_lut lookup table, and intersection, the
+        HillslopeID, MUKEY, and Shape_Area of the polygons of the map units intersected with the hillslopes."""
+
+        if self._soil_tables is None:
+            self._soil_tables = random_soil_tables(self.hillslope_ids, self.df_hillslopes().Area.values,
+                                                   np.random.default_rng(self.seed + 4))
+        return self._soil_tables
+
+    def write_k2_results(self, simulation_directory, out_name="kin.out"):
+        """Write a KINEROS2-style output file for every element and a kin.fil pointing to it."""
+
+        os.makedirs(simulation_directory, exist_ok=True)
+        write_k2_output(os.path.join(simulation_directory, out_name), self.hillslope_ids, self.df_hillslopes().Area,
+                        self.channel_ids, np.random.default_rng(self.seed + 5))
+        with open(os.path.join(simulation_directory, "kin.fil"), "w") as f:
+            f.write(f"kin.par, kin.pre, {out_name}, synthetic, N, Y, Y, N, N, N, 1\n")
+
+    def grids(self, cells_per_element=25):
+        """Return a synthetic DEM with about cells_per_element cells per element and its D8 flow directions."""
+        side = max(3, int(np.sqrt(self.elements * cells_per_element)))
+        dem = synthetic_dem(side, side, np.random.default_rng(self.seed + 6))
+        return dem, d8_flow_direction(dem)
+
+    def serpentine_grid(self, cells_per_element=25):
+        """Return a serpentine valley DEM (see serpentine_dem) with about cells_per_element cells per element."""
+        return serpentine_dem(max(5, int(np.sqrt(self.elements * cells_per_element))))
+
+
+def random_channel_tree(channel_count, rng):
+    """Return the downstream position of each channel of a random binary tree of channel_count channels, -1 at the
+    outlet. A channel's downstream channel always has a lower position."""
+
+    downstream = np.full(channel_count, -1, dtype=np.int64)
+    leaves = [0]
+    draws = rng.random(channel_count // 2)
+    count = 1
+    for draw in draws:
+        k = int(draw * len(leaves))
+        parent = leaves[k]
+        leaves[k] = count
+        leaves.append(count + 1)
+        downstream[count] = downstream[count + 1] = parent
+        count += 2
+    return downstream
+
+
+def upstream_first_sequence(downstream):
+    """Return channel positions ordered by decreasing distance to the outlet, so every channel comes after all the
+    channels upstream of it."""
+
+    depth = np.zeros(downstream.size, dtype=np.int64)
+    for position in range(1, downstream.size):
+        depth[position] = depth[downstream[position]] + 1
+    return np.argsort(-depth, kind="stable")
+
+
+def random_soil_parameters(rng, count):
+    """Return a DataFrame of plausible K2 soil parameters for count elements."""
+
+    textures = KIN_LUT.iloc[rng.integers(0, len(KIN_LUT), count)].reset_index(drop=True)
+    return pd.DataFrame({
+        "Ksat": textures.KS.values,
+        "G": textures.G.values,
+        "Porosity": textures.POR.values,
+        "Rock": rng.uniform(0.0, 0.4, count),
+        "Sand": textures.SAND.values / 100,
+        "Silt": textures.SILT.values / 100,
+        "Clay": textures.CLAY.values / 100,
+        "Splash": rng.uniform(50.0, 150.0, count),
+        "Cohesion": rng.uniform(0.001, 0.02, count),
+        "Pave": np.zeros(count),
+        "SMax": textures.SMAX.values,
+        "CV": textures.CV.values,
+        "Distribution": textures.DIST.values,
+        "BPressure": textures.BPressure.values})
+
+
+def random_soil_tables(hillslope_ids, hillslope_areas, rng):
+    """Return gSSURGO-like component, chorizon, chtexturegrp, and chtexture tables, the kin_lut table, and the
+    intersection of the map units with the hillslopes. About one map unit exists per 20 hillslopes; each map unit
+    has one to three components, each component one to four horizons."""
+
+    mapunit_count = max(10, hillslope_ids.size // 20)
+    mukeys = np.arange(100000, 100000 + mapunit_count)
+
+    components_per_mapunit = rng.integers(1, 4, mapunit_count)
+    component_mapunits = np.repeat(np.arange(mapunit_count), components_per_mapunit)
+    component_mukeys = mukeys[component_mapunits]
+    component_count = component_mukeys.size
+    cokeys = np.arange(1, component_count + 1)
+    comppct = rng.uniform(0.3, 1.0, component_count)
+    comppct = np.floor(comppct / np.bincount(component_mapunits, weights=comppct)[component_mapunits] * 100)
+    df_component = pd.DataFrame({"cokey": cokeys.astype(str), "comppct_r": comppct,
+                                 "mukey": component_mukeys.astype(str)})
+
+    horizons_per_component = rng.integers(1, 5, component_count)
+    horizon_cokeys = np.repeat(cokeys, horizons_per_component)
+    horizon_count = horizon_cokeys.size
+    thickness = rng.integers(5, 60, horizon_count).astype(float)
+    horizon_starts = np.repeat(np.cumsum(horizons_per_component) - horizons_per_component, horizons_per_component)
+    cumulative = np.cumsum(thickness)
+    bottom = cumulative - np.concatenate([[0.0], cumulative])[horizon_starts]
+    textures = KIN_LUT.iloc[rng.integers(0, len(KIN_LUT), horizon_count)].reset_index(drop=True)
+    sand = np.clip(textures.SAND.values + rng.normal(0.0, 3.0, horizon_count), 0.0, 100.0)
+    clay = np.clip(textures.CLAY.values + rng.normal(0.0, 3.0, horizon_count), 0.0, 100.0 - sand)
+    chkeys = np.arange(1, horizon_count + 1)
+    df_chorizon = pd.DataFrame({
+        "cokey": horizon_cokeys.astype(str),
+        "chkey": chkeys.astype(str),
+        "hzdept_r": bottom - thickness,
+        "hzdepb_r": bottom,
+        "ksat_r": textures.KS.values / 3.6 * rng.uniform(0.5, 1.5, horizon_count),
+        "sandtotal_r": sand,
+        "silttotal_r": 100.0 - sand - clay,
+        "claytotal_r": clay,
+        "dbthirdbar_r": rng.uniform(1.1, 1.7, horizon_count),
+        "partdensity": np.full(horizon_count, 2.65),
+        "sieveno10_r": rng.uniform(60.0, 100.0, horizon_count),
+        "kwfact": rng.choice([".17", ".24", ".32", ".37", ".43"], horizon_count)})
+
+    df_chtexturegrp = pd.DataFrame({"chkey": chkeys.astype(str), "chtgkey": chkeys.astype(str),
+                                    "texture": textures.TextureName.values})
+    df_chtexture = pd.DataFrame({"chtgkey": chkeys.astype(str), "texcl": textures.TextureName.values,
+                                 "lieutex": "None"})
+
+    # each hillslope intersects one to three map units
+    polygons_per_hillslope = rng.integers(1, 4, hillslope_ids.size)
+    polygon_hillslopes = np.repeat(np.arange(hillslope_ids.size), polygons_per_hillslope)
+    fractions = rng.uniform(0.1, 1.0, polygon_hillslopes.size)
+    fractions /= np.bincount(polygon_hillslopes, weights=fractions)[polygon_hillslopes]
+    df_intersection = pd.DataFrame({"HillslopeID": hillslope_ids[polygon_hillslopes],
+                                    "MUKEY": rng.choice(mukeys, polygon_hillslopes.size).astype(str),
+                                    "Shape_Area": np.asarray(hillslope_areas)[polygon_hillslopes] * fractions})
+
+    return {"component": df_component, "chorizon": df_chorizon, "chtexturegrp": df_chtexturegrp,
+            "chtexture": df_chtexture, "kin_lut": KIN_LUT.copy(), "intersection": df_intersection}
+
+
+def horizon_parameters(soil_tables):
+    """Return the horizon parameter table intersect_soils builds from the gSSURGO tables, the input of
+    calculate_weighted_hillslope_soil_parameters, computed with vectorized joins."""
+
+    df = soil_tables["chorizon"].merge(soil_tables["component"], on="cokey")
+    df = df.merge(soil_tables["chtexturegrp"], on="chkey").merge(soil_tables["kin_lut"], left_on="texture",
+                                                                 right_on="TextureName")
+    df["HorizonNumber"] = df.groupby("cokey").cumcount() + 1
+    return pd.DataFrame({
+        "HorizonId": df.chkey,
+        "HorizonNumber": df.HorizonNumber,
+        "HorizonThickness": df.hzdepb_r - df.hzdept_r,
+        "Ksat": df.KS,
+        "G": df.G,
+        "Porosity": df.POR,
+        "Rock": 1 - df.sieveno10_r / 100,
+        "Sand": df.SAND / 100,
+        "Silt": df.SILT / 100,
+        "Clay": df.CLAY / 100,
+        "Splash": 422 * df.kwfact.astype(float) * 0.8,
+        "Cohesion": 5.6 * df.kwfact.astype(float) / 130 * 0.5,
+        "Pave": 0,
+        "SMax": df.SMAX,
+        "CV": df.CV,
+        "Distribution": df.DIST,
+        "BPressure": df.BPressure,
+        "MapUnitKey": df.mukey,
+        "ComponentId": df.cokey,
+        "ComponentPercentage": df.comppct_r})
+
+
+def write_k2_output(path, hillslope_ids, hillslope_areas, channel_ids, rng):
+    """Write a KINEROS2-style output file with an element block for every hillslope and channel followed by the
+    tabular summary of element hydrologic components."""
+
+    element_ids = np.concatenate([hillslope_ids, channel_ids])
+    element_types = ["Plane"] * hillslope_ids.size + ["Channel"] * channel_ids.size
+    element_areas = np.concatenate([np.asarray(hillslope_areas), rng.uniform(100.0, 5000.0, channel_ids.size)])
+    contributing_areas = np.concatenate([np.asarray(hillslope_areas),
+                                         rng.uniform(1e4, 1e7, channel_ids.size)])
+    count = element_ids.size
+    peak_flow_times = rng.uniform(10.0, 300.0, count)
+    peak_sediment = rng.uniform(0.0, 50.0, count)
+    peak_sediment_times = peak_flow_times + rng.uniform(0.0, 5.0, count)
+    rainfall = element_areas * rng.uniform(0.01, 0.05, count)
+    inflow = np.where(np.arange(count) < hillslope_ids.size, 0.0, rng.uniform(0.0, 1e5, count))
+    infiltration = rainfall * rng.uniform(0.3, 0.9, count)
+    outflow = np.maximum(rainfall + inflow - infiltration, 0.0)
+    peak_flow = rng.uniform(0.0, 100.0, count)
+    initial_water_content = rng.uniform(0.1, 0.3, count)
+    sediment_yield = rng.uniform(0.0, 1e4, count)
+
+    with open(path, "w") as f:
+        f.write(" KINEROS2 synthetic output\n\n")
+        for i in range(count):
+            label = " Plane Element  " if element_types[i] == "Plane" else " Channel Elem.   "
+            f.write(f"{label}    {element_ids[i]}\n"
+                    f"   Cumulative rainfall = {rainfall[i]:.3f} cu m\n"
+                    f"   Peak flow = {peak_flow[i]:.3f} mm/h at {peak_flow_times[i]:.2f} min\n"
+                    f"   Total infiltration = {infiltration[i]:.3f} cu m\n"
+                    f"   Peak sediment discharge = {peak_sediment[i]:.4f} kg/s at {peak_sediment_times[i]:.2f} min\n"
+                    f"   Total sediment yield = {sediment_yield[i]:.3f} kg\n\n")
+        f.write("\n Tabular Summary of Element Hydrologic Components\n\n"
+                "                                             Cumulative   Cumulative   Cumulative      Peak"
+                "       Total      Initial     Sediment\n"
+                " Element  Element    Element    Contributing   Inflow     Rainfall     Outflow        Flow"
+                "       Infil.     Water        Yield\n"
+                "    ID     Type     Area(m2)      Area(m2)     (cu m)      (cu m)       (cu m)       (mm/h)"
+                "      (cu m)    Content       (kg)\n")
+        for i in range(count):
+            f.write(f"{element_ids[i]:8d} {element_types[i]:>8s} {element_areas[i]:12.2f} {contributing_areas[i]:14.2f}"
+                    f" {inflow[i]:11.3f} {rainfall[i]:11.3f} {outflow[i]:11.3f} {peak_flow[i]:11.3f}"
+                    f" {infiltration[i]:11.3f} {initial_water_content[i]:9.4f} {sediment_yield[i]:12.3f}\n")
+
+
+def synthetic_dem(rows, columns, rng):
+    """Return a DEM of a valley draining south, with random roughness so flow paths are not all parallel."""
+
+    y, x = np.mgrid[0:rows, 0:columns].astype(np.float32)
+    dem = 1000.0 + 0.5 * (rows - y) + 0.2 * np.abs(x - columns / 2)
+    return (dem + rng.uniform(0.0, 0.3, (rows, columns))).astype(np.float32)
+
+
+def serpentine_dem(side):
+    """Return a side x side DEM of one valley winding back and forth across the grid between walls, rising from its
+    outlet at the top left, with a pit every 50 cells along it. The far end of the valley only drains through every
+    row of the grid, the worst case for filling by spreading levels from the edges."""
+
+    dem = np.full((side, side), 100.0)
+    length = side - 2
+    rows = np.arange(1, side - 1, 2)
+    turns = np.arange(rows.size)
+    reversed_rows = turns % 2 == 1
+    cols = np.arange(1, side - 1)
+    steps = np.where(reversed_rows[:, None], side - 2 - cols[None, :], cols[None, :] - 1)
+    positions = turns[:, None] * (length + 1) + steps
+    dem[rows[:, None], cols[None, :]] = 50.0 + 0.001 * positions - 0.1 * (positions % 50 == 25)
+    # the cells joining a row to the next one, at its right end or left end in turn
+    joining = rows + 1 < side - 1
+    dem[rows[joining] + 1, np.where(reversed_rows[joining], 1, side - 2)] = (
+        50.0 + 0.001 * (turns[joining] * (length + 1) + length))
+    dem[0, 1] = 0.0
+    return dem
+
+
+def d8_flow_direction(dem):
+    """Return the D8 flow direction codes of dem, towards the steepest downslope neighbour, 0 where no neighbour is
+    lower. Edge cells only consider neighbours inside the grid."""
+
+    rows, columns = dem.shape
+    padded = np.pad(dem.astype(np.float32), 1, constant_values=np.inf)
+    best_drop = np.zeros((rows, columns), dtype=np.float32)
+    direction = np.zeros((rows, columns), dtype=np.uint8)
+    for code, (dr, dc) in D8_DIRECTIONS:
+        neighbour = padded[1 + dr:1 + dr + rows, 1 + dc:1 + dc + columns]
+        drop = (dem - neighbour) / (np.sqrt(2.0) if dr and dc else 1.0)
+        steeper = drop > best_drop
+        best_drop[steeper] = drop[steeper]
+        direction[steeper] = code
+    return direction
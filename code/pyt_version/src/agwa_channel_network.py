@@ -0,0 +1,179 @@
+import os
+import arcpy
+import hashlib
+import numpy as np
+
+
+NETWORK_ARRAYS = ["channel_ids", "from_nodes", "to_nodes", "upstream_offsets", "upstream_indices", "downstream"]
+
+
+def network_path(workspace, delineation_name, discretization_name):
+    """Return the path of the saved channel network of a discretization, next to the workspace geodatabase."""
+    return os.path.join(os.path.dirname(workspace), "channel_networks", delineation_name,
+                        f"{discretization_name}.npz")
+
+
+def channels_fingerprint(channel_ids, from_nodes, to_nodes):
+    """Return the SHA-256 of the ids and nodes of the channels, in the order of the channels feature class."""
+    sha256 = hashlib.sha256()
+    for values in [channel_ids, from_nodes, to_nodes]:
+        sha256.update(np.ascontiguousarray(values, dtype=np.int64).tobytes())
+    return sha256.hexdigest()
+
+
+def join_nodes(from_nodes, to_nodes):
+    """Sort-merge join of to_node == from_node. Returns the positions of the receiving and the contributing channel
+    of each pair, ordered by receiving channel and, for each receiving channel, by contributing channel."""
+
+    from_nodes = np.asarray(from_nodes, dtype=np.int64)
+    to_nodes = np.asarray(to_nodes, dtype=np.int64)
+    order = np.argsort(to_nodes, kind="stable")
+    sorted_to_nodes = to_nodes[order]
+    first = np.searchsorted(sorted_to_nodes, from_nodes, side="left")
+    counts = np.searchsorted(sorted_to_nodes, from_nodes, side="right") - first
+    down = np.repeat(np.arange(from_nodes.size), counts)
+    offsets = np.cumsum(counts) - counts
+    up = order[np.repeat(first, counts) + np.arange(down.size) - np.repeat(offsets, counts)]
+    return down, up
+
+
+class ChannelNetwork(object):
+    """In-memory topology of the channels of one discretization.
+
+    Channels are addressed by their position in channel_ids. The upstream neighbours of each channel are stored in
+    compressed sparse row form (upstream_offsets, upstream_indices) in the order they appear in the
+    contributing_channels table, and downstream holds the position of the receiving channel, or -1 at an outlet."""
+
+    def __init__(self, channel_ids, from_nodes, to_nodes, channel_ids_down, channel_ids_up):
+        self.channel_ids = np.asarray(channel_ids, dtype=np.int64)
+        self.from_nodes = np.asarray(from_nodes, dtype=np.int64)
+        self.to_nodes = np.asarray(to_nodes, dtype=np.int64)
+        self.index = {channel_id: i for i, channel_id in enumerate(self.channel_ids.tolist())}
+
+        channel_count = self.channel_ids.size
+        down = np.array([self.index[channel_id] for channel_id in channel_ids_down], dtype=np.int64)
+        up = np.array([self.index[channel_id] for channel_id in channel_ids_up], dtype=np.int64)
+
+        order = np.argsort(down, kind="stable")
+        self.upstream_indices = up[order]
+        self.upstream_offsets = np.zeros(channel_count + 1, dtype=np.int64)
+        np.cumsum(np.bincount(down, minlength=channel_count), out=self.upstream_offsets[1:])
+
+        self.downstream = np.full(channel_count, -1, dtype=np.int64)
+        self.downstream[up] = down
+
+        self._sequence = None
+        self.fingerprint = None
+
+    @classmethod
+    def from_nodes(cls, channel_ids, from_nodes, to_nodes):
+        """Build the channel network from the nodes of the channels: a channel contributes to the channel whose
+        from_node is its to_node. Contributing channels are listed in the order of channel_ids."""
+
+        down, up = join_nodes(from_nodes, to_nodes)
+        channel_ids = np.asarray(channel_ids, dtype=np.int64)
+        return cls(channel_ids, from_nodes, to_nodes, channel_ids[down], channel_ids[up])
+
+    @classmethod
+    def from_workspace(cls, workspace, delineation_name, discretization_name):
+        """Load the channel network of a discretization from the file saved next to the contributing_channels
+        table if it was saved for the current channels of the discretization, otherwise build it with one read of
+        the contributing_channels table and save it again. The channels feature class is read in both cases."""
+
+        channels_feature_class = os.path.join(workspace, f"{discretization_name}_channels")
+        channels = arcpy.da.TableToNumPyArray(channels_feature_class, ["ChannelID", "from_node", "to_node"])
+        path = network_path(workspace, delineation_name, discretization_name)
+        if os.path.exists(path):
+            network = cls.load(path)
+            if network.fingerprint == channels_fingerprint(channels["ChannelID"], channels["from_node"],
+                                                           channels["to_node"]):
+                return network
+
+        contributing_channels_table = os.path.join(workspace, "contributing_channels")
+        delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
+        discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
+        expression = (f"{delineation_name_field} = '{delineation_name}' And "
+                      f"{discretization_name_field} = '{discretization_name}'")
+        contributing = arcpy.da.TableToNumPyArray(contributing_channels_table, ["ChannelID", "ContributingChannel"],
+                                                  expression)
+        # contributing_channels stores the ids as text
+        channel_ids_down = [int(channel_id) for channel_id in contributing["ChannelID"]]
+        channel_ids_up = [int(channel_id) for channel_id in contributing["ContributingChannel"]]
+
+        network = cls(channels["ChannelID"], channels["from_node"], channels["to_node"], channel_ids_down,
+                      channel_ids_up)
+        network.save(path)
+        return network
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path) as arrays:
+            network = cls.__new__(cls)
+            for name in NETWORK_ARRAYS:
+                setattr(network, name, arrays[name])
+            # files saved before the fingerprint was recorded are never current
+            network.fingerprint = str(arrays["fingerprint"]) if "fingerprint" in arrays else None
+        network.index = {channel_id: i for i, channel_id in enumerate(network.channel_ids.tolist())}
+        network._sequence = None
+        return network
+
+    def save(self, path):
+        """Save the network as a compressed sparse row file, see network_path, with the fingerprint of its
+        channels."""
+        self.fingerprint = channels_fingerprint(self.channel_ids, self.from_nodes, self.to_nodes)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path}.{os.getpid()}.tmp.npz"
+        np.savez(temp_path, fingerprint=np.array(self.fingerprint),
+                 **{name: getattr(self, name) for name in NETWORK_ARRAYS})
+        os.replace(temp_path, path)
+
+    def contributing_pairs(self):
+        """Return the ids of the (receiving, contributing) channel pairs in contributing_channels table order."""
+        down = np.repeat(np.arange(len(self)), np.diff(self.upstream_offsets))
+        return self.channel_ids[down], self.channel_ids[self.upstream_indices]
+
+    def __len__(self):
+        return self.channel_ids.size
+
+    def upstream_of(self, position):
+        """Return the positions of the channels flowing directly into the channel at position."""
+        return self.upstream_indices[self.upstream_offsets[position]:self.upstream_offsets[position + 1]]
+
+    def contributing_channels(self, channel_id):
+        """Return the ids of the channels flowing directly into channel_id."""
+        return self.channel_ids[self.upstream_of(self.index[channel_id])]
+
+    def outlets(self):
+        """Return the positions of the outlet channels, i.e. channels whose to_node is no channel's from_node."""
+        return np.flatnonzero(~np.isin(self.to_nodes, self.from_nodes))
+
+    def sequence(self):
+        """Return channel positions ordered from upstream to downstream, with the outlet last.
+
+        The order is a post-order traversal from the outlet in which the contributing channel pushed last is
+        visited first, which is the order AGWA has always used for K2 channel sequence numbers."""
+
+        if self._sequence is not None:
+            return self._sequence
+
+        visited = np.zeros(len(self), dtype=bool)
+        order = np.empty(len(self), dtype=np.int64)
+        count = 0
+        for outlet in self.outlets():
+            stack = [outlet]
+            while stack:
+                position = stack[-1]
+                if visited[position]:
+                    order[count] = stack.pop()
+                    count += 1
+                    continue
+                visited[position] = True
+                upstream = self.upstream_of(position)
+                if upstream.size:
+                    stack.extend(upstream.tolist())
+                else:
+                    order[count] = stack.pop()
+                    count += 1
+
+        self._sequence = order[:count]
+        return self._sequence
@@ -0,0 +1,631 @@
+import numpy as np
+
+
+# ArcGIS D8 flow direction codes and the (row, column) offsets of the cells they point to
+D8_DIRECTIONS = [(1, (0, 1)), (2, (1, 1)), (4, (1, 0)), (8, (1, -1)),
+                 (16, (0, -1)), (32, (-1, -1)), (64, (-1, 0)), (128, (-1, 1))]
+
+
+def downstream_cells(flow_direction):
+    """Return the flat index of the cell each cell of a D8 flow direction grid drains to, -1 where the flow leaves
+    the grid or drains into a cell without a valid direction (NoData, sinks, or cells masked out of the grid)."""
+
+    flow_direction = np.asarray(flow_direction)
+    nrows, ncols = flow_direction.shape
+    downstream = np.full(flow_direction.size, -1, dtype=np.int64)
+    for code, (dr, dc) in D8_DIRECTIONS:
+        rows, cols = np.nonzero(flow_direction == code)
+        down_rows, down_cols = rows + dr, cols + dc
+        inside = (down_rows >= 0) & (down_rows < nrows) & (down_cols >= 0) & (down_cols < ncols)
+        downstream[rows[inside] * ncols + cols[inside]] = down_rows[inside] * ncols + down_cols[inside]
+
+    valid = np.isin(flow_direction.ravel(), [code for code, _ in D8_DIRECTIONS])
+    draining = downstream >= 0
+    downstream[draining & ~valid[np.maximum(downstream, 0)]] = -1
+    return downstream
+
+
+def step_lengths(flow_direction, cell_width, cell_height):
+    """Return the length of the flow step out of each cell: the cell width or height, or the diagonal."""
+
+    flow_direction = np.asarray(flow_direction).ravel()
+    lengths = np.zeros(flow_direction.size, dtype=np.float64)
+    for code, (dr, dc) in D8_DIRECTIONS:
+        lengths[flow_direction == code] = np.hypot(dr * cell_height, dc * cell_width)
+    return lengths
+
+
+def topological_levels(downstream):
+    """Return the cells in upstream-first order, as a list of levels: every cell comes after all the cells that
+    drain to it, and the cells of one level do not drain to each other. Raises ValueError on a flow loop."""
+
+    valid = downstream >= 0
+    indegree = np.bincount(downstream[valid], minlength=downstream.size)
+    frontier = np.flatnonzero(indegree == 0)
+    levels = []
+    visited = 0
+    while frontier.size:
+        levels.append(frontier)
+        visited += frontier.size
+        receiving = downstream[frontier]
+        receiving, counts = np.unique(receiving[receiving >= 0], return_counts=True)
+        indegree[receiving] -= counts
+        frontier = receiving[indegree[receiving] == 0]
+    if visited < downstream.size:
+        raise ValueError(f"The flow directions contain loops through {downstream.size - visited} cells")
+    return levels
+
+
+def accumulate(downstream, weights, levels=None):
+    """Return the sum of weights over each cell and all the cells draining to it."""
+
+    if levels is None:
+        levels = topological_levels(downstream)
+    accumulated = np.array(weights, dtype=np.float64).ravel()
+    for level in levels:
+        receiving = downstream[level]
+        draining = receiving >= 0
+        np.add.at(accumulated, receiving[draining], accumulated[level[draining]])
+    return accumulated
+
+
+def flow_accumulation(flow_direction):
+    """Return the number of cells draining to each cell, like the Flow Accumulation tool without weights."""
+
+    downstream = downstream_cells(flow_direction)
+    accumulated = accumulate(downstream, np.ones(downstream.size))
+    return (accumulated - 1).reshape(np.shape(flow_direction))
+
+
+def follow_to_root(next_cells, values=None):
+    """Follow next_cells from every cell until a root, a cell pointing to itself, by pointer jumping. Returns the
+    root of every cell and, if values are given, the sum of values along the path, the root excluded. Raises
+    ValueError if a path never reaches a root."""
+
+    next_cells = np.array(next_cells, dtype=np.int64)
+    is_root = next_cells == np.arange(next_cells.size)
+    if values is not None:
+        values = np.array(values, dtype=np.float64)
+        values[is_root] = 0.0
+    for _ in range(int(np.ceil(np.log2(max(next_cells.size, 2)))) + 2):
+        if is_root[next_cells].all():
+            return next_cells if values is None else (next_cells, values)
+        if values is not None:
+            values += values[next_cells]
+        next_cells = next_cells[next_cells]
+    raise ValueError("The flow paths contain loops")
+
+
+def channel_downstream(downstream, channels):
+    """Return the downstream cells of the channel cells restricted to the channel network, -1 elsewhere."""
+
+    channels = np.asarray(channels, dtype=bool).ravel()
+    channel_down = np.where(channels, downstream, -1)
+    draining = channel_down >= 0
+    channel_down[draining & ~channels[np.maximum(channel_down, 0)]] = -1
+    return channel_down
+
+
+def stream_link(channels, flow_direction, downstream=None):
+    """Return unique link numbers for the sections of the channel network between junctions, 0 off the channels,
+    like the Stream Link tool. A link starts at a channel head or below a junction, and links are numbered in
+    row-major order of their first cell. downstream is downstream_cells(flow_direction) if already computed."""
+
+    shape = np.shape(flow_direction)
+    channels = np.asarray(channels, dtype=bool).ravel()
+    if downstream is None:
+        downstream = downstream_cells(flow_direction)
+    channel_down = channel_downstream(downstream, channels)
+    inflows = np.bincount(channel_down[channel_down >= 0], minlength=channels.size)
+
+    # a channel cell with exactly one inflow continues the link of the cell draining to it
+    continuing = channels & (inflows == 1)
+    next_cells = np.arange(channels.size)
+    upstream = np.flatnonzero(channel_down >= 0)
+    receiving = channel_down[upstream]
+    next_cells[receiving[continuing[receiving]]] = upstream[continuing[receiving]]
+
+    starts = np.flatnonzero(channels & ~continuing)
+    link_numbers = np.zeros(channels.size, dtype=np.int64)
+    link_numbers[starts] = np.arange(1, starts.size + 1)
+    links = link_numbers[follow_to_root(next_cells)]
+    links[~channels] = 0
+    return links.reshape(shape)
+
+
+def split_stream_links(stream_links, flow_accumulation, point_links, point_facg):
+    """Split the stream links at pour points. stream_links holds link numbers with 0 off the channels; each pour
+    point lies on link point_links with flow accumulation point_facg. Every link with a higher number is renumbered
+    one up per pour point on a lower link, and the cells of a split link upstream of (with a lower flow accumulation
+    than) each of its pour points are numbered one up as well, which gives the same links as adding the pour points
+    one at a time."""
+
+    point_links = np.asarray(point_links, dtype=np.int64)
+    point_facg = np.asarray(point_facg, dtype=np.int64)
+    new_stream_links = np.array(stream_links, dtype=np.int64)
+    on_channel = new_stream_links > 0
+    links = new_stream_links[on_channel]
+    facg = np.asarray(flow_accumulation, dtype=np.int64)[on_channel]
+
+    # pour points on lower links
+    lower_points = np.searchsorted(np.sort(point_links), links, side="left")
+
+    # pour points on the same link with a higher flow accumulation, found in the (link, facg) order of the points
+    span = max(int(point_facg.max(initial=0)), int(facg.max(initial=0))) + 2
+    point_keys = np.sort(point_links * span + point_facg)
+    downstream_points = (np.searchsorted(point_keys, links * span + span - 1, side="right") -
+                         np.searchsorted(point_keys, links * span + facg, side="right"))
+
+    new_stream_links[on_channel] = links + lower_points + downstream_points
+    return new_stream_links
+
+
+def shreve_order(channels, flow_direction, downstream=None):
+    """Return the Shreve stream order of the channel cells, the number of channel heads upstream, 0 off the
+    channels, like the Stream Order tool with the SHREVE method."""
+
+    shape = np.shape(flow_direction)
+    channels = np.asarray(channels, dtype=bool).ravel()
+    if downstream is None:
+        downstream = downstream_cells(flow_direction)
+    channel_down = channel_downstream(downstream, channels)
+    inflows = np.bincount(channel_down[channel_down >= 0], minlength=channels.size)
+    heads = channels & (inflows == 0)
+    order = accumulate(channel_down, heads).astype(np.int64)
+    order[~channels] = 0
+    return order.reshape(shape)
+
+
+def zone_minimum(zones, values):
+    """Return, for each cell of a zone (zone > 0), the minimum of values over its zone, and NaN outside the zones.
+    On stream links this is what Zonal Fill gives, since every cell of a link is on its boundary."""
+
+    shape = np.shape(zones)
+    zones = np.asarray(zones).ravel()
+    values = np.asarray(values, dtype=np.float64).ravel()
+    in_zone = zones > 0
+    minimum = np.full(int(zones.max(initial=0)) + 1, np.inf)
+    np.minimum.at(minimum, zones[in_zone], values[in_zone])
+    filled = np.full(zones.size, np.nan)
+    filled[in_zone] = minimum[zones[in_zone]]
+    return filled.reshape(shape)
+
+
+def watershed(flow_direction, pour_points, downstream=None):
+    """Return, for each cell, the value of the first non-zero pour point cell on its flow path, the cell itself
+    included, and 0 where the path reaches none, like the Watershed tool."""
+
+    shape = np.shape(flow_direction)
+    if downstream is None:
+        downstream = downstream_cells(flow_direction)
+    pour_points = np.asarray(pour_points).ravel()
+    is_pour_point = pour_points != 0
+    next_cells = np.where(is_pour_point | (downstream < 0), np.arange(downstream.size), downstream)
+    roots = follow_to_root(next_cells)
+    labels = np.where(is_pour_point[roots], pour_points[roots], 0)
+    return labels.reshape(shape)
+
+
+def downstream_flow_length(flow_direction, cell_width, cell_height, downstream=None):
+    """Return the length of the flow path from each cell to where it leaves the grid or reaches a cell without a
+    valid direction, like the Flow Length tool with the DOWNSTREAM measurement. With downstream, e.g. from
+    stop_at, the paths end where downstream is -1 instead."""
+
+    shape = np.shape(flow_direction)
+    if downstream is None:
+        downstream = downstream_cells(flow_direction)
+    terminal = downstream < 0
+    lengths = step_lengths(flow_direction, cell_width, cell_height)
+    lengths[terminal] = 0.0
+    _, path_lengths = follow_to_root(np.where(terminal, np.arange(downstream.size), downstream), lengths)
+    return path_lengths.reshape(shape)
+
+
+def stop_at(downstream, cells):
+    """Return downstream with the flow paths ending at the cells before the given cells, as if the given cells had
+    no flow direction."""
+
+    cells = np.asarray(cells, dtype=bool).ravel()
+    stopped = np.where(cells, -1, downstream)
+    draining = stopped >= 0
+    stopped[draining & cells[np.maximum(stopped, 0)]] = -1
+    return stopped
+
+
+def nested_channel_networks(values, thresholds):
+    """Yield (threshold, channels) for the cells with values above each threshold, from the highest threshold to the
+    lowest. The cells are sorted by value once, and each network is the previous one with the cells between the two
+    thresholds added."""
+
+    shape = np.shape(values)
+    values = np.asarray(values, dtype=np.float64).ravel()
+    thresholds = sorted(thresholds, reverse=True)
+    candidates = np.flatnonzero(values > thresholds[-1])
+    candidates = candidates[np.argsort(-values[candidates], kind="stable")]
+    descending_values = -values[candidates]
+    channels = np.zeros(values.size, dtype=bool)
+    added = 0
+    for threshold in thresholds:
+        count = int(np.searchsorted(descending_values, -threshold, side="left"))
+        channels[candidates[added:count]] = True
+        added = count
+        yield threshold, channels.reshape(shape).copy()
+
+
+def snap_pour_points(flow_accumulation, rows, cols, radius):
+    """Return the rows and columns of the cell of highest flow accumulation within radius cells (a number, or one
+    per point) of each point, like the Snap Pour Point tool. Ties go to the cell nearest to the point."""
+
+    flow_accumulation = np.asarray(flow_accumulation, dtype=np.float64)
+    nrows, ncols = flow_accumulation.shape
+    rows, cols = np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)
+    radius = np.broadcast_to(np.asarray(radius, dtype=np.float64), rows.shape)
+    reach = int(np.floor(radius.max(initial=0)))
+    offsets = [(dr, dc) for dr in range(-reach, reach + 1) for dc in range(-reach, reach + 1)]
+    offsets.sort(key=lambda offset: offset[0] ** 2 + offset[1] ** 2)
+    best = np.full(rows.size, -np.inf)
+    snapped_rows, snapped_cols = rows.copy(), cols.copy()
+    for dr, dc in offsets:
+        near_rows, near_cols = rows + dr, cols + dc
+        inside = ((near_rows >= 0) & (near_rows < nrows) & (near_cols >= 0) & (near_cols < ncols) &
+                  (dr * dr + dc * dc <= radius * radius))
+        values = np.full(rows.size, -np.inf)
+        values[inside] = flow_accumulation[near_rows[inside], near_cols[inside]]
+        higher = values > best
+        best[higher] = values[higher]
+        snapped_rows[higher], snapped_cols[higher] = near_rows[higher], near_cols[higher]
+    return snapped_rows, snapped_cols
+
+
+def nested_watersheds(flow_direction, outlets, downstream=None):
+    """Label the watersheds of many outlets, given as flat cell indices, in one traversal. Returns zones, the
+    number (1 for the first outlet) of the first outlet on the flow path of each cell and 0 where the path reaches
+    none, like the Watershed tool, and parents, the number of the outlet each outlet drains to (0 for none). The
+    full watershed of an outlet is its zone and the zones of the outlets upstream of it (see upstream_outlets)."""
+
+    if downstream is None:
+        downstream = downstream_cells(flow_direction)
+    outlets = np.asarray(outlets, dtype=np.int64)
+    pour_points = np.zeros(downstream.size, dtype=np.int64)
+    pour_points[outlets] = np.arange(1, outlets.size + 1)
+    zones = watershed(flow_direction, pour_points, downstream).ravel()
+    below = downstream[outlets]
+    parents = np.where(below >= 0, zones[np.maximum(below, 0)], 0)
+    return zones.reshape(np.shape(flow_direction)), parents
+
+
+def upstream_outlets(parents):
+    """Return, for each outlet of nested_watersheds, the array of the numbers of the outlets whose zones make up its
+    watershed: itself and every outlet draining to it, directly or through other outlets."""
+
+    parents = np.asarray(parents, dtype=np.int64)
+    outlets = np.arange(1, parents.size + 1)
+    members, ancestors = [outlets], [outlets]
+    current = parents
+    for _ in range(parents.size + 1):
+        nested = current > 0
+        if not nested.any():
+            break
+        members.append(outlets[nested])
+        ancestors.append(current[nested])
+        current = parents[current[nested] - 1]
+        outlets = outlets[nested]
+    else:
+        raise ValueError("The outlets drain to each other in a loop")
+    members, ancestors = np.concatenate(members), np.concatenate(ancestors)
+    order = np.argsort(ancestors, kind="stable")
+    return np.split(members[order], np.searchsorted(ancestors[order], np.arange(2, parents.size + 1)))
+
+
+def zone_bounds(zones, count):
+    """Return the first row, first column, last row, and last column of the cells of each zone 1..count, as arrays
+    of length count; zones without cells get an empty range (first > last)."""
+
+    zones = np.asarray(zones)
+    rows, cols = np.nonzero(zones > 0)
+    labels = zones[rows, cols] - 1
+    first_rows = np.full(count, zones.shape[0], dtype=np.int64)
+    first_cols = np.full(count, zones.shape[1], dtype=np.int64)
+    last_rows = np.full(count, -1, dtype=np.int64)
+    last_cols = np.full(count, -1, dtype=np.int64)
+    np.minimum.at(first_rows, labels, rows)
+    np.minimum.at(first_cols, labels, cols)
+    np.maximum.at(last_rows, labels, rows)
+    np.maximum.at(last_cols, labels, cols)
+    return first_rows, first_cols, last_rows, last_cols
+
+
+def label_regions(mask):
+    """Return the 8-connected regions of the True cells of mask numbered 1, 2, ... in the row-major order of their
+    first cell, and 0 elsewhere, like the Region Group tool with EIGHT neighbours."""
+
+    mask = np.asarray(mask, dtype=bool)
+    first, second = neighbour_pairs(mask)
+    roots = join_pairs(first, second, mask.size)
+    labels = np.zeros(mask.size, dtype=np.int64)
+    labels[mask.ravel()] = np.unique(roots[mask.ravel()], return_inverse=True)[1].ravel() + 1
+    return labels.reshape(mask.shape)
+
+
+def neighbour_pairs(mask):
+    """Return the flat indices of every pair of 8-connected neighbouring True cells of mask, each pair once, the
+    smaller index first."""
+
+    nrows, ncols = mask.shape
+    index = np.arange(mask.size).reshape(mask.shape)
+    first, second = [], []
+    for dr, dc in [(0, 1), (1, -1), (1, 0), (1, 1)]:
+        rows_a, rows_b = slice(0, nrows - dr), slice(dr, nrows)
+        cols_a, cols_b = slice(max(0, -dc), ncols - max(0, dc)), slice(max(0, dc), ncols - max(0, -dc))
+        both = mask[rows_a, cols_a] & mask[rows_b, cols_b]
+        first.append(index[rows_a, cols_a][both])
+        second.append(index[rows_b, cols_b][both])
+    return np.concatenate(first), np.concatenate(second)
+
+
+def join_pairs(first, second, size):
+    """Return the root of each of size items after joining the pairs first, second: the smallest item of its
+    group. Every pair hooks the root of the larger item to the root of the smaller one, and the roots are then found
+    again by pointer jumping, until no pair joins two roots."""
+
+    parent = np.arange(size)
+    while True:
+        root_first, root_second = parent[first], parent[second]
+        joining = root_first != root_second
+        if not joining.any():
+            return parent
+        first, second = first[joining], second[joining]
+        root_first, root_second = root_first[joining], root_second[joining]
+        np.minimum.at(parent, np.maximum(root_first, root_second), np.minimum(root_first, root_second))
+        while True:
+            grandparent = parent[parent]
+            if np.array_equal(grandparent, parent):
+                break
+            parent = grandparent
+
+
+def depression_basins(dem, edge=None):
+    """Split dem (NaN for NoData) into basins, the cells descending to the same pit, and find the saddles where
+    water spills between them. Flow leaves the grid through NoData cells and the grid edges; edge, an array two rows
+    and two columns larger than dem, gives the levels of the ring of cells around dem instead: -inf where flow
+    leaves, the filled elevation of a neighbouring tile, or inf where it is not known yet.
+
+    Every cell follows its lowest lower neighbour to a pit, a cell without one; neighbouring pits of the same
+    elevation (flats) are one pit. Returns the basin of every cell numbered 1, 2, ... (0 for NoData), the bottom
+    elevation of each basin (index 0, the outside, is -inf), and the saddles: pairs of basins, 0 for the outside,
+    with the lowest level at which water crosses from one to the other, the higher of two neighbouring cells."""
+
+    dem = np.asarray(dem, dtype=np.float64)
+    nrows, ncols = dem.shape
+    valid = ~np.isnan(dem)
+    padded = np.full((nrows + 2, ncols + 2), np.nan)
+    padded[1:-1, 1:-1] = dem
+    outlet = np.full((nrows + 2, ncols + 2), -np.inf) if edge is None else np.array(edge, dtype=np.float64)
+    outlet[1:-1, 1:-1] = np.where(valid, np.inf, -np.inf)
+
+    # each cell steps to its lowest lower neighbour, and leaves through the lowest outlet next to it
+    index = np.arange(dem.size).reshape(dem.shape)
+    lowest = dem.copy()
+    next_cells = index.copy()
+    leaving = np.full(dem.shape, np.inf)
+    for _, (dr, dc) in D8_DIRECTIONS:
+        neighbour = padded[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+        lower = neighbour < lowest
+        lowest[lower] = neighbour[lower]
+        next_cells[lower] = index[lower] + dr * ncols + dc
+        leaving = np.minimum(leaving, np.maximum(dem, outlet[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]))
+    next_cells, leaving = next_cells.ravel(), leaving.ravel()
+
+    first, second = neighbour_pairs(valid)
+    pits = next_cells == index.ravel()
+    flat = pits[first] & pits[second] & (dem.ravel()[first] == dem.ravel()[second])
+    pit_roots = join_pairs(first[flat], second[flat], dem.size)
+    roots = pit_roots[follow_to_root(next_cells)]
+    basins = np.zeros(dem.size, dtype=np.int64)
+    basins[valid.ravel()] = np.unique(roots[valid.ravel()], return_inverse=True)[1].ravel() + 1
+    count = int(basins.max())
+    bottoms = np.full(count + 1, np.inf)
+    np.minimum.at(bottoms, basins[valid.ravel()], dem.ravel()[valid.ravel()])
+    bottoms[0] = -np.inf
+
+    # the lowest crossing between each pair of basins, and out of each basin
+    crossing = basins[first] != basins[second]
+    first, second = first[crossing], second[crossing]
+    out = valid.ravel() & (leaving < np.inf)
+    first_basins = np.concatenate([np.minimum(basins[first], basins[second]),
+                                   np.zeros(np.count_nonzero(out), dtype=np.int64)])
+    second_basins = np.concatenate([np.maximum(basins[first], basins[second]), basins[out]])
+    levels = np.concatenate([np.maximum(dem.ravel()[first], dem.ravel()[second]), leaving[out]])
+    pairs = first_basins * (count + 1) + second_basins
+    order = np.argsort(pairs)
+    pairs, levels = pairs[order], levels[order]
+    starts = np.flatnonzero(np.diff(pairs, prepend=-1))
+    if starts.size:
+        levels = np.minimum.reduceat(levels, starts)
+    pairs = pairs[starts]
+    return basins.reshape(dem.shape), bottoms, pairs // (count + 1), pairs % (count + 1), levels[:starts.size]
+
+
+def merge_basins(bottoms, first, second, levels):
+    """Build the depression hierarchy of basins from their saddles (see depression_basins). The saddles are taken
+    from the lowest up, like a priority flood: two basins meeting at a saddle become one depression that holds
+    both, and a basin reaching the outside (basin 0) spills there. Depressions are nodes 1, 2, ...: the basins
+    themselves, then the merged depressions. A depression still at its bottom elevation when it meets another has
+    no storage of its own and becomes part of the other one.
+
+    Returns the node of each basin (0 when it has no storage), the parent of each node (0 for the outermost
+    depressions), the spill elevation of each node (inf if it never spills), and whether each node is a
+    depression."""
+
+    count = len(bottoms) - 1
+    created = list(np.asarray(bottoms, dtype=np.float64).tolist())
+    parent = [0] * (count + 1)
+    spill = [np.inf] * (count + 1)
+    alias = list(range(count + 1))
+    components = list(range(count + 1))
+    node = list(range(count + 1))
+
+    def find(item):
+        while components[item] != item:
+            components[item] = components[components[item]]
+            item = components[item]
+        return item
+
+    order = np.argsort(levels, kind="stable")
+    for a, b, level in zip(np.asarray(first)[order].tolist(), np.asarray(second)[order].tolist(),
+                           np.asarray(levels)[order].tolist()):
+        root_a, root_b = find(a), find(b)
+        if root_a == root_b:
+            continue
+        if root_a == 0 or root_b == 0:
+            # the outside is always the root of its component
+            root = root_a or root_b
+            x = node[root]
+            if created[x] == level:
+                alias[x] = 0
+            else:
+                spill[x] = level
+            components[root] = 0
+            continue
+        x, y = node[root_a], node[root_b]
+        if created[x] == level and created[y] == level:
+            alias[y] = x
+            merged = x
+        elif created[x] == level:
+            spill[y], parent[y], merged = level, x, x
+        elif created[y] == level:
+            spill[x], parent[x], merged = level, y, y
+        else:
+            merged = len(created)
+            created.append(level)
+            parent.append(0)
+            spill.append(np.inf)
+            alias.append(merged)
+            spill[x], spill[y], parent[x], parent[y] = level, level, merged, merged
+        components[root_b] = root_a
+        node[root_a] = merged
+
+    alias = follow_to_root(alias)
+    parent = alias[np.array(parent, dtype=np.int64)]
+    is_depression = alias == np.arange(alias.size)
+    is_depression[0] = False
+    return alias[:count + 1], np.where(is_depression, parent, 0), np.array(spill), is_depression
+
+
+def _top_spill(parent, spill):
+    """Return the spill elevation of the outermost depression holding each node, -inf for node 0."""
+    top = follow_to_root(np.where(parent == 0, np.arange(parent.size), parent))
+    spill = np.asarray(spill, dtype=np.float64).copy()
+    spill[0] = -np.inf
+    return spill[top]
+
+
+def fill_depressions(dem, edge=None):
+    """Return dem with its depressions filled to their spill elevation, like the Fill tool. NaN cells are NoData;
+    flow leaves the grid through them and through the grid edges. edge, an array two rows and two columns larger
+    than dem, gives the levels of the ring of cells around dem instead: -inf where flow leaves, the filled
+    elevation of a neighbouring tile, or inf where it is not known yet. Cells that cannot reach an edge are inf.
+
+    Each cell is raised to the spill elevation of the outermost depression holding its basin (see
+    depression_basins and merge_basins), so every cell is visited once and only the saddles between basins are
+    ordered."""
+
+    dem = np.asarray(dem, dtype=np.float64)
+    basins, bottoms, first, second, levels = depression_basins(dem, edge)
+    basin_nodes, parent, spill, _ = merge_basins(bottoms, first, second, levels)
+    filled = np.maximum(dem, _top_spill(parent, spill)[basin_nodes[basins]])
+    filled[np.isnan(dem)] = np.nan
+    return filled
+
+
+def flow_directions(window, cell_width, cell_height, flat_distance=None):
+    """Return the D8 flow direction codes and flat distances of the cells inside window, a DEM with a one cell
+    ring around them (NaN outside the grid and for NoData), like the Flow Direction tool with NORMAL edges.
+
+    A cell flows to its steepest downslope neighbour. Without one, a cell next to NoData or the grid edge flows out
+    of the grid, and a cell on a flat flows to an equal neighbour one step closer to where the flat drains; the
+    flat distance counts those steps and is 0 for the other cells with a direction. flat_distance gives the flat
+    distances of the ring cells (e.g. from neighbouring tiles, a large value where unknown). Cells of flats that do
+    not drain, and sinks, get 0 and a flat distance of -1."""
+
+    window = np.asarray(window, dtype=np.float64)
+    nrows, ncols = window.shape[0] - 2, window.shape[1] - 2
+    center = window[1:-1, 1:-1]
+    best_drop = np.zeros((nrows, ncols))
+    directions = np.zeros((nrows, ncols), dtype=np.uint8)
+    outward = np.zeros((nrows, ncols), dtype=np.uint8)
+    has_equal = np.zeros((nrows, ncols), dtype=bool)
+    for code, (dr, dc) in D8_DIRECTIONS:
+        neighbour = window[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+        drop = (center - neighbour) / np.hypot(dr * cell_height, dc * cell_width)
+        steeper = drop > best_drop
+        best_drop[steeper] = drop[steeper]
+        directions[steeper] = code
+        outward[(outward == 0) & np.isnan(neighbour)] = code
+        has_equal |= neighbour == center
+    nodata = np.isnan(center)
+    leaving = (directions == 0) & (outward > 0) & ~nodata
+    directions[leaving] = outward[leaving]
+    directions[nodata] = 0
+
+    # flat distances spread from the cells with a direction through equal neighbours
+    unknown = np.iinfo(np.int64).max
+    distance = np.full(window.shape, unknown, dtype=np.int64)
+    if flat_distance is not None:
+        distance[:] = np.where(np.asarray(flat_distance) >= 0, flat_distance, unknown)
+    distance[1:-1, 1:-1] = np.where(directions > 0, 0, unknown)
+    flat = (directions == 0) & has_equal & ~nodata
+    padded_flat = np.zeros(window.shape, dtype=bool)
+    padded_flat[1:-1, 1:-1] = flat
+    elevation = window.ravel()
+    distance = distance.ravel()
+    padded_flat = padded_flat.ravel()
+    flat_cells = np.flatnonzero(padded_flat)
+    rows, cols = np.divmod(flat_cells, ncols + 2)
+
+    # the flats are searched breadth first, one step per round, from the cells with a distance next to them. A
+    # round only visits the neighbours of the cells reached in the previous round, or of the cells whose distance
+    # (e.g. from a neighbouring tile) is the distance of the round.
+    sources = []
+    for code, (dr, dc) in D8_DIRECTIONS:
+        neighbours = (rows + dr) * (ncols + 2) + cols + dc
+        sources.append(neighbours[(distance[neighbours] < unknown) & ~padded_flat[neighbours] &
+                                  (elevation[neighbours] == elevation[flat_cells])])
+    sources = np.unique(np.concatenate(sources)) if sources else np.zeros(0, dtype=np.int64)
+    sources = sources[np.argsort(distance[sources], kind="stable")]
+    source_distances = distance[sources]
+    frontier = np.zeros(0, dtype=np.int64)
+    step = 0
+    next_source = 0
+    while frontier.size or next_source < sources.size:
+        if not frontier.size:
+            step = source_distances[next_source]
+        last_source = np.searchsorted(source_distances, step, side="right")
+        frontier = np.concatenate([frontier, sources[next_source:last_source]])
+        next_source = last_source
+        frontier_rows, frontier_cols = np.divmod(frontier, ncols + 2)
+        reached = []
+        for code, (dr, dc) in D8_DIRECTIONS:
+            inside = ((frontier_rows + dr >= 0) & (frontier_rows + dr < nrows + 2) &
+                      (frontier_cols + dc >= 0) & (frontier_cols + dc < ncols + 2))
+            neighbours = (frontier_rows[inside] + dr) * (ncols + 2) + frontier_cols[inside] + dc
+            closer = (padded_flat[neighbours] & (distance[neighbours] > step + 1) &
+                      (elevation[neighbours] == elevation[frontier[inside]]))
+            reached.append(neighbours[closer])
+        frontier = np.unique(np.concatenate(reached))
+        distance[frontier] = step + 1
+        step += 1
+
+    # a flat cell flows to its first equal neighbour one step closer
+    flat_directions = np.zeros(flat_cells.size, dtype=np.uint8)
+    for code, (dr, dc) in D8_DIRECTIONS:
+        neighbours = (rows + dr) * (ncols + 2) + cols + dc
+        closer = ((flat_directions == 0) & (elevation[neighbours] == elevation[flat_cells]) &
+                  (distance[flat_cells] < unknown) & (distance[neighbours] == distance[flat_cells] - 1))
+        flat_directions[closer] = code
+    directions[rows - 1, cols - 1] = flat_directions
+
+    distance = distance.reshape(window.shape)[1:-1, 1:-1]
+    distance = np.where(distance == unknown, -1, distance)
+    distance[nodata] = -1
+    return directions, distance
@@ -0,0 +1,149 @@
+import importlib
+import numpy as np
+import pandas as pd
+import agwa_d8
+importlib.reload(agwa_d8)
+
+
+def find_depressions(dem, cell_area=1.0):
+    """Fill the depressions of dem (NaN for NoData) and describe them and their hierarchy in the same pass (see
+    agwa_d8.depression_basins and agwa_d8.merge_basins). Returns the filled DEM, the DepressionID of the outermost
+    depression holding every cell (0 outside depressions), and a DataFrame indexed by DepressionID with the
+    ParentID, SpillElevation, BottomElevation, MaxDepth, Cells, Area, and Volume of each depression.
+
+    A depression is the region of cells below its spill elevation. The outermost depressions (ParentID 0) are the
+    connected regions of cells raised by the fill, all filled to the same spill elevation; they are numbered first.
+    The depressions nested in them fill up and spill into a neighbouring depression at a lower elevation, and their
+    ParentID is the depression they merge into. The Cells, Area, and Volume of a depression include those of its
+    nested depressions. Depressions of each kind are numbered in the row-major order of their first cell."""
+
+    dem = np.asarray(dem, dtype=np.float64)
+    basins, bottoms, first, second, levels = agwa_d8.depression_basins(dem)
+    basin_nodes, parent, spill, is_depression = agwa_d8.merge_basins(bottoms, first, second, levels)
+
+    # every cell belongs to the innermost depression whose spill elevation is above it. Spill elevations rise
+    # from a depression to the ones holding it, so the cells climb from the depression of their basin by jumps of
+    # 2^k depressions, the longest first, while the spill elevation stays at or below them
+    cells = np.flatnonzero(~np.isnan(dem).ravel())
+    elevations = dem.ravel()[cells]
+    nodes = basin_nodes[basins.ravel()[cells]]
+    climb_spill = spill.copy()
+    climb_spill[0] = np.inf
+    jumps = [parent]
+    while jumps[-1].any():
+        jumps.append(jumps[-1][jumps[-1]])
+    climbing = climb_spill[nodes] <= elevations
+    for jump in reversed(jumps):
+        above = jump[nodes]
+        jumping = climbing & (climb_spill[above] <= elevations)
+        nodes[jumping] = above[jumping]
+    nodes[climbing] = parent[nodes[climbing]]
+    in_depression = nodes > 0
+    cells, elevations, nodes = cells[in_depression], elevations[in_depression], nodes[in_depression]
+    outermost = agwa_d8.follow_to_root(np.where(parent == 0, np.arange(parent.size), parent))
+
+    filled = dem.copy()
+    filled.ravel()[cells] = spill[outermost[nodes]]
+
+    # the statistics of the cells of each depression are added to the depressions holding it, innermost first
+    holding = np.where(parent > 0, parent, -1)
+    levels = agwa_d8.topological_levels(holding)
+    count = agwa_d8.accumulate(holding, np.bincount(nodes, minlength=parent.size), levels)
+    elevation_sum = agwa_d8.accumulate(holding, np.bincount(nodes, weights=elevations, minlength=parent.size),
+                                       levels)
+    bottom = np.full(parent.size, np.inf)
+    np.minimum.at(bottom, nodes, elevations)
+    first_cell = np.full(parent.size, dem.size)
+    np.minimum.at(first_cell, nodes, cells)
+    for level in levels:
+        level = level[holding[level] >= 0]
+        np.minimum.at(bottom, holding[level], bottom[level])
+        np.minimum.at(first_cell, holding[level], first_cell[level])
+    depression_nodes = np.flatnonzero(is_depression)
+
+    # the outermost depressions come first, each kind in the order of its first cell
+    depression_nodes = depression_nodes[np.lexsort((first_cell[depression_nodes],
+                                                    parent[depression_nodes] > 0))]
+    ids = np.zeros(parent.size, dtype=np.int64)
+    ids[depression_nodes] = np.arange(1, depression_nodes.size + 1)
+    labels = np.zeros(dem.size, dtype=np.int64)
+    labels[cells] = ids[outermost[nodes]]
+
+    spill_elevation = spill[depression_nodes]
+    cells_count = count[depression_nodes].astype(np.int64)
+    depressions = pd.DataFrame({"ParentID": ids[parent[depression_nodes]], "SpillElevation": spill_elevation,
+                                "BottomElevation": bottom[depression_nodes],
+                                "MaxDepth": spill_elevation - bottom[depression_nodes], "Cells": cells_count,
+                                "Area": cells_count * cell_area,
+                                "Volume": (cells_count * spill_elevation - elevation_sum[depression_nodes]) *
+                                          cell_area},
+                               index=pd.Index(np.arange(1, depression_nodes.size + 1), name="DepressionID"))
+    return filled, labels.reshape(dem.shape), depressions
+
+
+def zone_maximum(labels, values, count):
+    """Return the maximum of values over the cells of each label 1..count, -inf for labels without cells."""
+    in_zone = labels > 0
+    maximum = np.full(count, -np.inf)
+    np.maximum.at(maximum, labels[in_zone] - 1, np.asarray(values, dtype=np.float64)[in_zone])
+    return maximum
+
+
+def zone_values(labels, values, zones):
+    """Return the values of the cells of each label in zones as a dictionary of label -> array, sorting the cells
+    of all the zones by label once."""
+    labels = np.ravel(labels)
+    values = np.ravel(values)
+    zones = np.asarray(zones, dtype=labels.dtype)
+    in_zones = np.isin(labels, zones)
+    labels, values = labels[in_zones], values[in_zones]
+    order = np.argsort(labels, kind="stable")
+    labels, values = labels[order], values[order]
+    starts = np.searchsorted(labels, zones, side="left")
+    ends = np.searchsorted(labels, zones, side="right")
+    return {zone: values[start:end] for zone, start, end in zip(zones.tolist(), starts, ends)}
+
+
+def stage_storage(elevations, stages, cell_area=1.0):
+    """Return the surface area and volume of water at each stage over cells with the given elevations: the cells
+    below a stage are under water, and each holds the stage minus its elevation, as the Cut Fill tool reports for
+    a surface raised to the stage."""
+
+    elevations = np.sort(np.asarray(elevations, dtype=np.float64))
+    stages = np.asarray(stages, dtype=np.float64)
+    below = np.searchsorted(elevations, stages, side="left")
+    cumulative = np.concatenate([[0.0], np.cumsum(elevations)])
+    return below * cell_area, (below * stages - cumulative[below]) * cell_area
+
+
+def nearest_labels(labels, rows, cols, cell_width=1.0, cell_height=1.0, block_size=2 ** 22):
+    """Return the label of the labelled cell nearest to each of the cells rows, cols (which may lie outside the
+    grid), or 0 when there are no labelled cells, like a spatial join with the CLOSEST match option.
+
+    Stepping from a labelled cell towards a point gets closer to it, so the nearest labelled cell of a point outside
+    the labels is a cell next to an unlabelled cell or on the grid edge. The points are compared with those cells
+    only, block_size distances at a time."""
+
+    labels = np.asarray(labels)
+    labelled = labels > 0
+    padded = np.zeros((labels.shape[0] + 2, labels.shape[1] + 2), dtype=bool)
+    padded[1:-1, 1:-1] = labelled
+    interior = (padded[:-2, 1:-1] & padded[2:, 1:-1] & padded[1:-1, :-2] & padded[1:-1, 2:])
+    boundary_rows, boundary_cols = np.nonzero(labelled & ~interior)
+    boundary_labels = labels[boundary_rows, boundary_cols]
+
+    rows = np.ravel(rows)
+    cols = np.ravel(cols)
+    nearest = np.zeros(rows.size, dtype=labels.dtype)
+    if boundary_labels.size == 0:
+        return nearest
+    inside = (rows >= 0) & (rows < labels.shape[0]) & (cols >= 0) & (cols < labels.shape[1])
+    nearest[inside] = labels[rows[inside], cols[inside]]
+    outside = np.flatnonzero(nearest == 0)
+    points_per_block = max(1, block_size // boundary_labels.size)
+    for start in range(0, outside.size, points_per_block):
+        points = outside[start:start + points_per_block]
+        distance = (((boundary_rows - rows[points, None]) * cell_height) ** 2 +
+                    ((boundary_cols - cols[points, None]) * cell_width) ** 2)
+        nearest[points] = boundary_labels[np.argmin(distance, axis=1)]
+    return nearest
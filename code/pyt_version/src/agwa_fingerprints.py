@@ -0,0 +1,312 @@
+import os
+import json
+import arcpy
+import hashlib
+import importlib
+import numpy as np
+from datetime import datetime
+import agwa_parameter_store
+importlib.reload(agwa_parameter_store)
+
+
+HASH_BLOCK_SIZE = 1024 * 1024
+
+
+def file_signature(path, hashes=None):
+    """Return the modification time, size, and SHA-256 of a file. hashes is an optional dictionary of previously
+    computed hashes keyed by path, modification time, and size, so unchanged files are not read again."""
+
+    stat = os.stat(path)
+    key = f"{os.path.abspath(path)}|{stat.st_mtime_ns}|{stat.st_size}"
+    if hashes is not None and key in hashes:
+        digest = hashes[key]
+    else:
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+                sha256.update(block)
+        digest = sha256.hexdigest()
+        if hashes is not None:
+            hashes[key] = digest
+    return {"path": os.path.abspath(path), "mtime": stat.st_mtime_ns, "size": stat.st_size, "sha256": digest}
+
+
+def source_signature(source, hashes=None, signatures=None):
+    """Return a JSON-serializable signature of an input of a step.
+
+    Files are described by modification time, size, and content hash, and folders (e.g. Esri grids or a whole
+    geodatabase such as gSSURGO) by the modification time and size of their files. Datasets inside a geodatabase have
+    no file of their own, so they are described by a hash of their content: rasters by their cell values, and tables
+    and feature classes (e.g. the lookup tables) by the values of all their fields. Anything else, e.g. an option
+    value, is used as is.
+
+    The content hash of a dataset is kept in hashes under the modification time of the files of its geodatabase and
+    its row count or extent, and is only computed again when these change. signatures is an optional dictionary of
+    the signatures computed during the current run, so each source is described once per run."""
+
+    if not isinstance(source, str) or source == "":
+        return source
+    if signatures is not None:
+        if source not in signatures:
+            signatures[source] = source_signature(source, hashes)
+        return signatures[source]
+    if os.path.isfile(source):
+        return file_signature(source, hashes)
+    if os.path.isdir(source):
+        files = []
+        for root, _, names in os.walk(source):
+            for name in sorted(names):
+                if name.endswith(".lock"):
+                    continue
+                stat = os.stat(os.path.join(root, name))
+                files.append([os.path.relpath(os.path.join(root, name), source), stat.st_mtime_ns, stat.st_size])
+        return {"path": os.path.abspath(source), "files": files}
+    if arcpy.Exists(source):
+        description = arcpy.Describe(source)
+        signature = {"path": source, "dataType": description.dataType}
+        if description.dataType in ["RasterDataset", "RasterBand"]:
+            raster = arcpy.Raster(source)
+            signature["extent"] = [raster.extent.XMin, raster.extent.YMin, raster.extent.XMax, raster.extent.YMax,
+                                   raster.width, raster.height]
+            signature["sha256"] = dataset_content_hash(source, signature, raster_content_hash, hashes)
+        elif description.dataType in ["Table", "FeatureClass"]:
+            signature["rows"] = int(arcpy.management.GetCount(source)[0])
+            if description.dataType == "FeatureClass":
+                signature["extent"] = [description.extent.XMin, description.extent.YMin, description.extent.XMax,
+                                       description.extent.YMax]
+            signature["sha256"] = dataset_content_hash(source, signature, table_content_hash, hashes)
+        return signature
+    return source
+
+
+def dataset_content_hash(source, signature, content_hash, hashes=None):
+    """Return the content hash of a dataset in a geodatabase, taken from hashes if neither the files of the
+    geodatabase nor the row count or extent in signature changed since it was computed. A file geodatabase does not
+    tell which of its files holds a dataset, so any change to the geodatabase computes the hash again."""
+
+    modified = geodatabase_modified(source)
+    if hashes is None or modified is None:
+        return content_hash(source)
+    key = f"{source}|{modified}|{json.dumps(signature, sort_keys=True, default=str)}"
+    if key not in hashes:
+        # hashes of earlier versions of the dataset are never looked up again
+        for old_key in [k for k in hashes if k.startswith(f"{source}|")]:
+            del hashes[old_key]
+        hashes[key] = content_hash(source)
+    return hashes[key]
+
+
+def geodatabase_modified(source):
+    """Return the latest modification time of the files of the file geodatabase holding a dataset, or None if the
+    dataset is not in a file geodatabase."""
+
+    path = os.path.abspath(source)
+    while not path.lower().endswith(".gdb"):
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+    if not os.path.isdir(path):
+        return None
+    return max((entry.stat().st_mtime_ns for entry in os.scandir(path)
+                if entry.is_file() and not entry.name.endswith(".lock")), default=0)
+
+
+def raster_content_hash(raster):
+    """Return the SHA-256 of the cell values, extent, cell size, NoData value, and spatial reference of a raster,
+    read a block of rows at a time."""
+
+    raster = arcpy.Raster(raster)
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps([raster.extent.XMin, raster.extent.YMin, raster.extent.XMax, raster.extent.YMax,
+                              raster.meanCellWidth, raster.meanCellHeight, raster.noDataValue,
+                              raster.spatialReference.exportToString()], default=str).encode("utf-8"))
+    rows_per_block = max(1, HASH_BLOCK_SIZE * 16 // max(1, raster.width * 8))
+    for row in range(0, raster.height, rows_per_block):
+        nrows = min(rows_per_block, raster.height - row)
+        corner = arcpy.Point(raster.extent.XMin, raster.extent.YMax - (row + nrows) * raster.meanCellHeight)
+        block = arcpy.RasterToNumPyArray(raster, corner, raster.width, nrows)
+        sha256.update(np.ascontiguousarray(block).tobytes())
+    return sha256.hexdigest()
+
+
+def table_content_hash(table):
+    """Return the SHA-256 of the field names and the values of every row of a table or feature class (shapes as
+    WKB), in object id order, so editing any value, e.g. in a lookup table, changes the hash."""
+
+    description = arcpy.Describe(table)
+    fields = [field.name for field in arcpy.ListFields(table)
+              if field.type not in ["OID", "Geometry", "Raster", "Blob", "GlobalID"]]
+    if description.dataType == "FeatureClass":
+        fields.append("SHAPE@WKB")
+
+    def encode(value):
+        if isinstance(value, (bytes, bytearray, memoryview)):
+            return bytes(value).hex()
+        return str(value)
+
+    sha256 = hashlib.sha256()
+    sha256.update(json.dumps(fields).encode("utf-8"))
+    with arcpy.da.SearchCursor(table, ["OID@"] + fields) as cursor:
+        rows = sorted(cursor, key=lambda row: row[0])
+    for row in rows:
+        sha256.update(json.dumps(row[1:], default=encode).encode("utf-8"))
+    return sha256.hexdigest()
+
+
+def fingerprint(sources, options, hashes=None, signatures=None):
+    """Return the SHA-256 of the signatures of the sources and the options of a step."""
+
+    document = {"sources": [source_signature(source, hashes, signatures) for source in sources],
+                "options": options}
+    return hashlib.sha256(json.dumps(document, sort_keys=True, default=str).encode("utf-8")).hexdigest()
+
+
+def discretization_version(prjgdb, delineation_name, discretization_name):
+    """Return the creation date of a discretization in the metaDiscretization table, which changes whenever the
+    discretization is created again."""
+
+    meta_discretization_table = os.path.join(prjgdb, "metaDiscretization")
+    delineation_name_field = arcpy.AddFieldDelimiters(prjgdb, "DelineationName")
+    discretization_name_field = arcpy.AddFieldDelimiters(prjgdb, "DiscretizationName")
+    expression = (f"{delineation_name_field} = '{delineation_name}' And "
+                  f"{discretization_name_field} = '{discretization_name}'")
+    creation_dates = [row[0] for row in arcpy.da.SearchCursor(meta_discretization_table, ["CreationDate"],
+                                                              expression)]
+    return max(creation_dates) if creation_dates else None
+
+
+class FingerprintRegistry(object):
+    """Fingerprints of the parameterization steps that have run, kept in fingerprints.json in the parameter store.
+
+    Each record holds the step, the parameterization it ran for, the fingerprint of its inputs, and the fields it
+    produced in each parameter table. A step whose fingerprint matches a record of another parameterization of the
+    same discretization can take those fields from the parameter store instead of running again."""
+
+    def __init__(self, store_directory):
+        self.store_directory = store_directory
+        self.path = os.path.join(store_directory, "fingerprints.json")
+        self.hashes = self.read().get("hashes", {})
+        # a registry lives for one run, in which the sources do not change
+        self.signatures = {}
+
+    @classmethod
+    def for_workspace(cls, workspace):
+        return cls(agwa_parameter_store.ParameterStore.for_workspace(workspace).store_directory)
+
+    def read(self):
+        if not os.path.exists(self.path):
+            return {"steps": [], "hashes": {}}
+        with open(self.path, "r") as f:
+            return json.load(f)
+
+    def write(self, document):
+        os.makedirs(self.store_directory, exist_ok=True)
+        document["hashes"] = self.hashes
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(document, f, indent=2)
+        os.replace(temp_path, self.path)
+
+    def fingerprint(self, sources, options):
+        return fingerprint(sources, options, self.hashes, self.signatures)
+
+    def find(self, delineation_name, discretization_name, step_name, step_fingerprint, exclude=None):
+        """Return the most recent record of a step with the given fingerprint whose parameterization is still in the
+        parameter store, or None."""
+
+        store = agwa_parameter_store.ParameterStore(self.store_directory)
+        for record in reversed(self.read()["steps"]):
+            if (record["DelineationName"] != delineation_name or record["DiscretizationName"] != discretization_name
+                    or record["Step"] != step_name or record["Fingerprint"] != step_fingerprint
+                    or record["ParameterizationName"] == exclude):
+                continue
+            if all(store.exists(table_name, delineation_name, discretization_name, record["ParameterizationName"])
+                   for table_name in record["Fields"]):
+                return record
+        return None
+
+    def record(self, delineation_name, discretization_name, parameterization_name, step_name, step_fingerprint,
+               fields):
+        """Record that a step ran for a parameterization and produced fields, a dictionary of table -> fields."""
+
+        document = self.read()
+        document["steps"] = [record for record in document["steps"]
+                             if not (record["DelineationName"] == delineation_name and
+                                     record["DiscretizationName"] == discretization_name and
+                                     record["ParameterizationName"] == parameterization_name and
+                                     record["Step"] == step_name)]
+        document["steps"].append({"DelineationName": delineation_name,
+                                  "DiscretizationName": discretization_name,
+                                  "ParameterizationName": parameterization_name,
+                                  "Step": step_name,
+                                  "Fingerprint": step_fingerprint,
+                                  "Fields": fields,
+                                  "CreationDate": datetime.now().isoformat()})
+        self.write(document)
+
+    def read_fields(self, workspace, record):
+        """Read the fields of a record from the parameter store, as a dictionary of table -> DataFrame indexed by
+        element id."""
+
+        tables = {}
+        for table_name, fields in record["Fields"].items():
+            key_field = agwa_parameter_store.KEY_FIELDS[table_name]
+            df = agwa_parameter_store.read_parameter_set(workspace, table_name, record["DelineationName"],
+                                                         record["DiscretizationName"],
+                                                         record["ParameterizationName"])
+            tables[table_name] = df[[key_field] + [field for field in fields if field in df.columns]]
+        return tables
+
+
+class StepCache(object):
+    """Fingerprint cache of the steps of an agwa_pipeline.Pipeline that write fields of the parameter tables.
+
+    A step's fingerprint covers its sources, its options, and the fingerprints of the steps it depends on, so a
+    change propagates downstream. A step that matches a previous parameterization has its output fields copied from
+    that parameterization into the current set in the geodatabase and is not run."""
+
+    def __init__(self, workspace, delineation_name, discretization_name, parameterization_name):
+        self.workspace = workspace
+        self.delineation_name = delineation_name
+        self.discretization_name = discretization_name
+        self.parameterization_name = parameterization_name
+        self.registry = FingerprintRegistry.for_workspace(workspace)
+
+    def fingerprint(self, step, dependency_fingerprints):
+        return self.registry.fingerprint(step.sources, {"step": step.name, "options": step.options,
+                                                        "dependencies": dependency_fingerprints})
+
+    @staticmethod
+    def output_fields(step):
+        """Return the fields a step writes as a dictionary of table -> fields, or None if it has other outputs."""
+        if step.returns:
+            return None
+        fields = {}
+        for output in step.outputs:
+            table_name, _, field = output.partition(".")
+            if table_name not in agwa_parameter_store.KEY_FIELDS or not field:
+                return None
+            fields.setdefault(table_name, []).append(field)
+        return fields or None
+
+    def reuse(self, step):
+        fields = self.output_fields(step)
+        if fields is None:
+            return False
+        record = self.registry.find(self.delineation_name, self.discretization_name, step.name, step.fingerprint,
+                                    exclude=self.parameterization_name)
+        if record is None:
+            return False
+        for table_name, df in self.registry.read_fields(self.workspace, record).items():
+            agwa_parameter_store.mirror_parameter_set(self.workspace, table_name, self.delineation_name,
+                                                      self.discretization_name, self.parameterization_name, df)
+        step.reused_from = record["ParameterizationName"]
+        return True
+
+    def record(self, step):
+        fields = self.output_fields(step)
+        if fields is None:
+            return
+        self.registry.record(self.delineation_name, self.discretization_name, self.parameterization_name,
+                             step.name, step.fingerprint, fields)
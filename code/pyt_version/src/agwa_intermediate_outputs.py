@@ -0,0 +1,128 @@
+import os
+import time
+import threading
+import importlib
+import concurrent.futures
+import arcpy
+import agwa_tracing
+import agwa_pipeline
+importlib.reload(agwa_tracing)
+importlib.reload(agwa_pipeline)
+
+
+class IntermediateOutputs(object):
+    """Saves intermediate rasters named intermediate_<discretization name>_<raster name> in a workspace, in a
+    background writer process so the tool does not wait on disk I/O. The writer process has its own arcpy, so its
+    saves never run concurrently with the tool's arcpy calls in one process, and the LZ77 compression is set in its
+    environment only; rasters written by the tool itself are not compressed. At most max_queued saves are pending,
+    and arrays waiting to be written are limited to memory_budget bytes; a save blocks while either is full. close()
+    waits for the pending saves, records them as spans of the current run, and reports failed saves as warnings.
+    When enabled is False nothing is saved and no process is started.
+
+        with agwa_intermediate_outputs.IntermediateOutputs(workspace, save_intermediate_outputs) as outputs:
+            outputs.save_array(frame, stream_order, discretization_name, "StreamOrder")
+    """
+
+    def __init__(self, workspace, enabled, max_queued=8, memory_budget=1024 ** 3, compression="LZ77",
+                 message_function=arcpy.AddWarning):
+        self.workspace = workspace
+        self.enabled = bool(enabled)
+        self.max_queued = max_queued
+        self.memory_budget = memory_budget
+        self.compression = compression
+        self.message_function = message_function
+        self.saved = []
+        self.errors = []
+        self._queued = 0
+        self._queued_bytes = 0
+        self._budget = threading.Condition()
+        self._executor = None
+
+    def __enter__(self):
+        if self.enabled:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=1, mp_context=agwa_pipeline.process_context(),
+                initializer=agwa_pipeline.apply_environment,
+                initargs=({"compression": self.compression, "overwriteOutput": True},))
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+        return False
+
+    def path(self, discretization_name, raster_name):
+        return os.path.join(self.workspace, f"intermediate_{discretization_name}_{raster_name}")
+
+    def save_raster(self, raster, discretization_name, raster_name):
+        """Save a copy of an arcpy raster. Raster objects, often temporary, cannot be passed to the writer process,
+        so the copy is saved in the calling thread, compressed like the queued saves."""
+        if self.enabled:
+            start_time = time.perf_counter()
+            path = self.path(discretization_name, raster_name)
+            try:
+                with arcpy.EnvManager(compression=self.compression):
+                    arcpy.Raster(raster).save(path)
+                self.saved.append((raster_name, start_time, time.perf_counter()))
+            except Exception as e:
+                self.errors.append((path, e))
+
+    def save_array(self, frame, array, discretization_name, raster_name, value_to_nodata=None):
+        """Queue an array in frame (see agwa_raster_arrays.RasterFrame). The array must not be modified after."""
+        if self.enabled:
+            extent = frame.extent
+            self._put(raster_name, array.nbytes, self.path(discretization_name, raster_name),
+                      (array, extent.XMin, extent.YMax - array.shape[0] * frame.cell_height, frame.cell_width, frame.cell_height,
+                       frame.spatial_reference.exportToString(), value_to_nodata))
+
+    def _put(self, name, nbytes, path, arguments):
+        with self._budget:
+            # a save larger than the budget is still accepted when nothing else is waiting
+            self._budget.wait_for(lambda: self._queued == 0 or (
+                self._queued < self.max_queued and self._queued_bytes + nbytes <= self.memory_budget))
+            self._queued += 1
+            self._queued_bytes += nbytes
+        try:
+            future = self._executor.submit(write_array, path, *arguments)
+        except Exception as e:
+            # the writer process has died; the save is reported like a failed one
+            future = concurrent.futures.Future()
+            future.set_exception(e)
+        future.add_done_callback(lambda done: self._done(done, name, nbytes, path))
+
+    def _done(self, future, name, nbytes, path):
+        try:
+            start_time, end_time = future.result()
+            self.saved.append((name, start_time, end_time))
+        except Exception as e:
+            self.errors.append((path, e))
+        finally:
+            with self._budget:
+                self._queued -= 1
+                self._queued_bytes -= nbytes
+                self._budget.notify_all()
+
+    def close(self):
+        """Wait for the pending saves to be written and stop the writer process."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        for name, start_time, end_time in self.saved:
+            agwa_tracing.record_span(f"Saving intermediate {name}", start_time, end_time, lane=1)
+        for path, e in self.errors:
+            self.message_function(f"Could not save the intermediate output {path}: {e}")
+        self.saved = []
+        self.errors = []
+
+
+def write_array(path, array, x_min, y_min, cell_width, cell_height, spatial_reference, value_to_nodata):
+    """Save array as a raster with its lower left corner at x_min, y_min and define its spatial reference, given as
+    the string of SpatialReference.exportToString(). Runs in the writer process; returns the perf_counter() times
+    of the save, which share the clock of the tool's process."""
+
+    start_time = time.perf_counter()
+    raster = arcpy.NumPyArrayToRaster(array, arcpy.Point(x_min, y_min), cell_width, cell_height, value_to_nodata)
+    raster.save(path)
+    reference = arcpy.SpatialReference()
+    reference.loadFromString(spatial_reference)
+    arcpy.management.DefineProjection(path, reference)
+    return start_time, time.perf_counter()
@@ -0,0 +1,491 @@
+import os
+import json
+import arcpy
+import importlib
+import numpy as np
+import pandas as pd
+from datetime import datetime
+import agwa_table_writer
+importlib.reload(agwa_table_writer)
+
+
+KEY_FIELDS = {"parameters_hillslopes": "HillslopeID",
+              "parameters_channels": "ChannelID"}
+SET_FIELDS = ["DelineationName", "DiscretizationName", "ParameterizationName"]
+SKIPPED_FIELD_TYPES = ["OID", "Geometry", "Blob", "Raster", "GlobalID", "GUID"]
+
+
+class ParameterStore(object):
+    """Columnar store of the parameter tables, partitioned by (delineation, discretization, parameterization).
+
+    Each parameter set is saved as one NumPy structured array per table, sorted by the table's element id
+    (HillslopeID or ChannelID), under <store>/<delineation>/<discretization>/<parameterization>/<table>.npy.
+    Files are opened memory-mapped, so reading one set only touches that set's bytes and element ids are looked
+    up with a binary search. A catalog.json file at the root of the store lists the sets it holds. The
+    parameters_hillslopes and parameters_channels tables in the geodatabase are kept as a mirror for display.
+
+    A set can be layered on a parent set of the same delineation and discretization. A layered set only saves the
+    rows and columns that differ from its parent, and reads resolve the rest through the parent chain."""
+
+    def __init__(self, store_directory):
+        self.store_directory = store_directory
+        self.catalog_path = os.path.join(store_directory, "catalog.json")
+
+    @classmethod
+    def for_workspace(cls, workspace):
+        """Return the store kept next to a delineation workspace geodatabase."""
+        return cls(os.path.join(os.path.dirname(workspace), "parameter_store"))
+
+    def read_catalog(self):
+        if not os.path.exists(self.catalog_path):
+            return {"sets": {}}
+        with open(self.catalog_path, "r") as f:
+            return json.load(f)
+
+    def write_catalog(self, catalog):
+        os.makedirs(self.store_directory, exist_ok=True)
+        temp_path = f"{self.catalog_path}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(catalog, f, indent=2)
+        os.replace(temp_path, self.catalog_path)
+
+    @staticmethod
+    def set_key(delineation_name, discretization_name, parameterization_name):
+        return f"{delineation_name}/{discretization_name}/{parameterization_name}"
+
+    def table_path(self, table_name, delineation_name, discretization_name, parameterization_name):
+        return os.path.join(self.store_directory, delineation_name, discretization_name, parameterization_name,
+                            f"{table_name}.npy")
+
+    def exists(self, table_name, delineation_name, discretization_name, parameterization_name):
+        catalog = self.read_catalog()
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        while key in catalog["sets"]:
+            entry = catalog["sets"][key]
+            if table_name in entry["tables"]:
+                return True
+            if entry.get("ParentParameterizationName") is None:
+                return False
+            key = self.set_key(delineation_name, discretization_name, entry["ParentParameterizationName"])
+        return False
+
+    def parent(self, delineation_name, discretization_name, parameterization_name):
+        """Return the name of the parameterization a set is layered on, or None."""
+        catalog = self.read_catalog()
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        return catalog["sets"].get(key, {}).get("ParentParameterizationName")
+
+    def children(self, delineation_name, discretization_name, parameterization_name):
+        """Return the names of the parameterizations layered directly on a set."""
+        catalog = self.read_catalog()
+        return [entry["ParameterizationName"] for entry in catalog["sets"].values()
+                if entry["DelineationName"] == delineation_name and entry["DiscretizationName"] == discretization_name
+                and entry.get("ParentParameterizationName") == parameterization_name]
+
+    def create_layer(self, delineation_name, discretization_name, parent_parameterization_name,
+                     parameterization_name):
+        """Create a set that inherits every table of its parent without copying any rows."""
+
+        catalog = self.read_catalog()
+        parent_key = self.set_key(delineation_name, discretization_name, parent_parameterization_name)
+        if parent_key not in catalog["sets"]:
+            raise Exception(f"The parameterization '{parent_parameterization_name}' is not in the parameter store.")
+        if parent_parameterization_name == parameterization_name:
+            raise Exception(f"The parameterization '{parameterization_name}' cannot be layered on itself.")
+        self.delete(delineation_name, discretization_name, parameterization_name)
+        catalog = self.read_catalog()
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        catalog["sets"][key] = {"DelineationName": delineation_name,
+                                "DiscretizationName": discretization_name,
+                                "ParameterizationName": parameterization_name,
+                                "ParentParameterizationName": parent_parameterization_name,
+                                "tables": {}}
+        self.write_catalog(catalog)
+
+    def set_parent(self, delineation_name, discretization_name, parameterization_name, parent_parameterization_name):
+        """Layer an existing set on another set. The values of the set are not changed; its tables are saved again
+        with only the columns that differ from the new parent."""
+
+        catalog = self.read_catalog()
+        if parameterization_name in self.lineage(catalog, delineation_name, discretization_name,
+                                                 parent_parameterization_name):
+            raise Exception(f"The parameterization '{parameterization_name}' cannot be layered on "
+                            f"'{parent_parameterization_name}' because it is one of its parents.")
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        tables = {table_name: self.read(table_name, delineation_name, discretization_name, parameterization_name)
+                  for table_name in KEY_FIELDS
+                  if self.exists(table_name, delineation_name, discretization_name, parameterization_name)}
+        catalog["sets"][key]["ParentParameterizationName"] = parent_parameterization_name
+        self.write_catalog(catalog)
+        for table_name, df in tables.items():
+            self.write(table_name, delineation_name, discretization_name, parameterization_name, df)
+
+    def lineage(self, catalog, delineation_name, discretization_name, parameterization_name):
+        """Return the parameterization names from a set up to the root of its parent chain."""
+        names = []
+        while parameterization_name is not None and parameterization_name not in names:
+            names.append(parameterization_name)
+            key = self.set_key(delineation_name, discretization_name, parameterization_name)
+            parameterization_name = catalog["sets"].get(key, {}).get("ParentParameterizationName")
+        return names
+
+    def write(self, table_name, delineation_name, discretization_name, parameterization_name, df):
+        """Save the rows of one parameter set. The set name columns are implied by the partition and not stored.
+        If the set is layered on a parent with the same element ids, only the rows and columns that differ are
+        saved."""
+
+        # sets layered on this one keep their current values: a child that inherits a column whose values change
+        # is saved again against the new values. Its own values then do not change, so neither do its children's.
+        snapshots = []
+        children = self.children(delineation_name, discretization_name, parameterization_name)
+        if children and self.exists(table_name, delineation_name, discretization_name, parameterization_name):
+            df_current = self.read(table_name, delineation_name, discretization_name, parameterization_name)
+            changed = changed_columns(df_current, df, KEY_FIELDS[table_name])
+            catalog = self.read_catalog()
+            for child in children:
+                if changed & self.inherited_columns(catalog, table_name, delineation_name, discretization_name,
+                                                    child, set(df_current.columns) | set(df.columns)):
+                    snapshots.append((child, self.read(table_name, delineation_name, discretization_name, child)))
+
+        self.save(table_name, delineation_name, discretization_name, parameterization_name, df)
+        for child, df_child in snapshots:
+            self.save(table_name, delineation_name, discretization_name, child, df_child)
+
+    def inherited_columns(self, catalog, table_name, delineation_name, discretization_name, parameterization_name,
+                          parent_columns):
+        """Return the columns of a set that take some of their values from its parent, all of the parent's columns
+        if the set has not saved the table."""
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        table = catalog["sets"][key]["tables"].get(table_name)
+        if table is None:
+            return set(parent_columns)
+        if table.get("sparse"):
+            return set(table["columns"])
+        return set(table["inherited"])
+
+    def save(self, table_name, delineation_name, discretization_name, parameterization_name, df):
+        """Save the rows of one parameter set against the current values of its parent."""
+
+        key_field = KEY_FIELDS[table_name]
+        df = df.drop(columns=[c for c in SET_FIELDS + ["OBJECTID"] if c in df.columns])
+        df = df.sort_values(key_field, kind="stable").reset_index(drop=True)
+
+        # with the same element ids as the parent, columns equal to the parent's are not saved, and of the other
+        # columns only the rows that differ, if the parent has all of them
+        inherited = []
+        sparse = False
+        records = df
+        parent_parameterization_name = self.parent(delineation_name, discretization_name, parameterization_name)
+        if parent_parameterization_name is not None and self.exists(table_name, delineation_name, discretization_name,
+                                                                    parent_parameterization_name):
+            df_parent = self.read(table_name, delineation_name, discretization_name, parent_parameterization_name)
+            if np.array_equal(df_parent[key_field].to_numpy(), df[key_field].to_numpy()):
+                inherited = [column for column in df.columns if column != key_field and column in df_parent.columns
+                             and columns_equal(df[column], df_parent[column])]
+                records = df.drop(columns=inherited)
+                own_columns = [column for column in records.columns if column != key_field]
+                if all(column in df_parent.columns for column in own_columns):
+                    sparse = True
+                    overridden = np.zeros(len(df), dtype=bool)
+                    for column in own_columns:
+                        overridden |= ~values_equal(df[column], df_parent[column])
+                    records = records[overridden]
+        records = to_structured_array(records)
+
+        path = self.table_path(table_name, delineation_name, discretization_name, parameterization_name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = f"{path[:-4]}.tmp.npy"
+        np.save(temp_path, records, allow_pickle=False)
+        os.replace(temp_path, path)
+
+        catalog = self.read_catalog()
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        entry = catalog["sets"].setdefault(key, {"DelineationName": delineation_name,
+                                                 "DiscretizationName": discretization_name,
+                                                 "ParameterizationName": parameterization_name,
+                                                 "ParentParameterizationName": None,
+                                                 "tables": {}})
+        entry["tables"][table_name] = {"file": os.path.relpath(path, self.store_directory),
+                                       "key": key_field,
+                                       "rows": len(df),
+                                       "columns": list(df.columns),
+                                       "inherited": inherited,
+                                       "sparse": sparse,
+                                       "ModifiedDate": datetime.now().isoformat()}
+        self.write_catalog(catalog)
+
+    def load(self, table_name, delineation_name, discretization_name, parameterization_name):
+        """Return the memory-mapped structured array saved for one parameter set. For a layered set this only holds
+        the columns, and if the set is sparse the rows, that differ from the parent. Callers copy what they read, so
+        the file is not held open and can be replaced by the next write (a mapped file cannot be replaced on
+        Windows)."""
+        path = self.table_path(table_name, delineation_name, discretization_name, parameterization_name)
+        return np.load(path, mmap_mode="r", allow_pickle=False)
+
+    def resolve(self, table_name, delineation_name, discretization_name, parameterization_name, columns=None):
+        """Return the columns of one parameter set as a dictionary of arrays sorted by element id, resolving
+        inherited columns through the parent chain. Only the requested columns are read from the files."""
+
+        catalog = self.read_catalog()
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        entry = catalog["sets"][key]
+        table = entry["tables"].get(table_name)
+        if table is None:
+            return self.resolve(table_name, delineation_name, discretization_name,
+                                entry["ParentParameterizationName"], columns)
+
+        columns = table["columns"] if columns is None else [c for c in columns if c in table["columns"]]
+        key_field = KEY_FIELDS[table_name]
+        if key_field not in columns:
+            columns = [key_field] + columns
+        inherited = [column for column in columns if column in table["inherited"]]
+        sparse = table.get("sparse", False)
+        values = {}
+        if inherited or sparse:
+            # a sparse set takes every column from its parent, then replaces the rows it saved
+            values = self.resolve(table_name, delineation_name, discretization_name,
+                                  entry["ParentParameterizationName"], columns if sparse else inherited)
+        array = self.load(table_name, delineation_name, discretization_name, parameterization_name)
+        rows = np.searchsorted(values[key_field], array[key_field]) if sparse else None
+        for column in columns:
+            if column in inherited or (sparse and column == key_field):
+                continue
+            if sparse:
+                merged = values[column].astype(np.promote_types(values[column].dtype, array.dtype[column]))
+                merged[rows] = array[column]
+                values[column] = merged
+            else:
+                # copy the column out of the memory map so no view of the file outlives this call
+                values[column] = np.array(array[column])
+        del array
+        return {column: values[column] for column in columns}
+
+    def read(self, table_name, delineation_name, discretization_name, parameterization_name, columns=None):
+        """Read one parameter set as a DataFrame, including the set name columns."""
+
+        values = self.resolve(table_name, delineation_name, discretization_name, parameterization_name, columns)
+        if columns is not None:
+            values = {column: values[column] for column in columns if column in values}
+        df = pd.DataFrame({column: np.asarray(array) for column, array in values.items()})
+        df.insert(0, "DelineationName", delineation_name)
+        df.insert(1, "DiscretizationName", discretization_name)
+        df.insert(2, "ParameterizationName", parameterization_name)
+        return df
+
+    def lookup(self, table_name, delineation_name, discretization_name, parameterization_name, element_ids,
+               columns=None):
+        """Read the rows of the given element ids from one parameter set. Ids that are not in the set are dropped."""
+
+        values = self.resolve(table_name, delineation_name, discretization_name, parameterization_name, columns)
+        keys = values[KEY_FIELDS[table_name]]
+        element_ids = np.asarray(element_ids)
+        position = np.searchsorted(keys, element_ids)
+        found = position < keys.size
+        found[found] = keys[position[found]] == element_ids[found]
+        position = position[found]
+        columns = list(values) if columns is None else columns
+        return pd.DataFrame({column: np.asarray(values[column][position]) for column in columns})
+
+    def delete(self, delineation_name, discretization_name, parameterization_name):
+        """Remove all tables of one parameter set from the store. Sets layered on it keep their values."""
+
+        catalog = self.read_catalog()
+        key = self.set_key(delineation_name, discretization_name, parameterization_name)
+        if key not in catalog["sets"]:
+            return
+        for child in self.children(delineation_name, discretization_name, parameterization_name):
+            self.set_parent(delineation_name, discretization_name, child,
+                            self.parent(delineation_name, discretization_name, parameterization_name))
+        catalog = self.read_catalog()
+        entry = catalog["sets"].pop(key)
+        for table in entry["tables"].values():
+            path = os.path.join(self.store_directory, table["file"])
+            if os.path.exists(path):
+                os.remove(path)
+        self.write_catalog(catalog)
+
+
+def to_structured_array(df):
+    """Convert a DataFrame to a NumPy structured array, storing text columns as fixed-width unicode."""
+
+    columns = []
+    for column in df.columns:
+        if pd.api.types.is_numeric_dtype(df[column]) or pd.api.types.is_bool_dtype(df[column]):
+            columns.append(df[column].to_numpy())
+        else:
+            columns.append(np.array(df[column].fillna("").astype(str).tolist(), dtype=str))
+    dtype = [(column, values.dtype if values.dtype.kind != "U" or values.size else "U1")
+             for column, values in zip(df.columns, columns)]
+    array = np.empty(len(df), dtype=dtype)
+    for column, values in zip(df.columns, columns):
+        array[column] = values
+    return array
+
+
+def columns_equal(values, other_values):
+    """Return True if two columns hold the same values, treating NaN as equal to NaN."""
+    return bool(values_equal(values, other_values).all())
+
+
+def values_equal(values, other_values):
+    """Return whether each value of a column equals the value in the same row of another column, treating NaN as
+    equal to NaN. Numbers never equal text."""
+
+    values = np.asarray(values)
+    other_values = np.asarray(other_values)
+    if (values.dtype.kind in "iufcb") != (other_values.dtype.kind in "iufcb"):
+        return np.zeros(values.shape, dtype=bool)
+    equal = values == other_values
+    if values.dtype.kind in "fc" and other_values.dtype.kind in "fc":
+        equal |= np.isnan(values) & np.isnan(other_values)
+    return equal
+
+
+def changed_columns(df, other_df, key_field):
+    """Return the columns whose values differ between two versions of a parameter set, all of them if the element
+    ids differ."""
+
+    columns = set(df.columns) | set(other_df.columns)
+    if not np.array_equal(df[key_field].to_numpy(), other_df[key_field].to_numpy()):
+        return columns
+    return {column for column in columns
+            if column not in df.columns or column not in other_df.columns
+            or not columns_equal(df[column], other_df[column])}
+
+
+def set_expression(workspace, delineation_name, discretization_name, parameterization_name):
+    """Return the where clause selecting one parameter set in a geodatabase table."""
+    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
+    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
+    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
+    return (f"{delineation_name_field} = '{delineation_name}' And "
+            f"{discretization_name_field} = '{discretization_name}' And "
+            f"{parameterization_name_field} = '{parameterization_name}'")
+
+
+def read_table_set(workspace, table_name, delineation_name, discretization_name, parameterization_name):
+    """Read one parameter set from the geodatabase table, with NaN for null numbers and '' for null text."""
+
+    table = os.path.join(workspace, table_name)
+    null_values = {}
+    fields = []
+    for field in arcpy.ListFields(table):
+        if field.type in SKIPPED_FIELD_TYPES:
+            continue
+        fields.append(field.name)
+        if field.type in ["Double", "Single"]:
+            null_values[field.name] = np.nan
+        elif field.type in ["Integer", "SmallInteger", "BigInteger"]:
+            null_values[field.name] = -9999
+        elif field.type == "String":
+            null_values[field.name] = ""
+    expression = set_expression(workspace, delineation_name, discretization_name, parameterization_name)
+    return pd.DataFrame(arcpy.da.TableToNumPyArray(table, fields, expression, null_value=null_values))
+
+
+def publish_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name):
+    """Copy one parameter set from the geodatabase table into the parameter store."""
+
+    df = read_table_set(workspace, table_name, delineation_name, discretization_name, parameterization_name)
+    ParameterStore.for_workspace(workspace).write(table_name, delineation_name, discretization_name,
+                                                  parameterization_name, df)
+    return df
+
+
+def read_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name,
+                       null_value=None):
+    """Read one parameter set, from the parameter store if it holds the set, otherwise from the geodatabase table,
+    in which case the set is added to the store for the next read. NaN values are replaced by null_value if given."""
+
+    store = ParameterStore.for_workspace(workspace)
+    if store.exists(table_name, delineation_name, discretization_name, parameterization_name):
+        df = store.read(table_name, delineation_name, discretization_name, parameterization_name)
+    else:
+        df = publish_parameter_set(workspace, table_name, delineation_name, discretization_name,
+                                   parameterization_name)
+    if null_value is not None:
+        df = df.fillna(null_value)
+    return df
+
+
+def write_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name, df):
+    """Save one parameter set to the parameter store and mirror it to the geodatabase table.
+    Only the rows of this set are updated in the table, and rows it does not have yet (e.g. of a layered set) are
+    inserted."""
+
+    ParameterStore.for_workspace(workspace).write(table_name, delineation_name, discretization_name,
+                                                  parameterization_name, df)
+    mirror_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name, df)
+
+
+def mirror_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name, df):
+    """Write the columns of df to the rows of one parameter set in the geodatabase table, adding missing fields and
+    inserting rows the table does not have yet."""
+
+    table = os.path.join(workspace, table_name)
+    key_field = KEY_FIELDS[table_name]
+    existing_fields = {field.name for field in arcpy.ListFields(table)}
+    new_fields = []
+    for column in df.columns:
+        if column in existing_fields or column in SET_FIELDS + ["OBJECTID"]:
+            continue
+        if pd.api.types.is_float_dtype(df[column]):
+            new_fields.append([column, "DOUBLE"])
+        elif pd.api.types.is_integer_dtype(df[column]):
+            new_fields.append([column, "LONG"])
+        else:
+            new_fields.append([column, "TEXT"])
+    if new_fields:
+        arcpy.management.AddFields(table, new_fields)
+
+    columns = [c for c in df.columns if c not in SET_FIELDS + ["OBJECTID", key_field]]
+    rows = df.set_index(key_field)[columns]
+    rows = rows.astype(object).where(rows.notna(), None).to_dict("index")
+    expression = set_expression(workspace, delineation_name, discretization_name, parameterization_name)
+    with arcpy.da.UpdateCursor(table, [key_field] + columns, expression) as cursor:
+        for row in cursor:
+            values = rows.pop(row[0], None)
+            if values is None:
+                continue
+            row[1:] = [values[column] for column in columns]
+            cursor.updateRow(row)
+
+    with agwa_table_writer.TableWriter(table, SET_FIELDS + [key_field] + columns) as writer:
+        for element_id, values in rows.items():
+            writer.write([delineation_name, discretization_name, parameterization_name, element_id] +
+                         [values[column] for column in columns])
+
+
+def layer_parameter_set(workspace, delineation_name, discretization_name, parent_parameterization_name,
+                        parameterization_name):
+    """Create a parameter set that inherits all parameters of its parent. No rows are copied, neither in the parameter
+    store nor in the geodatabase tables: the set is read through its parent (see read_parameter_set) until its own
+    parameters are written."""
+
+    store = ParameterStore.for_workspace(workspace)
+    for table_name in KEY_FIELDS:
+        if not store.exists(table_name, delineation_name, discretization_name, parent_parameterization_name):
+            publish_parameter_set(workspace, table_name, delineation_name, discretization_name,
+                                  parent_parameterization_name)
+    store.create_layer(delineation_name, discretization_name, parent_parameterization_name, parameterization_name)
+
+
+def inherit_parameters(workspace, table_name, delineation_name, discretization_name, parameterization_name,
+                       parent_parameterization_name, columns):
+    """Layer a parameter set on a parent and take the given columns from the parent. Only the columns that still
+    differ from the parent are saved for the set. The set is mirrored to the geodatabase table."""
+
+    store = ParameterStore.for_workspace(workspace)
+    df_parent = read_parameter_set(workspace, table_name, delineation_name, discretization_name,
+                                   parent_parameterization_name)
+    df = read_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name)
+    if store.parent(delineation_name, discretization_name, parameterization_name) != parent_parameterization_name:
+        store.set_parent(delineation_name, discretization_name, parameterization_name, parent_parameterization_name)
+
+    key_field = KEY_FIELDS[table_name]
+    df_parent = df_parent.set_index(key_field)
+    df = df.set_index(key_field)
+    for column in columns:
+        df[column] = df_parent[column].reindex(df.index)
+    write_parameter_set(workspace, table_name, delineation_name, discretization_name, parameterization_name,
+                        df.reset_index())
@@ -0,0 +1,288 @@
+import os
+import sys
+import time
+import importlib
+import multiprocessing
+import concurrent.futures
+import agwa_tracing
+importlib.reload(agwa_tracing)
+
+# every worker imports arcpy when it starts, so a pool only pays off for a few steps running at once
+DEFAULT_MAX_WORKERS = 4
+
+
+class Step(object):
+    """One named step of a pipeline.
+
+    inputs and outputs are names of the data the step reads and writes, e.g. "parameters_hillslopes.Area" for a
+    field of a table or "channel_network" for a value returned by another step. The part of a name before the first
+    "." is the dataset the step locks: datasets of outputs are locked exclusively, datasets of inputs are shared, so
+    two steps never write the same geodatabase table at the same time. locks lists additional datasets the step
+    locks exclusively, e.g. a feature class whose schema it changes. If returns is set, the value returned by the
+    function is published under that name, and steps with that name in their inputs receive it as a keyword
+    argument. sources (paths the step reads) and options (method choices) make up the step's fingerprint when the
+    pipeline has a cache."""
+
+    def __init__(self, name, function, args=(), kwargs=None, inputs=(), outputs=(), locks=(), returns=None,
+                 sources=(), options=None):
+        self.name = name
+        self.function = function
+        self.args = tuple(args)
+        self.kwargs = dict(kwargs or {})
+        self.inputs = list(inputs)
+        self.outputs = list(outputs) + ([returns] if returns else [])
+        self.locks = list(locks)
+        self.returns = returns
+        self.sources = list(sources)
+        self.options = dict(options or {})
+        self.fingerprint = None
+        self.reused_from = None
+        self.dependencies = set()
+        self.start_time = None
+        self.end_time = None
+
+    @property
+    def duration(self):
+        if self.start_time is None or self.end_time is None:
+            return 0.0
+        return self.end_time - self.start_time
+
+    def exclusive_datasets(self):
+        return {dataset_of(name) for name in self.outputs if name != self.returns} | set(self.locks)
+
+    def shared_datasets(self):
+        return {dataset_of(name) for name in self.inputs}
+
+
+def dataset_of(name):
+    """Return the dataset part of an input or output name. Paths, e.g. of rasters, are datasets themselves."""
+    if "/" in name or "\\" in name:
+        return name
+    return name.split(".", 1)[0]
+
+
+class Pipeline(object):
+    """A DAG of steps run by a scheduler that starts every step whose dependencies are done and whose datasets are
+    not locked by a running step, in a pool of at most max_workers processes.
+
+    A step depends on the earlier steps that write one of its inputs, write one of its outputs, or read one of its
+    outputs, so declaring the steps in the order they used to run keeps the results of a sequential run.
+
+        pipeline = Pipeline("Parameterize elements")
+        pipeline.add("load_network", load_network, (workspace,), returns="channel_network")
+        pipeline.add("sequence", calculate_sequence, (workspace,), inputs=["channel_network"],
+                     outputs=["parameters_channels.Sequence"])
+        pipeline.run(max_workers=4)
+
+    cache is an optional object with fingerprint(step, dependency_fingerprints), reuse(step), and record(step)
+    methods. When given, a step whose outputs the cache can restore for its fingerprint is not run, and the
+    fingerprint of every step that runs is recorded.
+
+    environment is an optional dictionary of arcpy.env settings, e.g. {"workspace": workspace, "overwriteOutput":
+    True}. Spawned workers do not inherit the arcpy environment of this process, so the settings are applied in
+    every worker before it runs a step, and in this process when the steps run here.
+    """
+
+    def __init__(self, name, message_function=print, cache=None, environment=None):
+        self.name = name
+        self.steps = []
+        self.results = {}
+        self.message_function = message_function
+        self.cache = cache
+        self.environment = dict(environment or {})
+
+    def add(self, name, function, args=(), kwargs=None, inputs=(), outputs=(), locks=(), returns=None, sources=(),
+            options=None):
+        step = Step(name, function, args, kwargs, inputs, outputs, locks, returns, sources, options)
+        for previous in self.steps:
+            if (set(step.inputs) & set(previous.outputs) or set(step.outputs) & set(previous.outputs) or
+                    set(step.outputs) & set(previous.inputs)):
+                step.dependencies.add(previous.name)
+        self.steps.append(step)
+        return step
+
+    def run(self, max_workers=None):
+        """Run all steps and return the dictionary of published values. With max_workers of 1 the steps run one
+        after another in this process. Without max_workers a pool of at most DEFAULT_MAX_WORKERS processes is used,
+        and none if no more than two steps can run at once."""
+
+        if not max_workers:
+            max_workers = min(self.concurrency(), DEFAULT_MAX_WORKERS, os.cpu_count() or 1)
+            if max_workers <= 2:
+                max_workers = 1
+        start_time = time.perf_counter()
+        if self.cache is not None:
+            fingerprints = {}
+            for step in self.steps:
+                step.fingerprint = self.cache.fingerprint(step, [fingerprints[name]
+                                                                 for name in sorted(step.dependencies)])
+                fingerprints[step.name] = step.fingerprint
+        if max_workers == 1:
+            apply_environment(self.environment)
+            for step in self.steps:
+                if self.reuse(step):
+                    continue
+                self.message_function(f"{self.name}: {step.name}")
+                with agwa_tracing.span(step.name):
+                    step.start_time = time.perf_counter()
+                    self.store_result(step, step.function(*step.args, **self.step_kwargs(step)))
+                    step.end_time = time.perf_counter()
+        else:
+            with concurrent.futures.ProcessPoolExecutor(max_workers=max_workers, mp_context=process_context(),
+                                                        initializer=apply_environment,
+                                                        initargs=(self.environment,)) as executor:
+                self.run_in_pool(executor, max_workers)
+        self.message_function(self.report(time.perf_counter() - start_time))
+        return self.results
+
+    def run_in_pool(self, executor, max_workers):
+        pending = list(self.steps)
+        done = set()
+        running = {}
+        lanes = {}
+        while pending or running:
+            for step in list(pending):
+                if len(running) >= max_workers:
+                    break
+                if not step.dependencies <= done or self.is_locked(step, running.values()):
+                    continue
+                if self.reuse(step):
+                    pending.remove(step)
+                    done.add(step.name)
+                    continue
+                self.message_function(f"{self.name}: {step.name}")
+                step.start_time = time.perf_counter()
+                running[executor.submit(timed_call, step.function, step.args, self.step_kwargs(step))] = step
+                busy_lanes = {lanes[other.name] for other in running.values() if other is not step}
+                lanes[step.name] = min(set(range(1, max_workers + 1)) - busy_lanes)
+                pending.remove(step)
+
+            if not running and not pending:
+                break
+            if not running:
+                raise Exception(f"{self.name}: the steps {[step.name for step in pending]} cannot be scheduled.")
+
+            finished, _ = concurrent.futures.wait(running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in finished:
+                step = running.pop(future)
+                step.end_time = time.perf_counter()
+                try:
+                    result, duration = future.result()
+                except Exception as e:
+                    for other in running:
+                        other.cancel()
+                    raise Exception(f"{self.name}: step '{step.name}' failed. {e}") from e
+                # the step's duration is timed in the worker, without starting the worker and importing modules
+                step.start_time = step.end_time - duration
+                agwa_tracing.record_span(step.name, step.start_time, step.end_time, lanes[step.name])
+                self.store_result(step, result)
+                done.add(step.name)
+
+    def concurrency(self):
+        """Return an estimate of the largest number of steps that can run at once: of the steps at the same depth
+        of the DAG, those that do not lock each other's datasets."""
+
+        depths = {}
+        for step in self.steps:
+            depths[step.name] = 1 + max((depths[name] for name in step.dependencies), default=0)
+        largest = 0
+        for depth in set(depths.values()):
+            running = []
+            for step in self.steps:
+                if depths[step.name] == depth and not self.is_locked(step, running):
+                    running.append(step)
+            largest = max(largest, len(running))
+        return largest
+
+    @staticmethod
+    def is_locked(step, running_steps):
+        for other in running_steps:
+            other_exclusive = other.exclusive_datasets()
+            if step.exclusive_datasets() & (other_exclusive | other.shared_datasets()):
+                return True
+            if step.shared_datasets() & other_exclusive:
+                return True
+        return False
+
+    def step_kwargs(self, step):
+        kwargs = dict(step.kwargs)
+        for name in step.inputs:
+            if name in self.results:
+                kwargs[name] = self.results[name]
+        return kwargs
+
+    def reuse(self, step):
+        """Restore the outputs of a step from the cache instead of running it. Returns True if they were restored."""
+        if self.cache is None:
+            return False
+        step.start_time = time.perf_counter()
+        reused = self.cache.reuse(step)
+        step.end_time = time.perf_counter()
+        if reused:
+            agwa_tracing.record_span(f"{step.name} (reused)", step.start_time, step.end_time)
+            self.message_function(f"{self.name}: {step.name} (inputs unchanged, reusing {step.reused_from})")
+            self.cache.record(step)
+        return reused
+
+    def store_result(self, step, result):
+        if step.returns:
+            self.results[step.returns] = result
+        if self.cache is not None:
+            self.cache.record(step)
+
+    def critical_path(self):
+        """Return the chain of dependent steps with the longest total duration of the last run."""
+
+        steps = {step.name: step for step in self.steps}
+        finish = {}
+        previous = {}
+        for step in self.steps:
+            before = max(step.dependencies, key=lambda name: finish[name], default=None)
+            finish[step.name] = step.duration + (finish[before] if before else 0.0)
+            previous[step.name] = before
+        name = max(finish, key=finish.get, default=None)
+        path = []
+        while name is not None:
+            path.append(steps[name])
+            name = previous[name]
+        return path[::-1]
+
+    def report(self, wall_time):
+        """Return a summary of the step durations and the critical path of the last run."""
+
+        lines = [f"{self.name} finished in {wall_time:.1f} s"]
+        for step in self.steps:
+            reused = f" (reused from {step.reused_from})" if step.reused_from else ""
+            lines.append(f"  {step.name}: {step.duration:.1f} s{reused}")
+        path = self.critical_path()
+        lines.append(f"  Critical path ({sum(step.duration for step in path):.1f} s): " +
+                     " -> ".join(step.name for step in path))
+        return "\n".join(lines)
+
+
+def timed_call(function, args, kwargs):
+    """Call function and return its result and the seconds it took. Runs in the pool workers."""
+    start_time = time.perf_counter()
+    result = function(*args, **kwargs)
+    return result, time.perf_counter() - start_time
+
+
+def apply_environment(environment):
+    """Apply arcpy.env settings in the current process. Used as the initializer of the pool workers."""
+    if not environment:
+        return
+    import arcpy
+    for name, value in environment.items():
+        setattr(arcpy.env, name, value)
+
+
+def process_context():
+    """Return a spawn context whose workers run the Python interpreter of the current environment. Inside ArcGIS
+    Pro sys.executable is ArcGISPro.exe, so the worker executable is taken from sys.exec_prefix."""
+
+    context = multiprocessing.get_context("spawn")
+    if os.name == "nt":
+        executable = os.path.join(sys.exec_prefix, "pythonw.exe")
+        if os.path.basename(sys.executable).lower() not in ["python.exe", "pythonw.exe"] and os.path.exists(executable):
+            context.set_executable(executable)
+    return context
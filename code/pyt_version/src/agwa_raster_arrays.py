@@ -0,0 +1,92 @@
+import os
+import arcpy
+import numpy as np
+
+
+class RasterFrame(object):
+    """The cell grid of a template raster. Rasters sharing its cell size and alignment are read into arrays covering
+    the same cells, and arrays are written back as rasters with its spatial reference."""
+
+    def __init__(self, template_raster):
+        raster = arcpy.Raster(template_raster)
+        self.extent = raster.extent
+        self.cell_width = raster.meanCellWidth
+        self.cell_height = raster.meanCellHeight
+        self.nrows = raster.height
+        self.ncols = raster.width
+        self.spatial_reference = raster.spatialReference
+        self.lower_left_corner = arcpy.Point(self.extent.XMin, self.extent.YMin)
+
+    @property
+    def shape(self):
+        return self.nrows, self.ncols
+
+    def read(self, raster, nodata_to_value=0):
+        """Return the cells of raster in the frame as an array, with nodata_to_value for NoData and for cells
+        outside the raster."""
+        return arcpy.RasterToNumPyArray(raster, self.lower_left_corner, self.ncols, self.nrows, nodata_to_value)
+
+    def read_valid(self, raster):
+        """Return a boolean array of the cells of the frame where raster has data."""
+        nodata_value = arcpy.Raster(raster).noDataValue
+        if nodata_value is None:
+            return np.ones(self.shape, dtype=bool)
+        return self.read(raster, nodata_value) != nodata_value
+
+    def cells(self, x, y):
+        """Return the rows and columns of the cells containing the points x, y, and whether each is in the frame."""
+        rows = np.floor((self.extent.YMax - np.asarray(y)) / self.cell_height).astype(np.int64)
+        cols = np.floor((np.asarray(x) - self.extent.XMin) / self.cell_width).astype(np.int64)
+        inside = (rows >= 0) & (rows < self.nrows) & (cols >= 0) & (cols < self.ncols)
+        return rows, cols, inside
+
+    def write(self, array, output_path, value_to_nodata=None):
+        """Save array as a raster at output_path and return it."""
+        return self.write_block(array, 0, 0, output_path, value_to_nodata)
+
+    def corner(self, row, col, nrows):
+        """Return the lower left corner of the block of nrows rows starting at row, col of the frame."""
+        return arcpy.Point(self.extent.XMin + col * self.cell_width,
+                           self.extent.YMax - (row + nrows) * self.cell_height)
+
+    def read_block(self, raster, row, col, nrows, ncols, nodata_to_value=0):
+        """Return the nrows x ncols cells of raster starting at row, col of the frame as an array."""
+        return arcpy.RasterToNumPyArray(raster, self.corner(row, col, nrows), ncols, nrows, nodata_to_value)
+
+    def write_block(self, array, row, col, output_path, value_to_nodata=None):
+        """Save array as a raster covering the cells of the frame starting at row, col, and return it.
+        NumPyArrayToRaster does not carry the spatial reference, so it is defined on the saved raster."""
+        raster = arcpy.NumPyArrayToRaster(array, self.corner(row, col, array.shape[0]), self.cell_width,
+                                          self.cell_height, value_to_nodata)
+        raster.save(output_path)
+        arcpy.management.DefineProjection(output_path, self.spatial_reference)
+        return arcpy.Raster(output_path)
+
+    def read_tiled(self, raster, array, grid, nodata_to_value=np.nan):
+        """Read raster into array (usually memory-mapped) one tile of grid (see agwa_tiles.TileGrid) at a time, with
+        nodata_to_value for NoData."""
+        nodata_value = arcpy.Raster(raster).noDataValue
+        for tile in grid.tiles():
+            block = self.read_block(raster, *grid.bounds(tile), 0 if nodata_value is None else nodata_value)
+            block = block.astype(array.dtype)
+            if nodata_value is not None:
+                block[block == nodata_value] = nodata_to_value
+            array[grid.slices(tile)] = block
+
+    def write_tiled(self, array, output_path, grid, pixel_type, scratch_folder, value_to_nodata=None):
+        """Save array one tile of grid at a time as rasters in scratch_folder, and mosaic them into a raster at
+        output_path with pixel_type (for example "32_BIT_FLOAT"). Returns the raster."""
+        tile_paths = []
+        for tile in grid.tiles():
+            row, col, nrows, ncols = grid.bounds(tile)
+            block = np.ascontiguousarray(array[grid.slices(tile)])
+            tile_path = os.path.join(scratch_folder, f"tile_{tile[0]}_{tile[1]}.tif")
+            arcpy.NumPyArrayToRaster(block, self.corner(row, col, nrows), self.cell_width, self.cell_height,
+                                     value_to_nodata).save(tile_path)
+            tile_paths.append(tile_path)
+        output_folder, output_name = os.path.split(output_path)
+        arcpy.management.MosaicToNewRaster(tile_paths, output_folder, output_name, self.spatial_reference, pixel_type,
+                                           self.cell_width, 1)
+        for tile_path in tile_paths:
+            arcpy.management.Delete(tile_path)
+        return arcpy.Raster(output_path)
@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import hashlib
+import importlib
+import arcpy
+import agwa_fingerprints
+importlib.reload(agwa_fingerprints)
+
+
+class RasterCache(object):
+    """A shared folder of derived rasters keyed by the content of their inputs, the operation that created them, and
+    its parameters, so a DEM processed for one project is not processed again for another.
+
+    Each entry is a folder entries/<key> with the raster file, its sidecar files (.aux.xml, .tfw, ...), and a
+    manifest.json holding the size and SHA-256 of the raster file and when the entry was last used. Rasters are
+    handed out by hard link where the file system allows it and copied otherwise, and the raster file is checked
+    against its manifest before every use; a damaged entry is removed. Entries are added by renaming a finished
+    folder into place, so several processes can share the cache, and the least recently used entries are removed
+    when the cache grows over max_bytes."""
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.entries_directory = os.path.join(directory, "entries")
+        self.hashes_path = os.path.join(directory, "hashes.json")
+        os.makedirs(self.entries_directory, exist_ok=True)
+        self.hashes = self._read_hashes()
+
+    def _read_hashes(self):
+        try:
+            with open(self.hashes_path, "r") as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _write_hashes(self):
+        temp_path = f"{self.hashes_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.hashes, f)
+        os.replace(temp_path, self.hashes_path)
+
+    @staticmethod
+    def key(operation, parameters, input_keys):
+        """Return the key of the output of operation with parameters on inputs with the given keys."""
+        document = {"operation": operation, "parameters": parameters, "inputs": list(input_keys)}
+        return hashlib.sha256(json.dumps(document, sort_keys=True).encode("utf-8")).hexdigest()
+
+    def content_hash(self, raster):
+        """Return the SHA-256 of the content of a raster. A raster file is hashed byte for byte, with the hashes of
+        unchanged files remembered in the cache; other rasters (in a geodatabase, Esri grids) are hashed from their
+        cell values, extent, cell size, and spatial reference."""
+
+        path = arcpy.Describe(raster).catalogPath
+        if os.path.isfile(path):
+            count = len(self.hashes)
+            digest = agwa_fingerprints.file_signature(path, self.hashes)["sha256"]
+            if len(self.hashes) != count:
+                self._write_hashes()
+            return digest
+
+        return agwa_fingerprints.raster_content_hash(path)
+
+    def _entry(self, key):
+        return os.path.join(self.entries_directory, key)
+
+    @staticmethod
+    def _sidecars(raster_path):
+        folder, name = os.path.split(raster_path)
+        stem = os.path.splitext(name)[0]
+        return [os.path.join(folder, file_name) for file_name in os.listdir(folder)
+                if file_name != name and (file_name.startswith(f"{name}.") or file_name.startswith(f"{stem}."))]
+
+    @staticmethod
+    def _file_hash(path):
+        sha256 = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(agwa_fingerprints.HASH_BLOCK_SIZE), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
+
+    @staticmethod
+    def _link_or_copy(source, destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            shutil.copy2(source, destination)
+
+    def fetch(self, key, output_path):
+        """Place the cached raster of key at output_path, replacing the raster there, and return True, or return False
+        if the cache has no intact entry for key."""
+
+        entry = self._entry(key)
+        manifest_path = os.path.join(entry, "manifest.json")
+        try:
+            with open(manifest_path, "r") as f:
+                manifest = json.load(f)
+            cached_path = os.path.join(entry, manifest["raster"])
+            if os.path.getsize(cached_path) != manifest["size"] or self._file_hash(cached_path) != manifest["sha256"]:
+                shutil.rmtree(entry, ignore_errors=True)
+                return False
+
+            output_folder, output_name = os.path.split(output_path)
+            os.makedirs(output_folder, exist_ok=True)
+            if os.path.exists(output_path):
+                arcpy.management.Delete(output_path)
+            self._link_or_copy(cached_path, output_path)
+            # sidecars are copied, since tools rewrite them in place (statistics, pyramids)
+            output_stem = os.path.splitext(output_name)[0]
+            for file_name in manifest["sidecars"]:
+                sidecar_name = output_stem + file_name[len(os.path.splitext(manifest["raster"])[0]):]
+                shutil.copy2(os.path.join(entry, file_name), os.path.join(output_folder, sidecar_name))
+
+            manifest["last_used"] = time.time()
+            temp_path = f"{manifest_path}.{uuid.uuid4().hex}.tmp"
+            with open(temp_path, "w") as f:
+                json.dump(manifest, f)
+            os.replace(temp_path, manifest_path)
+            return True
+        except (OSError, ValueError, KeyError):
+            return False
+
+    def store(self, key, raster_path):
+        """Add the raster file at raster_path and its sidecars to the cache as the entry of key, then evict the least
+        recently used entries over the size limit."""
+
+        entry = self._entry(key)
+        if os.path.exists(entry):
+            return
+        temp_entry = os.path.join(self.entries_directory, f".{key}.{uuid.uuid4().hex}")
+        os.makedirs(temp_entry)
+        try:
+            raster_name = os.path.basename(raster_path)
+            self._link_or_copy(raster_path, os.path.join(temp_entry, raster_name))
+            sidecars = []
+            for sidecar_path in self._sidecars(raster_path):
+                shutil.copy2(sidecar_path, temp_entry)
+                sidecars.append(os.path.basename(sidecar_path))
+            manifest = {"raster": raster_name, "sidecars": sidecars, "size": os.path.getsize(raster_path),
+                        "sha256": self._file_hash(raster_path), "created": time.time(), "last_used": time.time()}
+            with open(os.path.join(temp_entry, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+            os.rename(temp_entry, entry)
+        except OSError:
+            # another process stored the same entry first
+            shutil.rmtree(temp_entry, ignore_errors=True)
+        self.evict()
+
+    def evict(self):
+        """Remove the least recently used entries until the cache is within max_bytes."""
+
+        entries = []
+        for key in os.listdir(self.entries_directory):
+            entry = self._entry(key)
+            try:
+                with open(os.path.join(entry, "manifest.json"), "r") as f:
+                    last_used = json.load(f)["last_used"]
+                size = sum(os.path.getsize(os.path.join(entry, file_name)) for file_name in os.listdir(entry))
+            except (OSError, ValueError, KeyError):
+                continue
+            entries.append((last_used, size, entry))
+        total = sum(size for _, size, _ in entries)
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
@@ -0,0 +1,104 @@
+import os
+import json
+import time
+import uuid
+import shutil
+import importlib
+import numpy as np
+import pandas as pd
+import agwa_fingerprints
+importlib.reload(agwa_fingerprints)
+
+
+CACHE_VERSION = 1
+
+
+class SoilParameterCache(object):
+    """Weighted K2 soil parameters of every map unit of a soils database (e.g. a statewide gSSURGO geodatabase),
+    compiled once so a parameterization only looks up the map units of its hillslopes instead of reading and
+    weighting the database tables again.
+
+    Each entry is a folder entries/<key>, where the key is the fingerprint of the soils database, the AGWA lookup
+    tables, max_thickness, and max_horizons. The folder holds a sub-folder per table with one .npy file per column,
+    rows sorted by MapUnitKey, and a manifest.json of the columns. Columns are opened memory-mapped, and the rows
+    of a map unit are found by binary search on the MapUnitKey column, so a lookup only reads the rows it needs.
+    Entries are added by renaming a finished folder into place."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.entries_directory = os.path.join(directory, "entries")
+
+    @staticmethod
+    def key(soils_database, lookup_tables, max_thickness, max_horizons):
+        """Return the key of the soil parameters of soils_database with the kin_lut table of the lookup_tables
+        geodatabase."""
+        return agwa_fingerprints.fingerprint([soils_database, lookup_tables],
+                                             {"version": CACHE_VERSION, "max_thickness": float(max_thickness),
+                                              "max_horizons": int(max_horizons)})
+
+    def _entry(self, key):
+        return os.path.join(self.entries_directory, key)
+
+    def exists(self, key):
+        return os.path.isfile(os.path.join(self._entry(key), "manifest.json"))
+
+    def store(self, key, tables, source):
+        """Add the tables, a dictionary of name -> DataFrame with a MapUnitKey column, as the entry of key. source
+        is recorded in the manifest to describe the entry."""
+
+        if self.exists(key):
+            return
+        os.makedirs(self.entries_directory, exist_ok=True)
+        temp_entry = os.path.join(self.entries_directory, f".{key}.{uuid.uuid4().hex}")
+        manifest = {"source": source, "created": time.time(), "tables": {}}
+        try:
+            for name, df in tables.items():
+                os.makedirs(os.path.join(temp_entry, name))
+                df = df.assign(MapUnitKey=df.MapUnitKey.astype(str)).sort_values("MapUnitKey", kind="stable")
+                columns = []
+                for i, column in enumerate(df.columns):
+                    values = df[column].to_numpy()
+                    if values.dtype.kind not in "biuf":
+                        # text columns are stored as fixed width strings, which can be memory-mapped
+                        values = values.astype(str)
+                    np.save(os.path.join(temp_entry, name, f"{i}.npy"), values)
+                    columns.append(column)
+                manifest["tables"][name] = {"columns": columns, "rows": len(df)}
+            with open(os.path.join(temp_entry, "manifest.json"), "w") as f:
+                json.dump(manifest, f)
+        except BaseException:
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            raise
+
+        try:
+            os.rename(temp_entry, self._entry(key))
+        except OSError:
+            shutil.rmtree(temp_entry, ignore_errors=True)
+            # the entry is only complete once renamed, so an existing entry was stored by another process first
+            if not os.path.isdir(self._entry(key)):
+                raise
+
+    def fetch(self, key, mukeys):
+        """Return a dictionary of name -> DataFrame of the rows of the map units mukeys in each table of the entry
+        of key, or None if the cache has no entry for key."""
+
+        entry = self._entry(key)
+        try:
+            with open(os.path.join(entry, "manifest.json"), "r") as f:
+                manifest = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        mukeys = np.unique(np.asarray(mukeys).astype(str))
+        tables = {}
+        for name, table in manifest["tables"].items():
+            columns = {column: np.load(os.path.join(entry, name, f"{i}.npy"), mmap_mode="r")
+                       for i, column in enumerate(table["columns"])}
+            map_unit_keys = columns["MapUnitKey"]
+            starts = np.searchsorted(map_unit_keys, mukeys, side="left")
+            ends = np.searchsorted(map_unit_keys, mukeys, side="right")
+            rows = np.concatenate([np.arange(start, end) for start, end in zip(starts, ends)] +
+                                  [np.zeros(0, dtype=np.int64)])
+            tables[name] = pd.DataFrame({column: np.asarray(values[rows]) for column, values in columns.items()},
+                                        columns=table["columns"])
+        return tables
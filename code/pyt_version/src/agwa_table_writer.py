@@ -0,0 +1,62 @@
+import arcpy
+
+
+class TableWriter(object):
+    """Buffered writer that appends rows to a table or feature class through a single insert cursor.
+
+    Rows are collected in memory and inserted in chunks of chunk_size, so the table's schema lock is acquired once
+    and the cursor is not reopened for every row. Use as a context manager; remaining rows are flushed and the
+    cursor is released on exit.
+
+        with TableWriter(table, ["HillslopeID", "Area"]) as writer:
+            for hillslope_id, area in rows:
+                writer.write((hillslope_id, area))
+    """
+
+    def __init__(self, table, fields, chunk_size=10000):
+        self.table = table
+        self.fields = list(fields)
+        self.chunk_size = chunk_size
+        self.rows_written = 0
+        self._buffer = []
+        self._cursor = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        try:
+            if exc_type is None:
+                self.flush()
+        finally:
+            self.close()
+        return False
+
+    def write(self, row):
+        """Buffer one row, flushing when the buffer reaches chunk_size."""
+        self._buffer.append(row)
+        if len(self._buffer) >= self.chunk_size:
+            self.flush()
+
+    def write_rows(self, rows):
+        """Buffer an iterable of rows."""
+        for row in rows:
+            self.write(row)
+
+    def flush(self):
+        """Insert all buffered rows."""
+        if not self._buffer:
+            return
+        if self._cursor is None:
+            self._cursor = arcpy.da.InsertCursor(self.table, self.fields)
+        for row in self._buffer:
+            self._cursor.insertRow(row)
+        self.rows_written += len(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        """Release the insert cursor. Buffered rows that were not flushed are discarded."""
+        self._buffer = []
+        if self._cursor is not None:
+            del self._cursor
+            self._cursor = None
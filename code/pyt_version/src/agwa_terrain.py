@@ -0,0 +1,37 @@
+import numpy as np
+
+
+def surface_gradients(window, cell_width, cell_height):
+    """Return the rate of change of elevation eastward and northward of the cells inside window, a DEM with a one
+    cell ring around them, by Horn's 3 x 3 method. NaN neighbours (NoData or outside the grid) take the elevation
+    of the center cell, as the Slope and Aspect tools do at edges."""
+
+    window = np.asarray(window, dtype=np.float64)
+    nrows, ncols = window.shape[0] - 2, window.shape[1] - 2
+    center = window[1:-1, 1:-1]
+
+    def neighbour(dr, dc):
+        values = window[1 + dr:1 + dr + nrows, 1 + dc:1 + dc + ncols]
+        return np.where(np.isnan(values), center, values)
+
+    a, b, c = neighbour(-1, -1), neighbour(-1, 0), neighbour(-1, 1)
+    d, f = neighbour(0, -1), neighbour(0, 1)
+    g, h, i = neighbour(1, -1), neighbour(1, 0), neighbour(1, 1)
+    dz_dx = ((c + 2 * f + i) - (a + 2 * d + g)) / (8 * cell_width)
+    dz_dy = ((a + 2 * b + c) - (g + 2 * h + i)) / (8 * cell_height)
+    return dz_dx, dz_dy
+
+
+def slope_percent(window, cell_width, cell_height):
+    """Return the slope in percent rise of the cells inside window, like the Slope tool with PERCENT_RISE."""
+    dz_dx, dz_dy = surface_gradients(window, cell_width, cell_height)
+    return np.hypot(dz_dx, dz_dy) * 100
+
+
+def aspect(window, cell_width, cell_height):
+    """Return the downslope direction in compass degrees of the cells inside window, -1 on flat cells, like the
+    Aspect tool."""
+    dz_dx, dz_dy = surface_gradients(window, cell_width, cell_height)
+    # the downslope direction points against the gradient
+    degrees = np.degrees(np.arctan2(-dz_dx, -dz_dy)) % 360
+    return np.where((dz_dx == 0) & (dz_dy == 0), -1.0, degrees)
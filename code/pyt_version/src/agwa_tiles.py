@@ -0,0 +1,229 @@
+import os
+import numpy as np
+import agwa_d8
+import agwa_terrain
+
+
+# Approximate bytes of working memory per cell of a tile for the heaviest kernel (filling)
+BYTES_PER_CELL = 160
+# Approximate bytes flow_accumulation keeps for the whole grid per cell on the perimeter of a tile
+BYTES_PER_BOUNDARY_CELL = 200
+
+
+class TileGrid(object):
+    """Square tiles covering a grid of shape (nrows, ncols), processed one at a time with a ring of halo cells
+    read from the neighbouring tiles, so full-grid arrays (usually memory-mapped) are only touched a tile at a
+    time."""
+
+    def __init__(self, shape, tile_size):
+        self.shape = tuple(shape)
+        self.tile_size = int(tile_size)
+        self.tile_rows = -(-self.shape[0] // self.tile_size)
+        self.tile_cols = -(-self.shape[1] // self.tile_size)
+
+    @classmethod
+    def for_budget(cls, shape, memory_budget, bytes_per_cell=BYTES_PER_CELL,
+                   bytes_per_boundary_cell=BYTES_PER_BOUNDARY_CELL):
+        """Return the grid of the largest tiles whose working memory, together with the arrays flow_accumulation
+        keeps for the cells on the perimeters of all tiles, fits in memory_budget bytes. Smaller tiles have more
+        perimeter cells, so if no tile size fits, the tile size that needs the least memory is used."""
+
+        cells = shape[0] * shape[1]
+        largest = max(16, int(np.sqrt(memory_budget / bytes_per_cell)) - 2)
+        # the memory of a tile size t is about (t + 2)² bytes_per_cell + 4 cells / t bytes_per_boundary_cell
+        least = max(16, min(largest, int((2 * cells * bytes_per_boundary_cell / bytes_per_cell) ** (1 / 3))))
+        tile_sizes = np.arange(least, largest + 1)
+        memory = (tile_sizes + 2) ** 2 * bytes_per_cell + 4 * cells / tile_sizes * bytes_per_boundary_cell
+        fitting = tile_sizes[memory <= memory_budget]
+        return cls(shape, fitting[-1] if fitting.size else least)
+
+    def memory(self, bytes_per_cell=BYTES_PER_CELL, bytes_per_boundary_cell=BYTES_PER_BOUNDARY_CELL):
+        """Return the approximate working memory in bytes of processing the grid, see for_budget."""
+        perimeter_cells = sum(2 * (nrows + ncols) for _, _, nrows, ncols in map(self.bounds, self.tiles()))
+        return (self.tile_size + 2) ** 2 * bytes_per_cell + perimeter_cells * bytes_per_boundary_cell
+
+    def __len__(self):
+        return self.tile_rows * self.tile_cols
+
+    def tiles(self):
+        """Yield the tiles as (tile_row, tile_col) in row-major order."""
+        for tile_row in range(self.tile_rows):
+            for tile_col in range(self.tile_cols):
+                yield tile_row, tile_col
+
+    def bounds(self, tile):
+        """Return the first row, first column, number of rows, and number of columns of a tile."""
+        row = tile[0] * self.tile_size
+        col = tile[1] * self.tile_size
+        return row, col, min(self.tile_size, self.shape[0] - row), min(self.tile_size, self.shape[1] - col)
+
+    def slices(self, tile):
+        row, col, nrows, ncols = self.bounds(tile)
+        return slice(row, row + nrows), slice(col, col + ncols)
+
+    def window(self, array, tile, fill_value):
+        """Return a copy of the cells of a tile with a one cell ring around it, fill_value outside the grid."""
+        row, col, nrows, ncols = self.bounds(tile)
+        window = np.full((nrows + 2, ncols + 2), fill_value, dtype=np.result_type(array.dtype, type(fill_value)))
+        row0, col0 = max(row - 1, 0), max(col - 1, 0)
+        row1, col1 = min(row + nrows + 1, self.shape[0]), min(col + ncols + 1, self.shape[1])
+        window[row0 - row + 1:row1 - row + 1, col0 - col + 1:col1 - col + 1] = array[row0:row1, col0:col1]
+        return window
+
+    def neighbours(self, tile):
+        """Return the tiles around a tile, diagonal ones included."""
+        return [(tile[0] + dr, tile[1] + dc) for dr in (-1, 0, 1) for dc in (-1, 0, 1)
+                if (dr or dc) and 0 <= tile[0] + dr < self.tile_rows and 0 <= tile[1] + dc < self.tile_cols]
+
+    def global_index(self, tile, window_index):
+        """Return the flat grid index of flat indices into the window of a tile, -1 outside the grid."""
+        row, col, nrows, ncols = self.bounds(tile)
+        window_rows, window_cols = np.divmod(np.asarray(window_index), ncols + 2)
+        rows, cols = window_rows + row - 1, window_cols + col - 1
+        inside = (rows >= 0) & (rows < self.shape[0]) & (cols >= 0) & (cols < self.shape[1])
+        return np.where(inside, rows * self.shape[1] + cols, -1)
+
+
+def create_array(directory, name, shape, dtype, fill_value):
+    """Return a memory-mapped .npy array in directory, filled with fill_value a block of rows at a time."""
+    array = np.lib.format.open_memmap(os.path.join(directory, f"{name}.npy"), mode="w+", dtype=dtype,
+                                      shape=tuple(shape))
+    rows_per_block = max(1, 2 ** 24 // max(1, shape[1]))
+    for row in range(0, shape[0], rows_per_block):
+        array[row:row + rows_per_block] = fill_value
+    return array
+
+
+def _perimeter(array):
+    return np.concatenate([array[0], array[-1], array[:, 0], array[:, -1]])
+
+
+def _sweep_until_stable(grid, process):
+    """Process the tiles in alternating forward and backward sweeps until no tile is dirty. process(tile) returns
+    True if the perimeter of the tile changed, which makes its neighbours dirty. Returns the number of tile runs."""
+    order = list(grid.tiles())
+    dirty = set(order)
+    runs = 0
+    while dirty:
+        for tile in order:
+            if tile not in dirty:
+                continue
+            dirty.discard(tile)
+            runs += 1
+            if process(tile):
+                dirty.update(grid.neighbours(tile))
+        order.reverse()
+    return runs
+
+
+def fill(dem, filled, grid):
+    """Fill the depressions of dem (NaN for NoData) into filled, tile by tile. A tile is filled with the filled
+    elevations of its neighbours around it, so a depression spanning tiles is resolved by refilling the tiles
+    next to a tile whose edge went down, until no edge changes. filled must start as inf."""
+
+    def process(tile):
+        rows, cols = grid.slices(tile)
+        edge = grid.window(filled, tile, -np.inf)
+        edge[np.isnan(edge)] = -np.inf
+        tile_filled = agwa_d8.fill_depressions(dem[rows, cols], edge)
+        changed = not np.array_equal(_perimeter(tile_filled), _perimeter(filled[rows, cols]), equal_nan=True)
+        filled[rows, cols] = tile_filled
+        return changed
+
+    return _sweep_until_stable(grid, process)
+
+
+def flow_direction(filled, directions, flat_distance, grid, cell_width, cell_height):
+    """Compute the D8 flow directions of a filled DEM into directions, tile by tile. Flats spanning tiles are
+    resolved like depressions in fill, through the flat distances of the tile edges; flat_distance must start as
+    -1 and holds the flat distances on return."""
+
+    def process(tile):
+        rows, cols = grid.slices(tile)
+        tile_directions, tile_distance = agwa_d8.flow_directions(grid.window(filled, tile, np.nan), cell_width,
+                                                                 cell_height, grid.window(flat_distance, tile, -1))
+        changed = not np.array_equal(_perimeter(tile_distance), _perimeter(flat_distance[rows, cols]))
+        directions[rows, cols] = tile_directions
+        flat_distance[rows, cols] = tile_distance
+        return changed
+
+    return _sweep_until_stable(grid, process)
+
+
+def _tile_flow(directions, grid, tile):
+    """Return the downstream cells of a tile in window indices, with flow into the ring kept, and its interior."""
+    window = grid.window(directions, tile, 0)
+    downstream = agwa_d8.downstream_cells(window)
+    interior = np.zeros(window.shape, dtype=bool)
+    interior[1:-1, 1:-1] = True
+    interior = interior.ravel()
+    inside = np.where(interior[np.maximum(downstream, 0)] & (downstream >= 0), downstream, -1)
+    inside[~interior] = -1
+    return window, downstream, inside, interior
+
+
+def flow_accumulation(directions, accumulation, grid, nodata_value=-1):
+    """Compute the flow accumulation (number of upstream cells) of D8 flow directions into accumulation, tile by
+    tile. Each tile is accumulated twice. The first pass finds, for every cell where flow leaves a tile, the cells
+    of the tile draining through it and the cell it drains to in the next tile; the flow between tiles is then
+    accumulated over those exit cells only, and the second pass accumulates each tile again with the flow entering
+    it from its neighbours.
+
+    The exit cells and the cells on the perimeters of all tiles are kept in memory for the whole grid, about
+    BYTES_PER_BOUNDARY_CELL bytes per perimeter cell, which TileGrid.for_budget accounts for."""
+
+    exits, exit_weights, exit_targets = [], [], []
+    entries, entry_roots = [], []
+    for tile in grid.tiles():
+        window, downstream, inside, interior = _tile_flow(directions, grid, tile)
+        local = agwa_d8.accumulate(inside, interior)
+        roots = agwa_d8.follow_to_root(np.where(inside >= 0, inside, np.arange(inside.size)))
+        leaving = interior & (downstream >= 0) & (inside < 0)
+        exits.append(grid.global_index(tile, np.flatnonzero(leaving)))
+        exit_weights.append(local[leaving])
+        exit_targets.append(grid.global_index(tile, downstream[leaving]))
+        ring_cells = np.zeros(window.shape, dtype=bool)
+        ring_cells[1:-1, 1:-1] = True
+        ring_cells[2:-2, 2:-2] = False
+        perimeter = np.flatnonzero(ring_cells.ravel())
+        entries.append(grid.global_index(tile, perimeter))
+        entry_roots.append(np.where(leaving[roots[perimeter]], grid.global_index(tile, roots[perimeter]), -1))
+
+    exits, exit_weights = np.concatenate(exits), np.concatenate(exit_weights)
+    exit_targets = np.concatenate(exit_targets)
+    entries, entry_roots = np.concatenate(entries), np.concatenate(entry_roots)
+    entry_order = np.argsort(entries)
+    entries, entry_roots = entries[entry_order], entry_roots[entry_order]
+    exit_order = np.argsort(exits)
+    exits, exit_weights, exit_targets = exits[exit_order], exit_weights[exit_order], exit_targets[exit_order]
+
+    # the exit cell of the next tile each exit cell drains through, and the flow through every exit cell
+    next_exits = entry_roots[np.searchsorted(entries, exit_targets)]
+    next_positions = np.where(next_exits >= 0, np.searchsorted(exits, np.maximum(next_exits, 0)), -1)
+    through = agwa_d8.accumulate(next_positions, exit_weights)
+    inflow_cells, inflow_index = np.unique(exit_targets, return_inverse=True)
+    inflows = np.bincount(inflow_index, weights=through, minlength=inflow_cells.size)
+
+    for tile in grid.tiles():
+        rows, cols = grid.slices(tile)
+        window, downstream, inside, interior = _tile_flow(directions, grid, tile)
+        weights = interior.astype(np.float64)
+        interior_cells = np.flatnonzero(interior)
+        cells = grid.global_index(tile, interior_cells)
+        positions = np.searchsorted(inflow_cells, cells)
+        entering = positions < inflow_cells.size
+        entering[entering] = inflow_cells[positions[entering]] == cells[entering]
+        weights[interior_cells[entering]] += inflows[positions[entering]]
+        total = agwa_d8.accumulate(inside, weights).reshape(window.shape)[1:-1, 1:-1] - 1
+        total[window[1:-1, 1:-1] == 0] = nodata_value
+        accumulation[rows, cols] = total
+
+
+def slope_and_aspect(dem, slope, aspect, grid, cell_width, cell_height):
+    """Compute the slope in percent rise and the aspect of dem (NaN for NoData) into slope and aspect, tile by
+    tile."""
+    for tile in grid.tiles():
+        rows, cols = grid.slices(tile)
+        window = grid.window(dem, tile, np.nan)
+        slope[rows, cols] = agwa_terrain.slope_percent(window, cell_width, cell_height)
+        aspect[rows, cols] = agwa_terrain.aspect(window, cell_width, cell_height)
@@ -0,0 +1,316 @@
+import os
+import sys
+import json
+import time
+import inspect
+import threading
+import functools
+from datetime import datetime
+
+
+_state = threading.local()
+
+
+def peak_rss():
+    """Return the peak resident set size of this process in bytes, or None if it cannot be read."""
+
+    if os.name == "nt":
+        import ctypes
+        from ctypes import wintypes
+
+        class ProcessMemoryCounters(ctypes.Structure):
+            _fields_ = [("cb", wintypes.DWORD),
+                        ("PageFaultCount", wintypes.DWORD),
+                        ("PeakWorkingSetSize", ctypes.c_size_t),
+                        ("WorkingSetSize", ctypes.c_size_t),
+                        ("QuotaPeakPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaPeakNonPagedPoolUsage", ctypes.c_size_t),
+                        ("QuotaNonPagedPoolUsage", ctypes.c_size_t),
+                        ("PagefileUsage", ctypes.c_size_t),
+                        ("PeakPagefileUsage", ctypes.c_size_t)]
+
+        counters = ProcessMemoryCounters()
+        counters.cb = ctypes.sizeof(counters)
+        get_process_memory_info = ctypes.windll.psapi.GetProcessMemoryInfo
+        get_process_memory_info.argtypes = [wintypes.HANDLE, ctypes.POINTER(ProcessMemoryCounters), wintypes.DWORD]
+        if get_process_memory_info(ctypes.windll.kernel32.GetCurrentProcess(), ctypes.byref(counters), counters.cb):
+            return counters.PeakWorkingSetSize
+        return None
+
+    try:
+        import resource
+    except ImportError:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and in bytes on macOS
+    return peak if sys.platform == "darwin" else peak * 1024
+
+
+class Span(object):
+    """A timed section of a run. Records wall time, CPU time of this process, the peak resident set size at the
+    end of the span and how much the span raised it, and the number of rows it processed."""
+
+    def __init__(self, name, parent=None, lane=0):
+        self.name = name
+        self.parent = parent
+        self.lane = lane
+        self.depth = 0 if parent is None else parent.depth + 1
+        self.children = []
+        self.rows = None
+        self.start_time = None
+        self.end_time = None
+        self.cpu_time = None
+        self.peak_rss = None
+        self.peak_rss_increase = None
+        self._start_cpu = None
+        self._start_peak_rss = None
+        self._stage = None
+
+    def start(self):
+        self.start_time = time.perf_counter()
+        self._start_cpu = time.process_time()
+        self._start_peak_rss = peak_rss()
+        return self
+
+    def stop(self):
+        self.end_stage()
+        self.end_time = time.perf_counter()
+        self.cpu_time = time.process_time() - self._start_cpu
+        self.peak_rss = peak_rss()
+        if self.peak_rss is not None and self._start_peak_rss is not None:
+            self.peak_rss_increase = self.peak_rss - self._start_peak_rss
+        return self
+
+    def end_stage(self):
+        if self._stage is not None:
+            self._stage.stop()
+            self._stage = None
+
+    def add_rows(self, rows):
+        self.rows = (self.rows or 0) + rows
+
+    @property
+    def wall_time(self):
+        if self.start_time is None or self.end_time is None:
+            return None
+        return self.end_time - self.start_time
+
+    def to_dict(self, origin):
+        return {"name": self.name,
+                "depth": self.depth,
+                "parent": self.parent.name if self.parent is not None else None,
+                "start": self.start_time - origin,
+                "wall_time": self.wall_time,
+                "cpu_time": self.cpu_time,
+                "peak_rss": self.peak_rss,
+                "peak_rss_increase": self.peak_rss_increase,
+                "rows": self.rows}
+
+
+class Run(object):
+    """The spans of one run of a tool, written to a JSON file and a Chrome trace file (chrome://tracing or
+    https://ui.perfetto.dev) in output_directory when the run ends."""
+
+    def __init__(self, name, output_directory=None, message_function=print):
+        self.name = name
+        self.output_directory = output_directory
+        self.message_function = message_function
+        self.root = Span(name)
+        self.spans = [self.root]
+        self.started = datetime.now()
+
+    def summary(self):
+        """Return an indented table of the spans of the run."""
+
+        lines = [f"Timing summary of {self.name}"]
+        for span in self.spans:
+            if span.wall_time is None:
+                continue
+            line = f"{'  ' * span.depth}{span.name}: {span.wall_time:.2f} s wall"
+            if span.cpu_time is not None:
+                line += f", {span.cpu_time:.2f} s CPU"
+            if span.peak_rss is not None:
+                line += f", peak RSS {span.peak_rss / 1024 ** 2:.0f} MB"
+                if span.peak_rss_increase:
+                    line += f" (+{span.peak_rss_increase / 1024 ** 2:.0f} MB)"
+            if span.rows is not None:
+                line += f", {span.rows} rows"
+            lines.append(line)
+        return "\n".join(lines)
+
+    def chrome_trace(self):
+        origin = self.root.start_time
+        events = []
+        for span in self.spans:
+            if span.wall_time is None:
+                continue
+            events.append({"name": span.name,
+                           "ph": "X",
+                           "ts": (span.start_time - origin) * 1e6,
+                           "dur": span.wall_time * 1e6,
+                           "pid": os.getpid(),
+                           "tid": span.lane,
+                           "args": {"cpu_time": span.cpu_time,
+                                    "peak_rss": span.peak_rss,
+                                    "peak_rss_increase": span.peak_rss_increase,
+                                    "rows": span.rows}})
+        return {"traceEvents": events, "displayTimeUnit": "ms"}
+
+    def write(self):
+        """Write the JSON and Chrome trace files of the run and return the path of the JSON file."""
+
+        if self.output_directory is None:
+            return None
+        os.makedirs(self.output_directory, exist_ok=True)
+        file_name = f"{self.name.replace(' ', '_')}_{self.started.strftime('%Y%m%d_%H%M%S_%f')}"
+        origin = self.root.start_time
+        json_path = os.path.join(self.output_directory, f"{file_name}.json")
+        with open(json_path, "w") as f:
+            json.dump({"run": self.name,
+                       "started": self.started.isoformat(),
+                       "python": sys.version,
+                       "spans": [span.to_dict(origin) for span in self.spans if span.wall_time is not None]},
+                      f, indent=2)
+        with open(os.path.join(self.output_directory, f"{file_name}.trace.json"), "w") as f:
+            json.dump(self.chrome_trace(), f)
+        return json_path
+
+
+def current_run():
+    return getattr(_state, "run", None)
+
+
+def current_span():
+    stack = getattr(_state, "stack", None)
+    if not stack:
+        return None
+    span = stack[-1]
+    return span._stage or span
+
+
+class span(object):
+    """Context manager timing a section of the current run. Spans nest; outside a run they only time the section.
+
+        with agwa_tracing.span("Reading soil tables") as s:
+            ...
+            s.add_rows(len(df))
+    """
+
+    def __init__(self, name, rows=None):
+        self.name = name
+        self.rows = rows
+        self.span = None
+
+    def __enter__(self):
+        parent = current_span()
+        self.span = Span(self.name, parent, parent.lane if parent is not None else 0)
+        if self.rows is not None:
+            self.span.add_rows(self.rows)
+        run = current_run()
+        if run is not None:
+            run.spans.append(self.span)
+            if parent is not None:
+                parent.children.append(self.span)
+        _state.stack = getattr(_state, "stack", []) + [self.span]
+        return self.span.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.span.stop()
+        _state.stack = _state.stack[:-1]
+        return False
+
+
+def stage(name, message_function=None):
+    """End the current stage of the innermost span and start a new one named name. This marks the sequential,
+    message-delimited stages of a tool without nesting each one in a with block. The name is also sent to
+    message_function, or to the message function of the current run."""
+
+    run = current_run()
+    if message_function is None:
+        message_function = run.message_function if run is not None else print
+    message_function(name)
+
+    stack = getattr(_state, "stack", None)
+    if not stack:
+        return None
+    parent = stack[-1]
+    parent.end_stage()
+    stage_span = Span(name.strip(), parent, parent.lane)
+    parent.children.append(stage_span)
+    if run is not None:
+        run.spans.append(stage_span)
+    parent._stage = stage_span.start()
+    return stage_span
+
+
+def add_rows(rows):
+    """Add to the number of rows processed by the current stage or span."""
+    active = current_span()
+    if active is not None:
+        active.add_rows(rows)
+
+
+def record_span(name, start_time, end_time, lane=0, rows=None):
+    """Add a span that was timed elsewhere, e.g. a step run in a worker process, under the current span.
+    start_time and end_time are time.perf_counter() values of this process."""
+
+    run = current_run()
+    if run is None:
+        return None
+    parent = current_span()
+    recorded = Span(name, parent, lane)
+    recorded.start_time = start_time
+    recorded.end_time = end_time
+    recorded.rows = rows
+    if parent is not None:
+        parent.children.append(recorded)
+    run.spans.append(recorded)
+    return recorded
+
+
+def trace_directory(path):
+    """Return the folder trace files are written to for a workspace geodatabase or an output folder."""
+    if path.lower().endswith(".gdb"):
+        path = os.path.dirname(path)
+    return os.path.join(path, "agwa_traces")
+
+
+def traced(name, directory_argument=None, message_function=print):
+    """Decorator running a tool's main function as a traced run. The trace files are written next to the path
+    passed as the directory_argument argument (see trace_directory). A run inside another run is a nested span."""
+
+    def decorator(function):
+        signature = inspect.signature(function)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if current_run() is not None:
+                with span(name):
+                    return function(*args, **kwargs)
+
+            output_directory = None
+            if directory_argument is not None:
+                path = signature.bind(*args, **kwargs).arguments.get(directory_argument)
+                if path:
+                    output_directory = trace_directory(path)
+            run = Run(name, output_directory, message_function)
+            _state.run = run
+            _state.stack = [run.root.start()]
+            try:
+                return function(*args, **kwargs)
+            finally:
+                run.root.stop()
+                _state.run = None
+                _state.stack = []
+                message_function(run.summary())
+                try:
+                    path = run.write()
+                    if path is not None:
+                        message_function(f"Timing trace written to {path}")
+                except OSError as e:
+                    message_function(f"Could not write the timing trace: {e}")
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+
+
+TEXTURE_FRACTIONS = ["Sand", "Silt", "Clay"]
+
+
+def weighted_means(df, keys, parameters, weight_column, normalize_texture=False):
+    """Return the weighted mean of each parameter column over the rows of each group of df with the same keys, one
+    row per group in order of first appearance, with the key columns first. The weighted mean is the sum of
+    parameter x weight over the rows with a parameter value divided by the sum of the weights of all rows of the
+    group, as (group[param] * group[weight]).sum() / group[weight].sum() computes it. With normalize_texture, the
+    Sand, Silt, and Clay means of each group are rescaled to sum to 1 when their sum is not 0.
+
+    The groups are found by sorting the rows once, and all the parameters are summed in one np.add.reduceat pass
+    over the sorted rows."""
+
+    keys = [keys] if isinstance(keys, str) else list(keys)
+    group_index = df.groupby(keys, sort=False, dropna=False).ngroup().values
+    order = np.argsort(group_index, kind="stable")
+    starts = np.flatnonzero(np.diff(group_index[order], prepend=-1))
+
+    # rows without a weight are left out of both sums, as pandas sums skip NaN
+    weights = np.nan_to_num(df[weight_column].values.astype(np.float64)[order], nan=0.0)
+    values = df[parameters].values.astype(np.float64)[order] * weights[:, None]
+    df_weighted = df[keys].iloc[order[starts]].reset_index(drop=True)
+    if starts.size == 0:
+        return df_weighted.assign(**{parameter: np.zeros(0) for parameter in parameters})
+    with np.errstate(invalid="ignore", divide="ignore"):
+        means = np.add.reduceat(np.nan_to_num(values, nan=0.0), starts) / np.add.reduceat(weights, starts)[:, None]
+    df_weighted = pd.concat([df_weighted, pd.DataFrame(means, columns=parameters)], axis=1)
+
+    if normalize_texture:
+        total_particle = df_weighted[TEXTURE_FRACTIONS].sum(axis=1, skipna=False)
+        normalize = (total_particle != 0) & total_particle.notna()
+        df_weighted.loc[normalize, TEXTURE_FRACTIONS] = df_weighted.loc[normalize, TEXTURE_FRACTIONS].div(
+            total_particle[normalize], axis=0)
+    return df_weighted
@@ -0,0 +1,196 @@
+import arcpy
+import numpy as np
+
+
+def iterate_blocks(template_raster, block_size=2048):
+    """Yield (lower_left_corner, ncols, nrows, row_offset, col_offset) for square blocks covering a raster.
+    The lower left corners are snapped to the cells of the template raster, so any raster sharing the template's
+    cell size and alignment can be read block by block with arcpy.RasterToNumPyArray."""
+
+    raster = arcpy.Raster(template_raster)
+    extent = raster.extent
+    cell_width = raster.meanCellWidth
+    cell_height = raster.meanCellHeight
+    for row_offset in range(0, raster.height, block_size):
+        nrows = min(block_size, raster.height - row_offset)
+        for col_offset in range(0, raster.width, block_size):
+            ncols = min(block_size, raster.width - col_offset)
+            lower_left_corner = arcpy.Point(extent.XMin + col_offset * cell_width,
+                                            extent.YMax - (row_offset + nrows) * cell_height)
+            yield lower_left_corner, ncols, nrows, row_offset, col_offset
+
+
+class ZonalAccumulator(object):
+    """Per-zone count, sum, minimum, and maximum of one value raster, accumulated one block at a time.
+    When circular is True the values are treated as compass directions in degrees; negative values
+    (flat cells in an ArcGIS aspect raster) are ignored and the mean is the circular mean."""
+
+    def __init__(self, zone_count, circular=False):
+        self.circular = circular
+        self.count = np.zeros(zone_count, dtype=np.int64)
+        self.sum = np.zeros(zone_count, dtype=np.float64)
+        self.min = np.full(zone_count, np.inf)
+        self.max = np.full(zone_count, -np.inf)
+        if circular:
+            self.sum_sin = np.zeros(zone_count, dtype=np.float64)
+            self.sum_cos = np.zeros(zone_count, dtype=np.float64)
+
+    def add(self, zone_index, values):
+        """Add the values of one block. zone_index holds the position of each cell's zone, -1 outside the zones."""
+        values = values.astype(np.float64, copy=False)
+        valid = (zone_index >= 0) & ~np.isnan(values)
+        if self.circular:
+            valid &= values >= 0
+        index = zone_index[valid]
+        values = values[valid]
+        if index.size == 0:
+            return
+
+        zone_count = self.count.size
+        self.count += np.bincount(index, minlength=zone_count)
+        self.sum += np.bincount(index, weights=values, minlength=zone_count)
+        np.minimum.at(self.min, index, values)
+        np.maximum.at(self.max, index, values)
+        if self.circular:
+            radians = np.deg2rad(values)
+            self.sum_sin += np.bincount(index, weights=np.sin(radians), minlength=zone_count)
+            self.sum_cos += np.bincount(index, weights=np.cos(radians), minlength=zone_count)
+
+    def mean(self):
+        """Return the mean of each zone, NaN for zones without data."""
+        with np.errstate(invalid="ignore", divide="ignore"):
+            if self.circular:
+                mean = np.rad2deg(np.arctan2(self.sum_sin, self.sum_cos)) % 360
+                return np.where(self.count > 0, mean, np.nan)
+            return np.where(self.count > 0, self.sum / self.count, np.nan)
+
+    def statistics(self):
+        """Return a dictionary of per-zone COUNT, SUM, MIN, MAX, and MEAN arrays."""
+        has_data = self.count > 0
+        return {"COUNT": self.count,
+                "SUM": self.sum,
+                "MIN": np.where(has_data, self.min, np.nan),
+                "MAX": np.where(has_data, self.max, np.nan),
+                "MEAN": self.mean()}
+
+
+class CrossTabulator(object):
+    """Per-zone cell counts of the classes of a class raster (e.g. land cover), accumulated one block at a time.
+    counts[i, j] is the number of cells of zone i with class classes[j]; classes are added as blocks bring them.
+    zone_cells[i] is the number of cells of zone i, NoData classes included."""
+
+    def __init__(self, zone_count):
+        self.classes = np.zeros(0, dtype=np.int64)
+        self.counts = np.zeros((zone_count, 0), dtype=np.int64)
+        self.zone_cells = np.zeros(zone_count, dtype=np.int64)
+
+    def add(self, zone_index, classes):
+        """Add the classes of one block. zone_index holds the position of each cell's zone, -1 outside the zones,
+        and classes is -1 where the class raster has no data."""
+        self.zone_cells += np.bincount(zone_index[zone_index >= 0], minlength=self.zone_cells.size)
+        valid = (zone_index >= 0) & (classes >= 0)
+        if not valid.any():
+            return
+        block_classes, class_index = np.unique(classes[valid], return_inverse=True)
+        zone_count = self.counts.shape[0]
+        # one bincount over the combined (zone, class) key
+        block_counts = np.bincount(zone_index[valid] * block_classes.size + class_index,
+                                   minlength=zone_count * block_classes.size).reshape(zone_count, block_classes.size)
+
+        all_classes = np.union1d(self.classes, block_classes)
+        if all_classes.size != self.classes.size:
+            counts = np.zeros((zone_count, all_classes.size), dtype=np.int64)
+            counts[:, np.searchsorted(all_classes, self.classes)] = self.counts
+            self.classes, self.counts = all_classes, counts
+        self.counts[:, np.searchsorted(self.classes, block_classes)] += block_counts
+
+
+def cross_tabulate(zone_raster, zone_ids, class_raster, block_size=2048):
+    """Count the cells of each class of an integer class raster in each zone, in a single block-wise pass over the
+    zone raster, like the Tabulate Area tool.
+
+    zone_raster: integer raster of zone ids, aligned with the class raster.
+    zone_ids: the zone ids to report, in the order of the rows of the counts.
+    Returns the sorted classes found in the zones, an array of counts with a row per zone and a column per class,
+    and the number of cells of each zone, NoData classes included."""
+
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    sort_order = np.argsort(zone_ids)
+    sorted_zone_ids = zone_ids[sort_order]
+
+    raster = arcpy.Raster(class_raster)
+    tabulator = CrossTabulator(zone_ids.size)
+    for lower_left_corner, ncols, nrows, _, _ in iterate_blocks(zone_raster, block_size):
+        zones = arcpy.RasterToNumPyArray(zone_raster, lower_left_corner, ncols, nrows, -1).astype(np.int64).ravel()
+        zone_index = lookup_zone_index(sorted_zone_ids, sort_order, zones)
+        if not (zone_index >= 0).any():
+            continue
+
+        values = arcpy.RasterToNumPyArray(raster, lower_left_corner, ncols, nrows).ravel()
+        nodata = np.isnan(values) if values.dtype.kind == "f" else np.zeros(values.shape, dtype=bool)
+        if raster.noDataValue is not None:
+            nodata |= values == raster.noDataValue
+        tabulator.add(zone_index, np.where(nodata, -1, values).astype(np.int64))
+
+    return tabulator.classes, tabulator.counts, tabulator.zone_cells
+
+
+def point_classes(class_raster, x, y):
+    """Return the class of an integer class raster at each point x, y, -1 where it has no data or outside it."""
+
+    raster = arcpy.Raster(class_raster)
+    extent = raster.extent
+    classes = np.full(np.size(x), -1, dtype=np.int64)
+    for i, (point_x, point_y) in enumerate(zip(np.ravel(x), np.ravel(y))):
+        col = int(np.floor((point_x - extent.XMin) / raster.meanCellWidth))
+        row = int(np.floor((extent.YMax - point_y) / raster.meanCellHeight))
+        if not (0 <= row < raster.height and 0 <= col < raster.width):
+            continue
+        corner = arcpy.Point(extent.XMin + col * raster.meanCellWidth,
+                             extent.YMax - (row + 1) * raster.meanCellHeight)
+        value = arcpy.RasterToNumPyArray(raster, corner, 1, 1)[0, 0]
+        # NaN is the only value not equal to itself
+        if value == value and value != raster.noDataValue:
+            classes[i] = int(value)
+    return classes
+
+
+def zonal_statistics(zone_raster, zone_ids, value_rasters, circular_rasters=(), block_size=2048):
+    """Calculate per-zone statistics for several value rasters in a single block-wise pass over the zone raster.
+
+    zone_raster: integer raster of zone ids, aligned with the value rasters.
+    zone_ids: the zone ids to report, in the order the statistics are returned.
+    value_rasters: dictionary of name -> raster path.
+    circular_rasters: names in value_rasters whose values are directions in degrees (e.g. aspect).
+    Returns a dictionary of name -> dictionary of COUNT, SUM, MIN, MAX, and MEAN arrays aligned with zone_ids."""
+
+    zone_ids = np.asarray(zone_ids, dtype=np.int64)
+    sort_order = np.argsort(zone_ids)
+    sorted_zone_ids = zone_ids[sort_order]
+
+    rasters = {name: arcpy.Raster(value_raster) for name, value_raster in value_rasters.items()}
+    accumulators = {name: ZonalAccumulator(zone_ids.size, name in circular_rasters) for name in value_rasters}
+    for lower_left_corner, ncols, nrows, _, _ in iterate_blocks(zone_raster, block_size):
+        zones = arcpy.RasterToNumPyArray(zone_raster, lower_left_corner, ncols, nrows, -1).astype(np.int64).ravel()
+        zone_index = lookup_zone_index(sorted_zone_ids, sort_order, zones)
+        if not (zone_index >= 0).any():
+            continue
+
+        for name, raster in rasters.items():
+            values = arcpy.RasterToNumPyArray(raster, lower_left_corner, ncols, nrows).ravel().astype(np.float64)
+            if raster.noDataValue is not None:
+                values[values == raster.noDataValue] = np.nan
+            accumulators[name].add(zone_index, values)
+
+    return {name: accumulator.statistics() for name, accumulator in accumulators.items()}
+
+
+def lookup_zone_index(sorted_zone_ids, sort_order, zones):
+    """Map zone values to their position in the original zone id list; values not in the list map to -1."""
+
+    if sorted_zone_ids.size == 0:
+        return np.full(zones.shape, -1, dtype=np.int64)
+    position = np.searchsorted(sorted_zone_ids, zones)
+    position[position == sorted_zone_ids.size] = 0
+    matched = sorted_zone_ids[position] == zones
+    return np.where(matched, sort_order[position], -1)
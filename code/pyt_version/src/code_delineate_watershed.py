@@ -2,9 +2,18 @@
 import arcpy
 import arcpy.management  # Import statement added to provide intellisense in PyCharm
 import os
+import re
+import importlib
 from datetime import datetime
+import numpy as np
 import pandas as pd
 from arcpy._mp import Table
+import agwa_tracing
+import agwa_d8
+import agwa_raster_arrays
+importlib.reload(agwa_tracing)
+importlib.reload(agwa_d8)
+importlib.reload(agwa_raster_arrays)
 
 # Check out any necessary licenses
 arcpy.CheckOutExtension("spatial")
@@ -20,17 +29,32 @@ def tweet(msg):
 def initialize_workspace(prjgdb, delineation_name, outlet_feature_set, outlet_snapping_radius):
     """Initialize the workspace by creating the metaDelineation table and writing the user's inputs to it."""
 
-    tweet("Creating metaDelineation table if it does not exist")
+    outlets = read_outlets(prjgdb, outlet_feature_set)
+    _, outlet_x, outlet_y = outlets[-1]
+    write_meta_delineation(prjgdb, [(delineation_name, outlet_x, outlet_y)], outlet_snapping_radius)
 
-    fields = ["DelineationName", "ProjectGeoDataBase", "DelineationWorkspace", "OutletX", "OutletY", "OutletSnappingRadius", "CreationDate", "AGWAVersionAtCreation",
-               "AGWAGDBVersionAtCreation", "Status"]    
-    metadata_delineation_table = os.path.join(prjgdb, "metaDelineation")
-    if not arcpy.Exists(metadata_delineation_table):
-        arcpy.CreateTable_management(prjgdb, "metaDelineation")
-        for field in fields:
-            arcpy.AddField_management(metadata_delineation_table, field, "TEXT")
 
-    
+def initialize_batch_workspace(prjgdb, delineation_name, outlet_feature_set, outlet_snapping_radius,
+                               name_field=None):
+    """Write one metaDelineation row for each outlet of the feature set, named by batch_delineation_name after the
+    value of name_field or the ObjectID of the outlet, and return the delineation names."""
+
+    outlets = read_outlets(prjgdb, outlet_feature_set, name_field)
+    delineations = [(batch_delineation_name(delineation_name, key), outlet_x, outlet_y)
+                    for key, outlet_x, outlet_y in outlets]
+    write_meta_delineation(prjgdb, delineations, outlet_snapping_radius)
+    return [name for name, _, _ in delineations]
+
+
+def batch_delineation_name(delineation_name, key):
+    """Return the name of the delineation of the outlet identified by key in a batch named delineation_name."""
+    return re.sub("[^A-Za-z0-9_]", "_", f"{delineation_name}_{key}")
+
+
+def read_outlets(prjgdb, outlet_feature_set, name_field=None):
+    """Return (key, x, y) for each outlet of the feature set in the spatial reference of the filled DEM, where key
+    is the value of name_field or the ObjectID of the outlet."""
+
     tweet("Documenting user's inputs to metaDealineation table and matching spatial references of the outlet and DEM if necessary")
 
     # Read spatial reference of the filled DEM from the metaWorkspace table
@@ -48,23 +72,43 @@ def initialize_workspace(prjgdb, delineation_name, outlet_feature_set, outlet_sn
     
     # Match spatial references of the outlet and DEM if necessary
     spatial_refrence_outlet = arcpy.Describe(outlet_feature_set).SpatialReference
-    for row in arcpy.da.SearchCursor(outlet_feature_set, ["SHAPE@"]):
-        if spatial_refrence_dem.name != spatial_refrence_outlet.name:
-            tweet("Projecting the outlet coordinates because the spatial references between the DEM and the outlet do "
-                  f"not match.\nDEM Spatial Reference: '{spatial_refrence_dem.name}'\n"
-                  f"Outlet Spatial Reference: '{spatial_refrence_outlet.name}'")                                                                                                      
-            outlet_x = row[0].projectAs(spatial_refrence_dem).centroid.X
-            outlet_y = row[0].projectAs(spatial_refrence_dem).centroid.Y
-        else:
-            outlet_x = row[0].centroid.X
-            outlet_y = row[0].centroid.Y
-    if row is None:
-        tweet("Cannot proceed. There were no records in the outlet feature set.")
+    project = spatial_refrence_dem.name != spatial_refrence_outlet.name
+    if project:
+        tweet("Projecting the outlet coordinates because the spatial references between the DEM and the outlet do "
+              f"not match.\nDEM Spatial Reference: '{spatial_refrence_dem.name}'\n"
+              f"Outlet Spatial Reference: '{spatial_refrence_outlet.name}'")
+    outlets = []
+    for row in arcpy.da.SearchCursor(outlet_feature_set, ["SHAPE@", name_field or "OID@"]):
+        shape = row[0].projectAs(spatial_refrence_dem) if project else row[0]
+        outlets.append((row[1], shape.centroid.X, shape.centroid.Y))
+    if not outlets:
+        msg = "Cannot proceed. There were no records in the outlet feature set."
+        tweet(msg)
+        raise Exception(msg)
+    return outlets
+
+
+def write_meta_delineation(prjgdb, delineations, outlet_snapping_radius):
+    """Create the metaDelineation table if it does not exist and write a row for each (delineation name, outlet x,
+    outlet y) of delineations."""
+
+    tweet("Creating metaDelineation table if it does not exist")
+
+    fields = ["DelineationName", "ProjectGeoDataBase", "DelineationWorkspace", "OutletX", "OutletY", "OutletSnappingRadius", "CreationDate", "AGWAVersionAtCreation",
+               "AGWAGDBVersionAtCreation", "Status"]    
+    metadata_delineation_table = os.path.join(prjgdb, "metaDelineation")
+    if not arcpy.Exists(metadata_delineation_table):
+        arcpy.CreateTable_management(prjgdb, "metaDelineation")
+        for field in fields:
+            arcpy.AddField_management(metadata_delineation_table, field, "TEXT")
 
     # write the user's inputs to the metaDelineation table
-    delineation_workspace = os.path.join(os.path.split(prjgdb)[0], delineation_name, f"{delineation_name}.gdb")
-    row_list = [delineation_name, prjgdb, delineation_workspace, outlet_x, outlet_y, outlet_snapping_radius, datetime.now().isoformat(), "4.0", "4.0", "Success"]        
+    creation_date = datetime.now().isoformat()
     with arcpy.da.InsertCursor(metadata_delineation_table, fields) as insert_cursor:
+        for delineation_name, outlet_x, outlet_y in delineations:
+            delineation_workspace = os.path.join(os.path.split(prjgdb)[0], delineation_name, f"{delineation_name}.gdb")
+            row_list = [delineation_name, prjgdb, delineation_workspace, outlet_x, outlet_y, outlet_snapping_radius,
+                        creation_date, "4.0", "4.0", "Success"]
             insert_cursor.insertRow(row_list)
 
 
@@ -83,16 +127,7 @@ def initialize_workspace(prjgdb, delineation_name, outlet_feature_set, outlet_sn
 def delineate(prjgdb, delineation_name, save_intermediate_outputs):
     """Delineate a watershed using the filled DEM, the flow direction raster, and the flow accumulation raster."""
 
-    # Create a folder and geo-database for the delineation
-    project_directory = os.path.split(prjgdb)[0]
-    delineation_directory = os.path.join(project_directory, delineation_name)
-    if not os.path.exists(delineation_directory):
-        os.makedirs(delineation_directory)
-    workspace = os.path.join(delineation_directory, f"{delineation_name}.gdb")
-    if not arcpy.Exists(workspace):
-        arcpy.CreateFileGDB_management(delineation_directory, f"{delineation_name}.gdb")
-        arcpy.AddMessage(f"Creating a file geodatabase '{workspace}' for the delineation.")
-
+    workspace = create_delineation_workspace(prjgdb, delineation_name)
     arcpy.env.workspace = workspace
 
     try:
@@ -114,20 +149,8 @@ def delineate(prjgdb, delineation_name, save_intermediate_outputs):
         # Step 3. Delineate the watershed, convert the raster to a polygon, and dissolve the polygon
         tweet("Delineating watershed")
         delineation_raster = arcpy.sa.Watershed(fd_raster, outlet_pour_point, "#")
-
-        tweet("Converting delineation raster to feature class")
-        intermediate_delineation_fc = "intermediate_{}_dissolve".format(delineation_name)
-        arcpy.RasterToPolygon_conversion(delineation_raster, intermediate_delineation_fc, "NO_SIMPLIFY", "#")
-
-        tweet("Dissolving intermediate delineation feature class")
-        delineation_fc = os.path.join(workspace, delineation_name)
-        result = arcpy.Dissolve_management(intermediate_delineation_fc, delineation_fc, "gridcode", "", "MULTI_PART",
-                                           "DISSOLVE_LINES")
-
-        delineation_fc = result.getOutput(0)
-        if not save_intermediate_outputs:
-            arcpy.Delete_management(intermediate_delineation_fc)
-
+        delineation_fc = convert_delineation(workspace, delineation_name, delineation_raster,
+                                             save_intermediate_outputs)
 
         # Step 4. Save the delineation raster and add delineation feature class to the map
         delineation_output_name = os.path.join(workspace, delineation_name + "_raster")
@@ -142,10 +165,114 @@ def delineate(prjgdb, delineation_name, save_intermediate_outputs):
         tweet(e)
 
 
+@agwa_tracing.traced("Delineate batch", "prjgdb", tweet)
+def delineate_batch(prjgdb, delineation_names, save_intermediate_outputs):
+    """Delineate the watersheds of many delineations in one pass over the flow direction grid. All outlets are
+    snapped at once, every cell is labelled with the first outlet on its flow path, and the watershed of an outlet
+    is its own zone and the zones of the outlets nested upstream of it (see agwa_d8.nested_watersheds). Each
+    delineation gets the same workspace, outlet raster, delineation raster, and feature class as with delineate."""
+
+    agwa_tracing.stage("Reading parameters from metadata", tweet)
+    fd_raster, fa_raster, df_delineations = extract_batch_inputs(prjgdb, delineation_names)
+    names = df_delineations["DelineationName"].values
+
+    agwa_tracing.stage("Reading flow direction and flow accumulation rasters", tweet)
+    frame = agwa_raster_arrays.RasterFrame(fd_raster)
+    flow_direction = frame.read(fd_raster, 0)
+    flow_accumulation = frame.read(fa_raster, -1)
+
+    agwa_tracing.stage("Snapping outlets", tweet)
+    rows, cols, inside = frame.cells(df_delineations["OutletX"].astype(float).values,
+                                     df_delineations["OutletY"].astype(float).values)
+    for name in names[~inside]:
+        tweet(f"Skipping delineation {name} because its outlet is outside the flow direction raster")
+    names = names[inside]
+    radius = df_delineations["OutletSnappingRadius"].astype(float).values[inside] / frame.cell_width
+    snapped_rows, snapped_cols = agwa_d8.snap_pour_points(flow_accumulation, rows[inside], cols[inside], radius)
+    outlet_cells, outlet_numbers = np.unique(snapped_rows * frame.ncols + snapped_cols, return_inverse=True)
+
+    agwa_tracing.stage("Delineating watersheds", tweet)
+    zones, parents = agwa_d8.nested_watersheds(flow_direction, outlet_cells)
+    basins = agwa_d8.upstream_outlets(parents)
+    first_rows, first_cols, last_rows, last_cols = agwa_d8.zone_bounds(zones, outlet_cells.size)
+    tweet(f"Delineated the watersheds of {outlet_cells.size} outlets, {np.count_nonzero(parents)} of them nested "
+          f"in another watershed")
+
+    agwa_tracing.stage("Writing delineations", tweet)
+    project = arcpy.mp.ArcGISProject("CURRENT")
+    m = project.activeMap
+    for name, row, col, outlet_number in zip(names, snapped_rows, snapped_cols, outlet_numbers):
+        with agwa_tracing.span(name):
+            try:
+                workspace = create_delineation_workspace(prjgdb, name)
+                arcpy.env.workspace = workspace
+                # NoData 0 keeps the cells of the frame outside the outlet cell invalid when the raster is read
+                frame.write_block(np.ones((1, 1), dtype=np.int32), row, col,
+                                  os.path.join(workspace, f"{name}_outelt"), 0)
+
+                # the watershed is cut to the bounding box of its zones
+                zone_indices = basins[outlet_number] - 1
+                row0, col0 = first_rows[zone_indices].min(), first_cols[zone_indices].min()
+                row1, col1 = last_rows[zone_indices].max() + 1, last_cols[zone_indices].max() + 1
+                in_basin = np.isin(zones[row0:row1, col0:col1], basins[outlet_number]).astype(np.int32)
+                delineation_raster = frame.write_block(in_basin, row0, col0,
+                                                       os.path.join(workspace, f"{name}_raster"), 0)
+                delineation_fc = convert_delineation(workspace, name, delineation_raster, save_intermediate_outputs)
+
+                delineation_layer = m.addDataFromPath(delineation_fc)
+                m.moveLayer(m.listLayers()[0], delineation_layer)
+            except Exception as e:
+                tweet(e)
+
+
+def create_delineation_workspace(prjgdb, delineation_name):
+    """Create a folder and geo-database for the delineation if they do not exist and return the geo-database."""
+
+    project_directory = os.path.split(prjgdb)[0]
+    delineation_directory = os.path.join(project_directory, delineation_name)
+    if not os.path.exists(delineation_directory):
+        os.makedirs(delineation_directory)
+    workspace = os.path.join(delineation_directory, f"{delineation_name}.gdb")
+    if not arcpy.Exists(workspace):
+        arcpy.CreateFileGDB_management(delineation_directory, f"{delineation_name}.gdb")
+        arcpy.AddMessage(f"Creating a file geodatabase '{workspace}' for the delineation.")
+    return workspace
+
+
+def convert_delineation(workspace, delineation_name, delineation_raster, save_intermediate_outputs):
+    """Convert the delineation raster to a polygon, dissolve the polygon, and return the delineation feature
+    class."""
+
+    tweet("Converting delineation raster to feature class")
+    intermediate_delineation_fc = os.path.join(workspace, "intermediate_{}_dissolve".format(delineation_name))
+    arcpy.RasterToPolygon_conversion(delineation_raster, intermediate_delineation_fc, "NO_SIMPLIFY", "#")
+
+    tweet("Dissolving intermediate delineation feature class")
+    delineation_fc = os.path.join(workspace, delineation_name)
+    result = arcpy.Dissolve_management(intermediate_delineation_fc, delineation_fc, "gridcode", "", "MULTI_PART",
+                                       "DISSOLVE_LINES")
+
+    delineation_fc = result.getOutput(0)
+    if not save_intermediate_outputs:
+        arcpy.Delete_management(intermediate_delineation_fc)
+    return delineation_fc
+
 
 def extract_inputs(prjgdb, delineation_name):
     """Extract the inputs from the metaWorkspace and metaDelineation tables."""
 
+    fd_raster, fa_raster, df_delineations = extract_batch_inputs(prjgdb, [delineation_name])
+    df_delineation = df_delineations.iloc[0]
+    outlet_x, outlet_y = df_delineation["OutletX"], df_delineation["OutletY"]
+    snapping_radius = int(df_delineation["OutletSnappingRadius"])
+    
+    return fd_raster, fa_raster, outlet_x, outlet_y, snapping_radius
+
+
+def extract_batch_inputs(prjgdb, delineation_names):
+    """Extract the flow direction and flow accumulation rasters from the metaWorkspace table, and the
+    metaDelineation rows of the delineations in the order of delineation_names, reading each table once."""
+
     tweet("Extracting input parameters from meta tables")
     # Extract the inputs from the metaWorkspace table
     df_meta_workspace = pd.DataFrame(arcpy.da.TableToNumPyArray(os.path.join(prjgdb, "metaWorkspace"), "*"))
@@ -169,13 +296,12 @@ def extract_inputs(prjgdb, delineation_name):
         msg = "Cannot proceed. \nThe table 'metaDelineation' returned 0 records."
         tweet(msg)
         raise Exception(msg)
-    df_delineation = df_meta_delineation.loc[df_meta_delineation['DelineationName'] == delineation_name].squeeze()
-    if df_delineation.empty:
-        msg = f"Cannot proceed. \nThe table 'metaDelineation' returned 0 records with field 'DelineationName' equal to '{delineation_name}'."
+    df_meta_delineation = df_meta_delineation.drop_duplicates("DelineationName", keep="last")
+    df_delineations = df_meta_delineation.set_index("DelineationName", drop=False)
+    missing = [name for name in delineation_names if name not in df_delineations.index]
+    if missing:
+        msg = f"Cannot proceed. \nThe table 'metaDelineation' returned 0 records with field 'DelineationName' equal to '{missing[0]}'."
         tweet(msg)
         raise Exception(msg)
-    
-    outlet_x, outlet_y = df_delineation["OutletX"], df_delineation["OutletY"]
-    snapping_radius = int(df_delineation["OutletSnappingRadius"])
-    
-    return fd_raster, fa_raster, outlet_x, outlet_y, snapping_radius
\ No newline at end of file
+
+    return fd_raster, fa_raster, df_delineations.loc[list(delineation_names)].reset_index(drop=True)
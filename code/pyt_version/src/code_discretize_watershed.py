@@ -2,8 +2,22 @@
 import os
 import arcpy
 import datetime
+import importlib
+import numpy as np
 import pandas as pd
 from arcpy._mp import Table
+import agwa_tracing
+import agwa_table_writer
+import agwa_channel_network
+import agwa_d8
+import agwa_raster_arrays
+import agwa_intermediate_outputs
+importlib.reload(agwa_tracing)
+importlib.reload(agwa_table_writer)
+importlib.reload(agwa_channel_network)
+importlib.reload(agwa_d8)
+importlib.reload(agwa_raster_arrays)
+importlib.reload(agwa_intermediate_outputs)
 
 arcpy.CheckOutExtension("spatial")
 
@@ -71,9 +85,10 @@ def initialize_workspace(delineation_name, model, methodology, threshold_method,
 
 
 
+@agwa_tracing.traced("Discretize", "workspace", tweet)
 def discretize(prjgdb, workspace, delineation_name, discretization_name, save_intermediate_outputs):
 
-    tweet("Reading parameters from metadata")
+    agwa_tracing.stage("Reading parameters from metadata", tweet)
 
     (flow_direction_raster, flow_accumulation_raster, fl_up_raster, dem_raster_path, delineation_name,
      methodology, threshold_method, threshold_value, 
@@ -91,7 +106,7 @@ def discretize(prjgdb, workspace, delineation_name, discretization_name, save_in
     
     # Start the discretization process, create the channel network
     if methodology == "Existing Channels":
-        tweet("Converting existing channels")
+        agwa_tracing.stage("Converting existing channels", tweet)
 
         # Open the existing channels feature class, left out checking if input is mdb or gdb
         existingStreamFC = arcpy.conversion.FeatureClassToFeatureClass(
@@ -111,7 +126,7 @@ def discretize(prjgdb, workspace, delineation_name, discretization_name, save_in
     
     elif methodology == "Channel Initiation Points":
 
-        tweet("Converting channel initiation points")
+        agwa_tracing.stage("Converting channel initiation points", tweet)
         channelInitiationPointsFC = arcpy.conversion.FeatureClassToFeatureClass(
                 channel_inition_points_feature, workspace, f"cip_{discretization_name}")
 
@@ -127,48 +142,155 @@ def discretize(prjgdb, workspace, delineation_name, discretization_name, save_in
         channel_raster = arcpy.sa.CostPath(outSnapPour, dem_raster_path, flow_direction_raster, "EACH_CELL")
         channel_raster.save(os.path.join(temp_directory, f"streamGrid_{discretization_name}"))
     
-    elif (methodology=="Threshold-based") & (threshold_method == "Flow length (unit: m)"):
-        tweet("Creating stream grid")
-        channel_raster = arcpy.Raster(fl_up_raster) > float(threshold_value)
-        channel_raster_output = f"{discretization_name}_channel_raster"
-        channel_raster.save(channel_raster_output)       
-
-    elif (methodology=="Threshold-based") & (threshold_method == "Flow accumulation (unit: %)"):
-        watershed_boundary = os.path.join(workspace, delineation_name)
-        watershed_fa_raster = arcpy.sa.ExtractByMask(flow_accumulation_raster, watershed_boundary)
-        cell_count = arcpy.GetRasterProperties_management(watershed_fa_raster, "MAXIMUM").getOutput(0)
-        channel_raster = arcpy.Raster(watershed_fa_raster) > float(threshold_value)*int(cell_count)/100
-        channel_raster_output = f"{discretization_name}_channel_raster"
-        channel_raster.save(channel_raster_output)               
+    # The stream links, orders, and discretization are computed from arrays of the flow direction and flow
+    # accumulation rasters with the D8 kernel in agwa_d8, in the cell grid of the flow direction raster
+    agwa_tracing.stage("Reading flow direction, flow accumulation, and channel rasters", tweet)
+    frame, in_watershed, flow_direction, flow_accumulation, downstream = read_flow_grids(flow_direction_raster,
+                                                                                         flow_accumulation_raster)
+    if methodology == "Threshold-based":
+        agwa_tracing.stage("Creating stream grid", tweet)
+        threshold_grid, threshold_scale = read_threshold_grid(threshold_method, frame, fl_up_raster,
+                                                              flow_accumulation, in_watershed)
+        channels = in_watershed & (threshold_grid > float(threshold_value) * threshold_scale)
+        write_channel_raster(workspace, discretization_name, frame, channels, in_watershed)
+    else:
+        channels = (frame.read(channel_raster, 0) > 0) & in_watershed
+
+    with agwa_intermediate_outputs.IntermediateOutputs(workspace, save_intermediate_outputs) as intermediate_outputs:
+        discretize_channels(workspace, delineation_name, discretization_name, frame, in_watershed, flow_direction,
+                            flow_accumulation, downstream, channels, flow_direction_raster, flow_accumulation_raster,
+                            internal_pour_points_method, internal_pour_points_feature,
+                            internal_pour_points_snap_distance, temp_directory, intermediate_outputs)
+
+
+@agwa_tracing.traced("Discretize thresholds", "workspace", tweet)
+def discretize_thresholds(prjgdb, workspace, delineation_name, discretization_names, save_intermediate_outputs):
+    """Discretize a delineation at several thresholds. Each discretization in discretization_names has its own
+    Threshold-based row in metaDiscretization, all with the same threshold method. The flow direction, flow
+    accumulation, and threshold rasters are read once, and the channel networks are derived from the highest
+    threshold to the lowest, each one adding the cells between two thresholds to the previous one."""
+
+    agwa_tracing.stage("Reading parameters from metadata", tweet)
+    parameters = {name: read_and_extract_parameters(prjgdb, delineation_name, name) for name in discretization_names}
+    (flow_direction_raster, flow_accumulation_raster, fl_up_raster, _, _, _, threshold_method, _, _, _, _, _, _, _,
+     _) = parameters[discretization_names[0]]
+    names_by_threshold = {}
+    for name, discretization_parameters in parameters.items():
+        if discretization_parameters[5] != "Threshold-based" or discretization_parameters[6] != threshold_method:
+            raise ValueError(f"Discretization {name} is not a Threshold-based discretization by {threshold_method}")
+        names_by_threshold.setdefault(float(discretization_parameters[7]), []).append(name)
 
+    arcpy.env.workspace = workspace
+    arcpy.env.mask = delineation_name + "_raster"
+    temp_directory = arcpy.env.scratchGDB
+    arcpy.env.overwriteOutput = True
+
+    agwa_tracing.stage("Reading flow direction, flow accumulation, and threshold rasters", tweet)
+    frame, in_watershed, flow_direction, flow_accumulation, downstream = read_flow_grids(flow_direction_raster,
+                                                                                         flow_accumulation_raster)
+    threshold_grid, threshold_scale = read_threshold_grid(threshold_method, frame, fl_up_raster, flow_accumulation,
+                                                          in_watershed)
+    threshold_grid = np.where(in_watershed, threshold_grid, -np.inf)
+    agwa_tracing.stage("Discretizing", tweet)
+
+    thresholds = {threshold * threshold_scale: threshold for threshold in names_by_threshold}
+    with agwa_intermediate_outputs.IntermediateOutputs(workspace, save_intermediate_outputs) as intermediate_outputs:
+        for scaled_threshold, channels in agwa_d8.nested_channel_networks(threshold_grid, list(thresholds)):
+            threshold = thresholds[scaled_threshold]
+            for discretization_name in names_by_threshold[threshold]:
+                with agwa_tracing.span(discretization_name):
+                    tweet(f"Discretizing {discretization_name} at threshold {threshold:g}, "
+                          f"{channels.sum()} channel cells")
+                    (_, _, _, _, _, _, _, _, _, _, _, _, internal_pour_points_method, internal_pour_points_feature,
+                     internal_pour_points_snap_distance) = parameters[discretization_name]
+                    write_channel_raster(workspace, discretization_name, frame, channels, in_watershed)
+                    discretize_channels(workspace, delineation_name, discretization_name, frame, in_watershed,
+                                        flow_direction, flow_accumulation, downstream, channels,
+                                        flow_direction_raster, flow_accumulation_raster, internal_pour_points_method,
+                                        internal_pour_points_feature, internal_pour_points_snap_distance,
+                                        temp_directory, intermediate_outputs)
+
+
+def threshold_discretization_name(discretization_name, threshold_value):
+    """Return the name of the discretization at threshold_value in a sweep named discretization_name."""
+    return f"{discretization_name}_{float(threshold_value):g}".replace(".", "_").replace("-", "_").replace("+", "")
+
+
+def read_flow_grids(flow_direction_raster, flow_accumulation_raster):
+    """Read the flow direction and flow accumulation rasters into arrays in the cell grid of the flow direction
+    raster, with the flow directions removed outside the mask. Returns the frame, the mask, both arrays, and the
+    downstream cells of the flow directions."""
+
+    frame = agwa_raster_arrays.RasterFrame(flow_direction_raster)
+    in_watershed = frame.read_valid(arcpy.env.mask)
+    flow_direction = np.where(in_watershed, frame.read(flow_direction_raster, 0), 0)
+    flow_accumulation = frame.read(flow_accumulation_raster, -1)
+    downstream = agwa_d8.downstream_cells(flow_direction)
+    return frame, in_watershed, flow_direction, flow_accumulation, downstream
+
+
+def read_threshold_grid(threshold_method, frame, fl_up_raster, flow_accumulation, in_watershed):
+    """Return the array the channel threshold applies to and the factor converting a threshold value to its unit:
+    the upstream flow length in m, or the flow accumulation in percent of the cells in the watershed."""
+
+    if threshold_method == "Flow length (unit: m)":
+        return frame.read(fl_up_raster, -1), 1.0
+    elif threshold_method == "Flow accumulation (unit: %)":
+        cell_count = int(flow_accumulation[in_watershed].max())
+        return flow_accumulation, cell_count / 100
+    raise ValueError(f"Unknown threshold method: {threshold_method}")
+
+
+def write_channel_raster(workspace, discretization_name, frame, channels, in_watershed):
+    """Write the channel cells of a discretization, a boolean array in frame, as the <discretization>_channel_raster
+    raster, with NoData outside the watershed."""
+    frame.write(np.where(in_watershed, channels, 255).astype(np.uint8),
+                os.path.join(workspace, f"{discretization_name}_channel_raster"), 255)
+
+
+def discretize_channels(workspace, delineation_name, discretization_name, frame, in_watershed, flow_direction,
+                        flow_accumulation, downstream, channels, flow_direction_raster, flow_accumulation_raster,
+                        internal_pour_points_method, internal_pour_points_feature, internal_pour_points_snap_distance,
+                        temp_directory, intermediate_outputs):
+    """Create the channels, nodes, and hillslopes of a discretization from its channel network, a boolean array of
+    the channel cells in frame, and add them to the map. Intermediate rasters are queued to intermediate_outputs."""
 
     # Create Flow Length Downstream. It is used in hillslope parameterization for hillslope-based flow length calculations
-    tweet("Creating flow length (downstream) raster")
-    flow_direction_nostream_raster = arcpy.sa.Con(channel_raster_output, flow_direction_raster, None, "Value = 0")
-    save_intermediate_raster(flow_direction_nostream_raster, discretization_name, "flowDirectionNoStream", workspace, save_intermediate_outputs)
-    flow_length_down_raster = arcpy.sa.FlowLength(flow_direction_nostream_raster, direction_measurement="DOWNSTREAM")
-    flow_length_down_raster.save(f"{discretization_name}_flow_length_downstream")
+    agwa_tracing.stage("Creating flow length (downstream) raster", tweet)
+    if intermediate_outputs.enabled:
+        intermediate_outputs.save_array(frame, np.where(channels | ~in_watershed, 0, flow_direction).astype(np.int32),
+                                        discretization_name, "flowDirectionNoStream", 0)
+    flow_length_down = agwa_d8.downstream_flow_length(flow_direction, frame.cell_width, frame.cell_height,
+                                                      agwa_d8.stop_at(downstream, channels))
+    flow_length_down[channels | ~in_watershed] = -1
+    frame.write(flow_length_down.astype(np.float32), os.path.join(workspace, f"{discretization_name}_flow_length_downstream"), -1)
 
     # Create Stream Link - line 1421  in VB file ???
-    tweet("Creating stream links raster")
-    stream_link_raster = arcpy.sa.StreamLink(channel_raster, flow_direction_raster)
-    save_intermediate_raster(stream_link_raster, discretization_name, "streamLinkRaster", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating stream links raster", tweet)
+    stream_links = agwa_d8.stream_link(channels, flow_direction, downstream)
 
     # Add internal pour points
     if internal_pour_points_method!="None":
-        stream_link_raster = add_internal_pour_points(workspace, delineation_name, discretization_name, 
-                                                      internal_pour_points_feature, internal_pour_points_snap_distance, 
-                                                     flow_accumulation_raster, channel_raster, stream_link_raster, save_intermediate_outputs)
+        if intermediate_outputs.enabled:
+            intermediate_outputs.save_array(frame, np.where(channels, flow_accumulation, -1).astype(np.float32),
+                                            discretization_name, "facgStreamGds", -1)
+        stream_links = add_internal_pour_points(workspace, delineation_name, discretization_name, 
+                                                internal_pour_points_feature, internal_pour_points_snap_distance, 
+                                                flow_accumulation_raster, frame, stream_links, flow_accumulation)
+
+    stream_links = stream_links.astype(np.int32)
+    stream_link_raster = frame.write(stream_links, os.path.join(temp_directory, f"streamLink_{discretization_name}"), 0)
+    intermediate_outputs.save_array(frame, stream_links, discretization_name, "streamLinkRaster", 0)
 
     # Process: Stream to Feature
-    tweet("Converting channels raster to feature class")
+    agwa_tracing.stage("Converting channels raster to feature class", tweet)
     channel_feature_class = f"{discretization_name}_channels"
     arcpy.gp.StreamToFeature(stream_link_raster, flow_direction_raster, channel_feature_class, "NO_SIMPLIFY")
     
 
     # Process Feature Vertices To Points
     try:
-        tweet("Creating nodes feature class")
+        agwa_tracing.stage("Creating nodes feature class", tweet)
         nodes_feature_class = f"{discretization_name}_nodes"
         arcpy.management.FeatureVerticesToPoints(channel_feature_class, nodes_feature_class, "START")
         arcpy.management.AddField(nodes_feature_class, "node_type", "TEXT", field_length=50)
@@ -185,83 +307,81 @@ def discretize(prjgdb, workspace, delineation_name, discretization_name, save_in
         raise ValueError(f"Error processing feature vertices to points: {str(e)}")
 
 
-    tweet("Identifying outlet node")
+    agwa_tracing.stage("Identifying outlet node", tweet)
     fields = ["SHAPE@", "arcid", "grid_code", "from_node", "to_node"]
     expression = "{0} = {1}".format(arcpy.AddFieldDelimiters(workspace, "to_node"), missing_to_node)    
     with arcpy.da.SearchCursor(channel_feature_class, fields, expression) as channel_cursor:
-        fields.append("node_type")
-        for channel_row in channel_cursor:
-            with arcpy.da.InsertCursor(nodes_feature_class, fields) as cursor:
-                cursor.insertRow((channel_row[0].lastPoint, channel_row[1], channel_row[2], channel_row[3], channel_row[4],
-                                  "outlet"))
+        with agwa_table_writer.TableWriter(nodes_feature_class, fields + ["node_type"]) as writer:
+            for channel_row in channel_cursor:
+                writer.write((channel_row[0].lastPoint, channel_row[1], channel_row[2], channel_row[3], channel_row[4],
+                              "outlet"))
 
 
     # Process: Stream Order
-    tweet("Creating stream orders raster")
-    stream_order_raster = arcpy.sa.StreamOrder(channel_raster, flow_direction_raster, "SHREVE")
-    save_intermediate_raster(stream_order_raster, discretization_name, "StreamOrder", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating stream orders raster", tweet)
+    stream_order = agwa_d8.shreve_order(channels, flow_direction, downstream)
+    intermediate_outputs.save_array(frame, stream_order.astype(np.int32), discretization_name, "StreamOrder")
 
 
     # Process: Raster Calculator (2)
-    tweet("Creating first order channels raster")
-    first_order_channel_raster = stream_order_raster == 1    
-    save_intermediate_raster(first_order_channel_raster, discretization_name, "firstOrderChannels", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating first order channels raster", tweet)
+    first_order_channels = stream_order == 1
+    intermediate_outputs.save_array(frame, first_order_channels.astype(np.int32),
+                                    discretization_name, "firstOrderChannels")
 
 
     # Process: Zonal Fill
-    tweet("Creating minimum flow accumulation zones raster of stream links")
-    minimum_fa_zones_raster = arcpy.sa.ZonalFill(stream_link_raster, flow_accumulation_raster)
-    save_intermediate_raster(minimum_fa_zones_raster, discretization_name, "faZones", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating minimum flow accumulation zones raster of stream links", tweet)
+    minimum_fa_zones = agwa_d8.zone_minimum(stream_links, flow_accumulation)
+    intermediate_outputs.save_array(frame, np.nan_to_num(minimum_fa_zones, nan=-1), discretization_name, "faZones",
+                                    -1)
 
 
     # Process: Raster Calculator (3)
-    tweet("Creating first order points raster")
-    stream_link_points_raster = minimum_fa_zones_raster == flow_accumulation_raster
-    save_intermediate_raster(stream_link_points_raster, discretization_name, "StreamLinkPoints", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating first order points raster", tweet)
+    stream_link_points = minimum_fa_zones == flow_accumulation
+    intermediate_outputs.save_array(frame, stream_link_points.astype(np.int32), discretization_name, "StreamLinkPoints")
 
 
     # Process: Raster Calculator (4)
-    tweet("Creating zero order points raster")
-    zero_order_points_raster = arcpy.sa.Con(first_order_channel_raster, stream_link_points_raster, 0)
-    save_intermediate_raster(zero_order_points_raster, discretization_name, "ZeroOrderPoints", workspace, save_intermediate_outputs)
-
-
-    # Process: Times
-    tweet("Creating stream links * 10 raster")
-    stream_link_10_raster = stream_link_raster * 10
-    save_intermediate_raster(stream_link_10_raster, discretization_name, "StreamLink10", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating zero order points raster", tweet)
+    zero_order_points = first_order_channels & stream_link_points
+    intermediate_outputs.save_array(frame, zero_order_points.astype(np.int32), discretization_name, "ZeroOrderPoints")
 
 
     # Process: Plus
-    tweet("Creating unique pour points raster")
-    unique_pour_points_raster = zero_order_points_raster + stream_link_10_raster
-    save_intermediate_raster(unique_pour_points_raster, discretization_name, "UniquePourPoints", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating unique pour points raster", tweet)
+    unique_pour_points = np.where(channels, stream_links * 10 + zero_order_points, 0)
+    intermediate_outputs.save_array(frame, unique_pour_points.astype(np.int32), discretization_name, "UniquePourPoints")
 
 
     # Process: Watershed
-    tweet("Creating discretization raster")
-    discretization_raster = arcpy.sa.Watershed(flow_direction_raster, unique_pour_points_raster, "VALUE")
-    save_intermediate_raster(discretization_raster, discretization_name, "discretization_raster", workspace, save_intermediate_outputs)
+    agwa_tracing.stage("Creating discretization raster", tweet)
+    discretization = agwa_d8.watershed(flow_direction, unique_pour_points, downstream)
+    discretization = discretization.astype(np.int32)
+    discretization_raster = frame.write(discretization,
+                                        os.path.join(temp_directory, f"discretization_{discretization_name}"), 0)
+    intermediate_outputs.save_array(frame, discretization, discretization_name, "discretization_raster", 0)
 
 
     # Raster to Polygon
-    tweet("Converting discretization raster to feature class")
+    agwa_tracing.stage("Converting discretization raster to feature class", tweet)
     intermediate_discretization_1 = f"{workspace}/intermediate_{discretization_name}_1"
     arcpy.RasterToPolygon_conversion(discretization_raster, intermediate_discretization_1, "NO_SIMPLIFY", "VALUE")
 
-    tweet("Splitting model hillslopes by channels")
+    agwa_tracing.stage("Splitting model hillslopes by channels", tweet)
     intermediate_discretization_2 = f"{workspace}/intermediate_{discretization_name}_2_split"
     arcpy.management.FeatureToPolygon([intermediate_discretization_1, channel_feature_class], intermediate_discretization_2)
 
     # Delete extra fields
-    tweet("Deleting unnecessary discretization fields")
+    agwa_tracing.stage("Deleting unnecessary discretization fields", tweet)
     arcpy.management.DeleteField(intermediate_discretization_2, ["FID_intermediate_1", "gridcode"])
 
-    tweet("Updating gridcode")
+    agwa_tracing.stage("Updating gridcode", tweet)
     intermediate_discretization_3 = f"{workspace}/intermediate_{discretization_name}_3_identity"
     arcpy.analysis.Identity(intermediate_discretization_2, intermediate_discretization_1, intermediate_discretization_3, "NO_FID")
 
-    tweet("Clipping to remove excess polygons")
+    agwa_tracing.stage("Clipping to remove excess polygons", tweet)
     intermediate_discretization_4 = f"{workspace}/intermediate_{discretization_name}_4_clip"
     arcpy.analysis.PairwiseClip(intermediate_discretization_3, delineation_name, intermediate_discretization_4)
 
@@ -269,7 +389,7 @@ def discretize(prjgdb, workspace, delineation_name, discretization_name, save_in
     assign_ids(intermediate_discretization_4, channel_feature_class)
 
     # Dissolve
-    tweet("Dissolving intermediate discretization feature class")
+    agwa_tracing.stage("Dissolving intermediate discretization feature class", tweet)
     intermediate_discretization_5 = f"{workspace}/intermediate_{discretization_name}_5_dissolve"
     arcpy.Dissolve_management(intermediate_discretization_4, intermediate_discretization_5, "HillslopeID", "", "MULTI_PART", "DISSOLVE_LINES")
 
@@ -277,16 +397,17 @@ def discretize(prjgdb, workspace, delineation_name, discretization_name, save_in
     plane_feature_class = f"{workspace}/{discretization_name}_hillslopes"
     arcpy.management.CopyFeatures(intermediate_discretization_5, plane_feature_class)
 
-    tweet("Identifying contributing channels")
+    agwa_tracing.stage("Identifying contributing channels", tweet)
     identify_contributing_channels(workspace, delineation_name, discretization_name, channel_feature_class)
 
     # Cleanup intermediates; list all possible intermediates here
     intermediates = [intermediate_discretization_1, intermediate_discretization_2, 
                         intermediate_discretization_3, intermediate_discretization_4, 
                         intermediate_discretization_5]
-    cleanup_intermediates(intermediates, save_intermediate_outputs)
+    cleanup_intermediates(intermediates, intermediate_outputs.enabled)
 
     # Add the discretization to current map
+    agwa_tracing.stage("Adding the discretization to the map", tweet)
     project = arcpy.mp.ArcGISProject("CURRENT")
     map = project.listMaps()[0]
     map.addDataFromPath(plane_feature_class)
@@ -307,98 +428,120 @@ def assign_ids(discretization_feature_class, channel_feature_class):
     # hillslopes ending in 1 are uplands
     # hillslopes ending in 2 are laterals on the right
     # hillslopes ending in 3 are laterals on the left
-    tweet("Assigning HillslopeID to hillslopes")
+    agwa_tracing.stage("Assigning HillslopeID to hillslopes", tweet)
     hillslope_id_field = "HillslopeID"
     arcpy.management.AddField(discretization_feature_class, hillslope_id_field, "LONG", None, None, None, "", "NULLABLE",
                               "NON_REQUIRED", "")
 
-    fields = ["SHAPE@", "GRIDCODE", "HillslopeID"]
-    with arcpy.da.UpdateCursor(discretization_feature_class, fields) as hillslope_cursor:
+    # Lateral hillslopes have even GRIDCODEs, GRIDCODE / 10 is the grid_code of their channel. Their side of the
+    # channel is found for all of them at once from a label point, which is always inside the polygon.
+    hillslope_oids, hillslope_gridcodes, label_points = [], [], []
+    with arcpy.da.SearchCursor(discretization_feature_class, ["OID@", "GRIDCODE", "SHAPE@"]) as hillslope_cursor:
+        for oid, gridcode, shape in hillslope_cursor:
+            if gridcode % 2 == 0:
+                hillslope_oids.append(oid)
+                hillslope_gridcodes.append(gridcode)
+                label_points.append((shape.labelPoint.X, shape.labelPoint.Y))
+
+    channel_vertices = read_channel_vertices(channel_feature_class)
+    on_right = hillslopes_on_right(channel_vertices, [gridcode // 10 for gridcode in hillslope_gridcodes],
+                                   np.array(label_points, dtype=np.float64).reshape(-1, 2))
+    # hillslopes ending in 2 are on the right of the channel looking downstream, 3 on the left
+    hillslope_ids = {oid: (gridcode + 2 if right else gridcode + 3)
+                     for oid, gridcode, right in zip(hillslope_oids, hillslope_gridcodes, on_right)
+                     if right is not None}
+
+    with arcpy.da.UpdateCursor(discretization_feature_class, ["OID@", "GRIDCODE", "HillslopeID"]) as hillslope_cursor:
         for hillslope_row in hillslope_cursor:
             if hillslope_row[1] % 2 == 1:
                 hillslope_row[2] = hillslope_row[1]
             else:
-                hillslope_poly = hillslope_row[0]
-                hillslope_gridcode = hillslope_row[1]
-                stream_gridcode = hillslope_gridcode / 10
-                expression = "{0} = {1}".format(arcpy.AddFieldDelimiters(arcpy.env.workspace, "grid_code"),
-                                                stream_gridcode)
-                with arcpy.da.SearchCursor(channel_feature_class, "SHAPE@", expression) as channel_cursor:
-                    for channel_row in channel_cursor:
-                        stream_line = channel_row[0]
-                        stream_part = stream_line.getPart(0)
-                        if stream_part.count > 3:
-                            start_point = stream_part[1]
-                            end_point = stream_part[2]
-                        else:
-                            start_point = stream_line.positionAlongLine(0.49, True).getPart(0)
-                            end_point = stream_line.positionAlongLine(0.51, True).getPart(0)
-
-                        start_tpl = (start_point.X, start_point.Y)
-                        end_tpl = (end_point.X, end_point.Y)
-                        midpoint = ((start_tpl[0] + end_tpl[0]) / 2, (start_tpl[1] + end_tpl[1]) / 2)
-
-                        if start_tpl[0] == end_tpl[0]:
-                            # vertical line
-                            int_tpl = tuple(item1 + item2 for item1, item2 in zip(midpoint, (1, 0)))
-                        elif start_tpl[1] == end_tpl[1]:
-                            # horizontal line
-                            int_tpl = tuple(item1 + item2 for item1, item2 in zip(midpoint, (0, 1)))
-                        else:
-                            # normal slope
-                            slope = (end_tpl[1] - start_tpl[1]) / (end_tpl[0] - start_tpl[0])
-                            slope_perp_bisector = -1 / slope
-                            intercept_bisector = slope_perp_bisector * (-1) * midpoint[0] + midpoint[1]
-                            int_x = midpoint[0] + 1
-                            int_y = slope_perp_bisector * int_x + intercept_bisector
-                            int_tpl = (int_x, int_y)
-
-                        # the intersection point is calculated from the stream of derived from the polygon
-                        # so using the cross product will always return the same result on the same side of the
-                        # line
-                        # a = np.array([start_tpl[0] - int_tpl[0], start_tpl[1] - int_tpl[1], 0])
-                        # b = np.array([end_tpl[0] - int_tpl[0], end_tpl[1] - int_tpl[1], 0])
-                        # c = np.cross(a, b)
-                        # if c[2] > 0:
-                        #     print("Side is left")
-                        #     hillslope_row[2] = hillslope_gridcode + 3
-                        # else:
-                        #     print("Side is right")
-                        #     hillslope_row[2] = hillslope_gridcode + 2
-                        # print(c)
-
-                        # The intersection point is calculated to always be on the right side of the stream
-                        # so if the hillslope polygon contains it, the polygon is on the right side of the stream too
-                        pg = arcpy.PointGeometry(arcpy.Point(int_tpl[0], int_tpl[1]), hillslope_poly.spatialReference)
-                        result = stream_line.queryPointAndDistance(pg)
-                        (point, dist_along_line, dist_to_point, on_right) = result
-                        if on_right:
-                            # intersection point is on right side of line
-                            # if hillslope_poly contains the point, it is also on the right side of the line
-                            # else it"s on the left side of the line
-                            if hillslope_poly.contains(pg):
-                                hillslope_row[2] = hillslope_gridcode + 2
-                            else:
-                                hillslope_row[2] = hillslope_gridcode + 3
-                        else:
-                            # intersection point is on left side of line
-                            # if hillslope_poly contains the point, it is also on the left side of the line
-                            # else it"s on the right side of the line
-                            if hillslope_poly.contains(pg):
-                                hillslope_row[2] = hillslope_gridcode + 3
-                            else:
-                                hillslope_row[2] = hillslope_gridcode + 2
-
+                hillslope_row[2] = hillslope_ids.get(hillslope_row[0])
             hillslope_cursor.updateRow(hillslope_row)
 
     # Assign the ChannelID to each stream in the channels feature class
-    tweet("Assigning ChannelID to channels")
+    agwa_tracing.stage("Assigning ChannelID to channels", tweet)
     channel_id_field = "ChannelID"
     arcpy.management.AddField(channel_feature_class, channel_id_field, "LONG", None, None, None, "", "NULLABLE",
                               "NON_REQUIRED", "")
     arcpy.management.CalculateField(channel_feature_class, channel_id_field, "(!grid_code! * 10) + 4", "PYTHON3")
 
 
+def read_channel_vertices(channel_feature_class):
+    """Read the vertices of all channels in one pass. Returns a dictionary of grid_code -> (first, last) positions of
+    the channel's vertices in the returned (n, 2) array of vertex coordinates, in digitized (downstream) order."""
+
+    vertices = arcpy.da.FeatureClassToNumPyArray(channel_feature_class, ["OID@", "grid_code", "SHAPE@X", "SHAPE@Y"],
+                                                 explode_to_points=True)
+    coordinates = np.column_stack([vertices["SHAPE@X"], vertices["SHAPE@Y"]]).astype(np.float64)
+    oids = vertices["OID@"]
+    starts = np.flatnonzero(np.r_[True, oids[1:] != oids[:-1]])
+    ends = np.r_[starts[1:], oids.size]
+    channel_vertices = {int(grid_code): (int(first), int(last))
+                        for grid_code, first, last in zip(vertices["grid_code"][starts], starts, ends)}
+    return channel_vertices, coordinates
+
+
+def hillslopes_on_right(channel_vertices, channel_gridcodes, points):
+    """Return for each point whether it lies on the right of the channel with the corresponding grid_code, looking
+    downstream, or None if the channel does not exist.
+
+    The side is the sign of the cross product of the point against the closest segment of the channel. When the
+    closest point of the channel is a vertex between two segments, the point is on the inner side of the bend only if
+    it is on that side of both segments."""
+
+    vertex_ranges, coordinates = channel_vertices
+    point_count = len(channel_gridcodes)
+    ranges = np.array([vertex_ranges.get(int(gridcode), (0, 0)) for gridcode in channel_gridcodes],
+                      dtype=np.int64).reshape(-1, 2)
+    # segment k of a channel runs from vertex k to vertex k + 1
+    segment_counts = np.maximum(ranges[:, 1] - ranges[:, 0] - 1, 0)
+    on_right = np.zeros(point_count, dtype=bool)
+    found = segment_counts > 0
+    if not found.any():
+        return [None] * point_count
+
+    # one row per (point, segment of its channel)
+    pair_point = np.repeat(np.arange(point_count), segment_counts)
+    pair_offsets = np.cumsum(segment_counts) - segment_counts
+    pair_segment = np.arange(pair_point.size) - np.repeat(pair_offsets, segment_counts)
+    start = coordinates[ranges[pair_point, 0] + pair_segment]
+    end = coordinates[ranges[pair_point, 0] + pair_segment + 1]
+    direction = end - start
+    relative = points[pair_point] - start
+
+    length_squared = np.einsum("ij,ij->i", direction, direction)
+    t = np.clip(np.einsum("ij,ij->i", relative, direction) / np.where(length_squared > 0, length_squared, 1.0),
+                0.0, 1.0)
+    distance_squared = np.einsum("ij,ij->i", relative - t[:, None] * direction, relative - t[:, None] * direction)
+    cross = direction[:, 0] * relative[:, 1] - direction[:, 1] * relative[:, 0]
+
+    # the closest segment of each point; pairs are grouped by point, so the first pair after sorting each group by
+    # distance is the closest one
+    order = np.lexsort((distance_squared, pair_point))
+    closest = order[pair_offsets[found]]
+    points_found = pair_point[closest]
+    right = cross[closest] < 0
+
+    # closest point at a vertex shared with the previous or next segment
+    segment = pair_segment[closest]
+    at_start = (t[closest] == 0.0) & (segment > 0)
+    at_end = (t[closest] == 1.0) & (segment < segment_counts[points_found] - 1)
+    for shared, incoming, outgoing in [(at_start, closest - 1, closest), (at_end, closest, closest + 1)]:
+        if not shared.any():
+            continue
+        incoming, outgoing = incoming[shared], outgoing[shared]
+        turn = direction[incoming, 0] * direction[outgoing, 1] - direction[incoming, 1] * direction[outgoing, 0]
+        right_of_incoming = cross[incoming] < 0
+        right_of_outgoing = cross[outgoing] < 0
+        # a right turn has the right side inside the bend
+        right[shared] = np.where(turn < 0, right_of_incoming & right_of_outgoing,
+                                 right_of_incoming | right_of_outgoing)
+
+    on_right[points_found] = right
+    return [bool(value) if has_channel else None for value, has_channel in zip(on_right, found)]
+
+
 def identify_contributing_channels(workspace, delineation_name, discretization_name, channel_feature_class):
 
     # Identify the contributing channels for each channel
@@ -411,116 +554,78 @@ def identify_contributing_channels(workspace, delineation_name, discretization_n
         for field in contrib_fields:
             arcpy.AddField_management(contributing_channels_table, field, "TEXT")
 
-    channel_fields = ["from_node", "ChannelID"]
-    # expression = "{0} = "{1}" AND {2} = "{3}"".format(arcpy.AddFieldDelimiters(workspace, "to_node"), missing_to_node)
-    with arcpy.da.SearchCursor(channel_feature_class, channel_fields) as channel_cursor:
-        for channel_row in channel_cursor:
-            from_node = channel_row[0]
-            channel_id = channel_row[1]
+    # Join to_node = from_node on one read of the channels and keep the result as a compressed sparse row file
+    channels = arcpy.da.TableToNumPyArray(channel_feature_class, ["ChannelID", "from_node", "to_node"])
+    channel_network = agwa_channel_network.ChannelNetwork.from_nodes(channels["ChannelID"], channels["from_node"],
+                                                                     channels["to_node"])
+    channel_ids_down, channel_ids_up = channel_network.contributing_pairs()
 
-            to_node_field = arcpy.AddFieldDelimiters(workspace, "to_node")
-            inner_expression = "{0} = {1}".format(to_node_field, from_node)
-            with arcpy.da.SearchCursor(channel_feature_class, channel_fields, inner_expression) as inner_channel_cursor:
-                for inner_channel_row in inner_channel_cursor:
-                    inner_channel_id = inner_channel_row[1]
-                    with arcpy.da.InsertCursor(contributing_channels_table, contrib_fields) as contrib_cursor:
-                        contrib_cursor.insertRow((delineation_name, discretization_name, channel_id, inner_channel_id,
-                                                 datetime.datetime.now().isoformat(), "4.0", "4.0", "X"))
+    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
+    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
+    expression = (f"{delineation_name_field} = '{delineation_name}' And "
+                  f"{discretization_name_field} = '{discretization_name}'")
+    with arcpy.da.UpdateCursor(contributing_channels_table, ["DelineationName"], expression) as cursor:
+        for _ in cursor:
+            cursor.deleteRow()
 
+    creation_date = datetime.datetime.now().isoformat()
+    with agwa_table_writer.TableWriter(contributing_channels_table, contrib_fields) as writer:
+        writer.write_rows((delineation_name, discretization_name, str(channel_id_down), str(channel_id_up),
+                           creation_date, "4.0", "4.0", "X")
+                          for channel_id_down, channel_id_up in zip(channel_ids_down.tolist(), channel_ids_up.tolist()))
+
+    channel_network.save(agwa_channel_network.network_path(workspace, delineation_name, discretization_name))
 
 
 def add_internal_pour_points(workspace, delineation_name, discretization_name, internal_pour_points_fc, 
-                             internal_pour_points_snap_distance, facg_gds, stream_grid_gds, stream_link_gds, save_intermediate_outputs):
-    # line 1367 to 1473 ???
-    """ Add internal pour points to the channel network."""
+                             internal_pour_points_snap_distance, facg_gds, frame, stream_links, flow_accumulation):
+    """ Add internal pour points to the channel network. stream_links and flow_accumulation are arrays in frame;
+    the links of all pour points are split in one pass (see agwa_d8.split_stream_links) and the new stream links
+    are returned."""
     
     try:
 
-        facg_raster = arcpy.Raster(facg_gds)
-        
-        # Get fa value at outlet location - option 1: use outlet raster
-        outlet_raster= f"{workspace}/{delineation_name}_outelt"
-        resultRaster = arcpy.sa.Con(outlet_raster, facg_raster)
-        result_max_value = arcpy.GetRasterProperties_management(resultRaster, "MAXIMUM")
-        outlet_facg_value = round(float(result_max_value.getOutput(0)))
-
-
-        # Get fa value at outlet location - option 2: use point featre class, do not work now, use snapped outlet?
-        # outlet_raster= f"{workspace}/{delineation_name}_outelt"
-        # outlet_fc = arcpy.da.FeatureClassToNumPyArray(outlet_feature_class, ["SHAPE@XY"])
-        # for outlet_feature in outlet_fc:
-        #     outlet_point = outlet_feature[0]
-        #     outlet_point_str = f"{outlet_point[0]} {outlet_point[1]}"  # this is not the right x and y???
-        #     outlet_facg_value = round(float(arcpy.management.GetCellValue(facg_raster, outlet_point_str).getOutput(0)))
-            
-        
+        # Get fa value at outlet location from the outlet raster
+        outlet_raster = f"{workspace}/{delineation_name}_outelt"
+        outlet_cells = frame.read_valid(outlet_raster)
+        outlet_facg_value = round(float(flow_accumulation[outlet_cells].max()))
+
         # Snap user input pour points, save as feature class - added by Haiyan
         snapped_pour_points_raster = arcpy.sa.SnapPourPoint(internal_pour_points_fc, facg_gds, float(internal_pour_points_snap_distance))
         snapped_pour_points_raster.save(os.path.join(workspace, f"temp_{discretization_name}_snapped_pour_points"))
         snapped_pour_points_feature_class = os.path.join(workspace, f"temp_snapped_{discretization_name}_pour_points")
         arcpy.RasterToPoint_conversion(snapped_pour_points_raster, snapped_pour_points_feature_class, "VALUE")
-        
-        
-        # Create a raster of the stream grid with the flow accumulation values
-        facg_stream_gds = arcpy.sa.Con(arcpy.Raster(stream_grid_gds), arcpy.Raster(facg_gds))
-        facg_stream_gds.save(f"temp_facgStreamGds_{discretization_name}")
-
-
-        # Loop through the features in the internal pour points feature class
-        with arcpy.da.SearchCursor(snapped_pour_points_feature_class, ["SHAPE@XY"]) as cursor:
-
-            i = 1
-            for row in cursor:
-                tweet(f"Adding internal pour point {i}")
-                
-                point = row[0]
-                point_str = f"{point[0]} {point[1]}"
-                link_value = int(arcpy.management.GetCellValue(stream_link_gds, point_str).getOutput(0))
-                facg_value = round(float(arcpy.management.GetCellValue(facg_raster, point_str).getOutput(0)))
-                # print(link_value, facg_value, outlet_facg_value)
-
-                # Skip the pour point if it"s the outlet
-                if facg_value == outlet_facg_value:
-                    tweet(f"Skipping adding internal pour point {i} because it is at the outlet location")
-                    i += 1
-                    continue
-
-                # Set each link greater than the value of the intersected link to 1, rest is 0
-                upstream_links_gds = arcpy.Raster(stream_link_gds) > link_value
-                save_intermediate_raster(upstream_links_gds, discretization_name, f"temp_upstreamLinksGds_{discretization_name}_{i}",
-                                            workspace, save_intermediate_outputs)
-
-                # Select the link intersected by the pour point
-                intersected_link_gds = arcpy.Raster(stream_link_gds) == link_value
-                save_intermediate_raster(intersected_link_gds, discretization_name, f"temp_intersectedLinkGds_{discretization_name}_{i}",
-                                            workspace, save_intermediate_outputs)
-
-                # Create the link filled with flow accumulation values
-                facg_link_gds = arcpy.sa.Con(arcpy.Raster(intersected_link_gds), arcpy.Raster(facg_gds))
-                save_intermediate_raster(facg_link_gds, discretization_name, f"temp_facgLinkGds_{discretization_name}_{i}",
-                                            workspace, save_intermediate_outputs)
-
-                # Select all cells from the facgLink that are less then (upstream of) the flow accumulation value at the pour point
-                facg_selection_gds = arcpy.Raster(facg_link_gds) < facg_value
-                save_intermediate_raster(facg_selection_gds, discretization_name, f"temp_facgSelectionGds_{discretization_name}_{i}",   
-                                            workspace, save_intermediate_outputs)
-
-                # Make a stream link for this pour point
-                new_link_gds = arcpy.sa.Con(arcpy.sa.IsNull(arcpy.Raster(facg_selection_gds)), 0, arcpy.Raster(facg_selection_gds))
-                save_intermediate_raster(new_link_gds, discretization_name, f"temp_newLinkGds_{discretization_name}_{i}",
-                                         workspace, save_intermediate_outputs)  
-
-                # merge to get the new stream link grid
-                stream_link_gds = arcpy.Raster(stream_link_gds) + arcpy.Raster(upstream_links_gds) + arcpy.Raster(new_link_gds)
-                save_intermediate_raster(stream_link_gds, discretization_name, f"temp_streamLinkGds_{discretization_name}_{i}", 
-                                         workspace, save_intermediate_outputs)                
-                i += 1
-                
-        return stream_link_gds
+
+        # Look up the link and flow accumulation of every snapped pour point
+        points = arcpy.da.FeatureClassToNumPyArray(snapped_pour_points_feature_class, ["SHAPE@X", "SHAPE@Y"])
+        rows, cols, inside = frame.cells(points["SHAPE@X"], points["SHAPE@Y"])
+        rows, cols = rows[inside], cols[inside]
+        point_links = stream_links[rows, cols]
+        point_facg = np.round(flow_accumulation[rows, cols]).astype(np.int64)
+        tweet(f"Adding {points.size} internal pour points")
+
+        # Skip the pour points outside the grid, off the channels, at the outlet, or sharing a cell with another
+        # pour point
+        on_channel = point_links > 0
+        at_outlet = point_facg == outlet_facg_value
+        if (~inside).any():
+            tweet(f"Skipping {(~inside).sum()} internal pour points that are outside the flow accumulation grid")
+        if (~on_channel).any():
+            tweet(f"Skipping {(~on_channel).sum()} internal pour points that are not on a channel")
+        if (on_channel & at_outlet).any():
+            tweet(f"Skipping {(on_channel & at_outlet).sum()} internal pour points at the outlet location")
+        keep = on_channel & ~at_outlet
+        _, unique_index = np.unique(rows[keep] * frame.ncols + cols[keep], return_index=True)
+        point_links = point_links[keep][unique_index]
+        point_facg = point_facg[keep][unique_index]
+
+        new_stream_links = agwa_d8.split_stream_links(stream_links, np.round(flow_accumulation).astype(np.int64),
+                                                      point_links, point_facg)
+        tweet(f"Split {np.unique(point_links).size} stream links at {point_links.size} internal pour points")
+        return new_stream_links
 
     except Exception as e:
-        arcpy.AddError("Error in adding internal pour points: " + str(e))
-        return None
+        raise Exception(f"Error in adding internal pour points: {e}") from e
 
 
 def read_and_extract_parameters(prjgdb, delineation_name, discretization_name):
@@ -553,19 +658,3 @@ def read_and_extract_parameters(prjgdb, delineation_name, discretization_name):
             methodology, threshold_method, threshold_value, existing_channel_network_feature, existing_channel_network_snap_distance,
             channel_inition_points_feature, channel_initiation_points_snap_distance,
             internal_pour_points_method, internal_pour_points_feature, internal_pour_points_snap_distance)
-
-
-def save_intermediate_raster(raster, discretization_name, raster_name, workspace, save_flag):
-    """
-    Saves a raster to a specified workspace if the save flag is True.
-
-    Parameters:
-    - raster: The raster object to save.
-    - filename: The filename for the saved raster.
-    - workspace: The directory where the raster will be saved.
-    - save_flag: A boolean indicating whether to save the raster.
-    """
-    if save_flag:
-        output_path = os.path.join(workspace, f"intermediate_{discretization_name}_{raster_name}")
-        raster.save(output_path)
-        # tweet(f"Saved raster: {output_path}")
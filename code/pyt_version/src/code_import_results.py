@@ -3,8 +3,11 @@ import io
 import arcpy
 import datetime
 import tempfile
+import importlib
 import pandas as pd
 import arcpy.management
+import agwa_tracing
+importlib.reload(agwa_tracing)
 
 def tweet(msg):
     """Produce a message for both arcpy and python    """
@@ -13,12 +16,15 @@ def tweet(msg):
     print(arcpy.GetMessages())
 
 
+@agwa_tracing.traced("Import K2 results", "simulation_abspath", tweet)
 def import_k2_results(delineation_name, discretization_name, parameterization_name, simulation_name, simulation_abspath): 
     
-    tweet(f"    Reading results from output file")
+    agwa_tracing.stage("    Reading results from output file", tweet)
     df_results = read_simulation_results(delineation_name, discretization_name, parameterization_name, simulation_name, simulation_abspath)
+    agwa_tracing.add_rows(len(df_results))
 
-    tweet("    Importing results into table k2_results")
+    agwa_tracing.stage("    Importing results into table k2_results", tweet)
+    agwa_tracing.add_rows(len(df_results))
     sim_name = os.path.split(simulation_abspath)[1]
     results_gdb_abspath = os.path.join(simulation_abspath, f"{sim_name}_results.gdb")
     if arcpy.Exists(results_gdb_abspath):
@@ -140,7 +146,7 @@ def read_tabular_data(filename):
         'Element_ID', 'Element_Type', 'Element_Area_m2', 'Contributing_Area_m2',
         'Inflow_cum', 'Rainfall_cum', 'Outflow_cum',
         'Peak_Flow_mmhr', 'Total_Infil_cum', 'Initial_Water_Content', 'Sediment_Yield_kg']    
-    df = pd.read_csv(io.StringIO(data), delim_whitespace=True, names=column_names)
+    df = pd.read_csv(io.StringIO(data), sep=r"\s+", names=column_names)
     df.loc[df.Element_Type=="Plane", "Element_Type"] = "Hillslope"
     return df
 
@@ -1,11 +1,27 @@
 import arcpy
 import os
+import math
 import datetime
+import importlib
+import numpy as np
 import pandas as pd
 from enum import Enum
 from arcpy._mp import Table
-from collections import deque
 import arcpy.management  # Import statement added to provide intellisense in PyCharm
+import agwa_channel_network
+import agwa_fingerprints
+import agwa_parameter_store
+import agwa_pipeline
+import agwa_table_writer
+import agwa_tracing
+import agwa_zonal_statistics
+importlib.reload(agwa_channel_network)
+importlib.reload(agwa_fingerprints)
+importlib.reload(agwa_parameter_store)
+importlib.reload(agwa_pipeline)
+importlib.reload(agwa_table_writer)
+importlib.reload(agwa_tracing)
+importlib.reload(agwa_zonal_statistics)
 
 arcpy.CheckOutExtension("spatial")
 
@@ -87,98 +103,133 @@ def initialize_workspace(delineation_name, prjgdb, discretization_name, paramete
     map.addTable(table)
 
 
-def parameterize(prjgdb, workspace, delineation_name, discretization, parameterization_name, save_intermediate_outputs):                 
+@agwa_tracing.traced("Parameterize elements", "workspace", tweet)
+def parameterize(prjgdb, workspace, delineation_name, discretization, parameterization_name, save_intermediate_outputs,
+                 max_workers=None):                 
 
     # TODO: Run arcpy.ValidateFieldName to make sure field names are valid for the workspace type
     
-    tweet("Reading parameter values")
+    agwa_tracing.stage("Reading parameter values", tweet)
     (unfilled_dem_raster, slope_raster, aspect_raster, agwa_directory, flow_length_method,
      hydraulic_geometry_relationship) = read_extract_parameters(prjgdb, delineation_name, 
                                                                 discretization, parameterization_name)      
     
     create_parameter_tables(workspace)
 
-    tweet("Populating parameter tables")
+    agwa_tracing.stage("Populating parameter tables", tweet)
     populate_hillslopeids_in_parameter_tables(workspace, delineation_name, discretization, parameterization_name)
 
     # Start AGWA parameterization
     arcpy.env.workspace = workspace
     arcpy.env.overwriteOutput = True
 
-    tweet("Calculating hillslope areas")
-    calculate_hillslope_areas(workspace, delineation_name, discretization, parameterization_name,
-                            save_intermediate_outputs)
+    # steps whose inputs match a previous parameterization of this discretization reuse its outputs
+    discretization_version = agwa_fingerprints.discretization_version(prjgdb, delineation_name, discretization)
+    cache = agwa_fingerprints.StepCache(workspace, delineation_name, discretization, parameterization_name)
+    pipeline = build_parameterization_pipeline(workspace, delineation_name, discretization, parameterization_name,
+                                               unfilled_dem_raster, slope_raster, aspect_raster, agwa_directory,
+                                               flow_length_method, hydraulic_geometry_relationship,
+                                               save_intermediate_outputs, discretization_version, cache)
+    agwa_tracing.stage("Running the parameterization steps", tweet)
+    pipeline.run(max_workers)
 
-    tweet("Calculating mean elevation")
-    calculate_mean_elevation(workspace, delineation_name, discretization, parameterization_name,
-                            unfilled_dem_raster, save_intermediate_outputs)
-
-    tweet("Calculating mean slope")
-    calculate_mean_slope(workspace, delineation_name, discretization, parameterization_name, slope_raster,
-                        save_intermediate_outputs)
-
-    tweet("Calculating mean aspect")
-    calculate_mean_aspect(workspace, delineation_name, discretization, parameterization_name, aspect_raster,
-                        save_intermediate_outputs)
-
-
-    tweet("Calculating mean flow length")
-    calculate_mean_flow_length(workspace, delineation_name, discretization, parameterization_name,
-                            save_intermediate_outputs)
-
-    tweet("Calculating hillslope centroids")
-    calculate_centroids(workspace, delineation_name, discretization, parameterization_name, save_intermediate_outputs)
-
-    tweet("Calculating stream lengths")
-    calculate_stream_length(workspace, delineation_name, discretization, parameterization_name,
-                            save_intermediate_outputs)
-
-    tweet("Calculating hillslope geometries")
-    calculate_geometries(workspace, delineation_name, discretization, parameterization_name, flow_length_method,
-                        save_intermediate_outputs)
-
-    tweet("Calculating stream sequence")
-    calculate_stream_sequence(workspace, delineation_name, discretization, parameterization_name,
-                            save_intermediate_outputs)
-
-    tweet("Calculating contributing areas")
-    calculate_contributing_area_k2(workspace, delineation_name, discretization, parameterization_name,
-                                save_intermediate_outputs)
+    return
 
-    tweet("Calculating stream slopes and centroids")
-    calculate_stream_slope(workspace, delineation_name, discretization, parameterization_name, unfilled_dem_raster,
-                        save_intermediate_outputs)
 
-    tweet("Calculating stream geometries")
-    calculate_stream_geometries(workspace, delineation_name, discretization, parameterization_name,
-                                hydraulic_geometry_relationship, agwa_directory, save_intermediate_outputs)
-
-    return
+def build_parameterization_pipeline(workspace, delineation_name, discretization, parameterization_name,
+                                    unfilled_dem_raster, slope_raster, aspect_raster, agwa_directory,
+                                    flow_length_method, hydraulic_geometry_relationship, save_intermediate_outputs,
+                                    discretization_version=None, cache=None):
+    """Declare the element parameterization steps with the fields they read and write. The hillslope steps and the
+    channel steps only meet at the contributing areas, so the two chains run concurrently. The sources and options
+    of each step make up its fingerprint, so with a cache only the steps whose inputs changed run again."""
+
+    hillslopes = "parameters_hillslopes"
+    channels = "parameters_channels"
+    names = (workspace, delineation_name, discretization, parameterization_name)
+    flow_length_raster = os.path.join(workspace, f"{discretization}_flow_length_downstream")
+    hillslopes_feature_class = os.path.join(workspace, f"{discretization}_hillslopes")
+    channels_feature_class = os.path.join(workspace, f"{discretization}_channels")
+    hgr_table = os.path.join(agwa_directory, "lookup_tables.gdb", "HGR")
+    version = {"discretization": discretization_version}
+
+    # the steps run in spawned workers, which resolve bare dataset names against this workspace
+    pipeline = agwa_pipeline.Pipeline("Element parameterization", tweet, cache,
+                                      environment={"workspace": workspace, "overwriteOutput": True})
+    pipeline.add("Calculating hillslope areas", calculate_hillslope_areas, names + (save_intermediate_outputs,),
+                 inputs=[f"{discretization}_hillslopes"],
+                 outputs=[f"{hillslopes}.Area"],
+                 sources=[hillslopes_feature_class], options=version)
+    pipeline.add("Calculating mean elevation, slope, aspect, and flow length", calculate_hillslope_statistics,
+                 names + (unfilled_dem_raster, slope_raster, aspect_raster, save_intermediate_outputs),
+                 inputs=[f"{discretization}_hillslopes", unfilled_dem_raster, slope_raster, aspect_raster,
+                         flow_length_raster],
+                 outputs=[f"{hillslopes}.MeanElevation", f"{hillslopes}.MeanSlope", f"{hillslopes}.MeanAspect",
+                          f"{hillslopes}.MeanFlowLength"],
+                 sources=[hillslopes_feature_class, unfilled_dem_raster, slope_raster, aspect_raster,
+                          flow_length_raster], options=version)
+    pipeline.add("Calculating hillslope centroids", calculate_centroids, names + (save_intermediate_outputs,),
+                 outputs=[f"{hillslopes}.CentroidX", f"{hillslopes}.CentroidY"],
+                 locks=[f"{discretization}_hillslopes"],
+                 sources=[hillslopes_feature_class], options=version)
+    pipeline.add("Calculating stream lengths", calculate_stream_length, names + (save_intermediate_outputs,),
+                 inputs=[f"{discretization}_channels"],
+                 outputs=[f"{channels}.ChannelLength"],
+                 sources=[channels_feature_class], options=version)
+    pipeline.add("Calculating hillslope geometries", calculate_geometries,
+                 names + (flow_length_method, save_intermediate_outputs),
+                 inputs=[f"{hillslopes}.Area", f"{hillslopes}.MeanFlowLength", f"{channels}.ChannelLength"],
+                 outputs=[f"{hillslopes}.Width", f"{hillslopes}.Length"],
+                 options=dict(version, flow_length_method=flow_length_method))
+    pipeline.add("Loading channel network", agwa_channel_network.ChannelNetwork.from_workspace,
+                 (workspace, delineation_name, discretization),
+                 inputs=[f"{discretization}_channels", "contributing_channels"],
+                 returns="channel_network",
+                 sources=[channels_feature_class], options=version)
+    pipeline.add("Calculating stream sequence", calculate_stream_sequence, names + (save_intermediate_outputs,),
+                 inputs=["channel_network"],
+                 outputs=[f"{channels}.Sequence"],
+                 options=version)
+    pipeline.add("Calculating contributing areas", calculate_contributing_area_k2,
+                 names + (save_intermediate_outputs,),
+                 inputs=["channel_network", f"{hillslopes}.Area"],
+                 outputs=[f"{channels}.LateralArea", f"{channels}.UpstreamArea"],
+                 options=version)
+    pipeline.add("Calculating stream slopes and centroids", calculate_stream_slope,
+                 names + (unfilled_dem_raster, save_intermediate_outputs),
+                 inputs=[unfilled_dem_raster, f"{channels}.ChannelLength"],
+                 outputs=[f"{channels}.CentroidX", f"{channels}.CentroidY", f"{channels}.UpstreamElevation",
+                          f"{channels}.DownstreamElevation", f"{channels}.MeanSlope"],
+                 locks=[f"{discretization}_channels"],
+                 sources=[channels_feature_class, unfilled_dem_raster], options=version)
+    pipeline.add("Calculating stream geometries", calculate_stream_geometries,
+                 names + (hydraulic_geometry_relationship, agwa_directory, save_intermediate_outputs),
+                 inputs=[f"{channels}.UpstreamArea", f"{channels}.LateralArea"],
+                 outputs=[f"{channels}.SideSlope1", f"{channels}.SideSlope2", f"{channels}.UpstreamBankfullDepth",
+                          f"{channels}.DownstreamBankfullDepth", f"{channels}.UpstreamBankfullWidth",
+                          f"{channels}.DownstreamBankfullWidth", f"{channels}.UpstreamBottomWidth",
+                          f"{channels}.DownstreamBottomWidth"],
+                 sources=[hgr_table],
+                 options=dict(version, hydraulic_geometry_relationship=hydraulic_geometry_relationship))
+    for table_name in [hillslopes, channels]:
+        pipeline.add(f"Publishing {table_name} to the parameter store", agwa_parameter_store.publish_parameter_set,
+                     (workspace, table_name, delineation_name, discretization, parameterization_name),
+                     inputs=[table_name] + [name for step in pipeline.steps for name in step.outputs
+                                            if name.startswith(f"{table_name}.")],
+                     outputs=[f"parameter_store.{table_name}"])
+    return pipeline
 
 
 def copy_parameterization(workspace, delineation_name, discretization_name, parameterization_name, previous_parameterization_name):
     """Copy the parameterization from a previous parameterization to a new parameterization. Called from tool_parameterize_elements.
     Note: Element parameterization should always be done before parameterizing the soil and land cover. Therefore, in this function, 
-    we only copy the elemnent parameters."""               
+    we only copy the elemnent parameters.
+    The new parameterization is layered on the previous one in the parameter store, so no rows are duplicated there; it
+    inherits every parameter until its own parameters are written, and it is read through the parameter store."""               
     
-    tables = ["parameters_hillslopes", "parameters_channels"]
-    for table in tables:
-        tweet(f"Copying element parameterameters from {previous_parameterization_name} for {table[11:]}")
-        table_path = arcpy.os.path.join(workspace, table)
-        fields = [f.name for f in arcpy.ListFields(table_path)]
-
-        new_rows = []
-        with arcpy.da.SearchCursor(table_path, fields) as cursor:
-            for row in cursor:
-                if ((row[fields.index('ParameterizationName')] == previous_parameterization_name) and 
-                   (row[fields.index('DelineationName')] == delineation_name) and
-                   (row[fields.index('DiscretizationName')] == discretization_name)):
-                    new_row = list(row)
-                    new_row[fields.index('ParameterizationName')] = parameterization_name
-                    new_rows.append(tuple(new_row))
-        with arcpy.da.InsertCursor(table_path, fields) as cursor:
-            for new_row in new_rows:
-                cursor.insertRow(new_row)
+    tweet(f"Copying element parameters from {previous_parameterization_name} to {parameterization_name}")
+    agwa_parameter_store.layer_parameter_set(workspace, delineation_name, discretization_name,
+                                             previous_parameterization_name, parameterization_name)
 
 
 def calculate_hillslope_areas(workspace, delineation_name, discretization_name, parameterization_name,
@@ -212,152 +263,66 @@ def populate_hillslopeids_in_parameter_tables(workspace, delineation_name, discr
     parameters_hillslopes_table = os.path.join(workspace, "parameters_hillslopes")
     parameters_channels_table = os.path.join(workspace, "parameters_channels")
 
-    hillslopes_fields = ["HillslopeID"]
     parameters_fields = ["DelineationName", "DiscretizationName", "ParameterizationName", "HillslopeID"]
     discretization_feature_class = os.path.join(workspace, f"{discretization_name}_hillslopes")
-    with arcpy.da.SearchCursor(discretization_feature_class, hillslopes_fields) as hillslopes_cursor:
-        for hillslope_row in hillslopes_cursor:
-            hillslope_id = hillslope_row[0]
-            with arcpy.da.InsertCursor(parameters_hillslopes_table, parameters_fields) as parameters_cursor:
-                parameters_cursor.insertRow(
-                    (delineation_name, discretization_name, parameterization_name, hillslope_id))
-
-    channels_fields = ["ChannelID"]
+    with agwa_table_writer.TableWriter(parameters_hillslopes_table, parameters_fields) as writer:
+        with arcpy.da.SearchCursor(discretization_feature_class, ["HillslopeID"]) as hillslopes_cursor:
+            for hillslope_row in hillslopes_cursor:
+                writer.write((delineation_name, discretization_name, parameterization_name, hillslope_row[0]))
+
     parameters_fields = ["DelineationName", "DiscretizationName", "ParameterizationName", "ChannelID"]
     channels_feature_class = os.path.join(workspace, f"{discretization_name}_channels")
-    with arcpy.da.SearchCursor(channels_feature_class, channels_fields) as channels_cursor:
-        for stream_row in channels_cursor:
-            channel_id = stream_row[0]
-            with arcpy.da.InsertCursor(parameters_channels_table, parameters_fields) as parameters_cursor:
-                parameters_cursor.insertRow((delineation_name, discretization_name, parameterization_name,
-                                             channel_id))
+    with agwa_table_writer.TableWriter(parameters_channels_table, parameters_fields) as writer:
+        with arcpy.da.SearchCursor(channels_feature_class, ["ChannelID"]) as channels_cursor:
+            for stream_row in channels_cursor:
+                writer.write((delineation_name, discretization_name, parameterization_name, stream_row[0]))
 
 
-def calculate_mean_elevation(workspace, delineation_name, discretization_name, parameterization_name, dem_raster,
-                            save_intermediate_outputs):
-    
-    """ Calculate the mean elevation of each hillslope in the discretization feature class and
-        populate the parameters_hillslopes table. """
+def calculate_hillslope_statistics(workspace, delineation_name, discretization_name, parameterization_name,
+                                   dem_raster, slope_raster, aspect_raster, save_intermediate_outputs):
+    """Calculate the mean elevation, slope, aspect, and flow length of each hillslope and populate the
+    parameters_hillslopes table. The hillslopes are rasterized once and all four value rasters are read block by
+    block in a single pass, so the zonal statistics, joins, and field calculations are done once instead of four
+    times. Aspect is averaged as a circular mean."""
 
     arcpy.env.workspace = workspace
 
     parameters_hillslopes_table = os.path.join(workspace, "parameters_hillslopes")
     discretization_feature_class = os.path.join(workspace, f"{discretization_name}_hillslopes")
-    zone_field = "HillslopeID"
-    value_raster = dem_raster
-    zonal_table = f"intermediate_{discretization_name}_meanElevation"
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, 
-                                    "DATA", "MEAN")
+    flow_length_down_raster = os.path.join(workspace, f"{discretization_name}_flow_length_downstream")
+
+    # rasterize the hillslopes on the DEM grid so every value raster can be read with the same blocks
+    zone_raster = os.path.join(workspace, f"intermediate_{discretization_name}_hillslope_zones")
+    with arcpy.EnvManager(snapRaster=dem_raster, cellSize=dem_raster, extent=discretization_feature_class):
+        arcpy.conversion.PolygonToRaster(discretization_feature_class, "HillslopeID", zone_raster, "CELL_CENTER")
+
+    hillslope_ids = [row[0] for row in arcpy.da.SearchCursor(discretization_feature_class, ["HillslopeID"])]
+    value_rasters = {"MeanElevation": dem_raster,
+                     "MeanSlope": slope_raster,
+                     "MeanAspect": aspect_raster,
+                     "MeanFlowLength": flow_length_down_raster}
+    statistics = agwa_zonal_statistics.zonal_statistics(zone_raster, hillslope_ids, value_rasters,
+                                                        circular_rasters=["MeanAspect"])
+    means = {hillslope_id: [statistics[field]["MEAN"][i] for field in value_rasters]
+             for i, hillslope_id in enumerate(hillslope_ids)}
 
-    table_view = "parameters_hillslopes"
     delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
     discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
     parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
     expression = (f"{delineation_name_field} = '{delineation_name}' And "
                   f"{discretization_name_field} = '{discretization_name}' And "
                   f"{parameterization_name_field} = '{parameterization_name}'")
-
-    arcpy.management.MakeTableView(parameters_hillslopes_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "HillslopeID", zonal_table, "HillslopeID")
-    mean_elevation_field = f"{table_view}.MeanElevation"
-    zonal_mean_field = f"!{zonal_table}.MEAN!"
-    arcpy.management.CalculateField(table_view, mean_elevation_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
-
-    if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
-
-
-def calculate_mean_slope(workspace, delineation_name, discretization_name, parameterization_name, slope_raster,
-                        save_intermediate_outputs):
-    parameters_hillslopes_table = os.path.join(workspace, "parameters_hillslopes")
-    discretization_feature_class = os.path.join(workspace, "{}_hillslopes".format(discretization_name))
-    zone_field = "HillslopeID"
-    value_raster = slope_raster
-    zonal_table = "intermediate_{}_meanSlope".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
-
-    table_view = "parameters_hillslopes"
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                    discretization_name_field,
-                                                                    discretization_name,
-                                                                    parameterization_name_field,
-                                                                    parameterization_name)
-    arcpy.management.MakeTableView(parameters_hillslopes_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "HillslopeID", zonal_table, "HillslopeID")
-    mean_slope_field = "{}.MeanSlope".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_slope_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
-
-    if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
-
-
-def calculate_mean_aspect(workspace, delineation_name, discretization_name, parameterization_name, aspect_raster,
-                        save_intermediate_outputs):
-    parameters_hillslopes_table = os.path.join(workspace, "parameters_hillslopes")
-    discretization_feature_class = os.path.join(workspace, "{}_hillslopes".format(discretization_name))
-    zone_field = "HillslopeID"
-    value_raster = aspect_raster
-    zonal_table = "intermediate_{}_meanAspect".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
-
-    table_view = "parameters_hillslopes"
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                    discretization_name_field,
-                                                                    discretization_name,
-                                                                    parameterization_name_field,
-                                                                    parameterization_name)
-    arcpy.management.MakeTableView(parameters_hillslopes_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "HillslopeID", zonal_table, "HillslopeID")
-    mean_aspect_field = "{}.MeanAspect".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_aspect_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
-
-    if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
-
-
-def calculate_mean_flow_length(workspace, delineation_name, discretization_name, parameterization_name,
-                            save_intermediate_outputs):
-
-    parameters_hillslopes_table = os.path.join(workspace, "parameters_hillslopes")
-    discretization_feature_class = os.path.join(workspace, "{}_hillslopes".format(discretization_name))
-    flow_length_down_raster = os.path.join(workspace, "{}_flow_length_downstream".format(discretization_name))
-    zone_field = "HillslopeID"
-    value_raster = flow_length_down_raster
-    zonal_table = "intermediate_{}_mean_flow_length_downstream".format(discretization_name)
-    arcpy.sa.ZonalStatisticsAsTable(discretization_feature_class, zone_field, value_raster, zonal_table, "DATA",
-                                    "MEAN")
-
-    table_view = "parameters_hillslopes"
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'".format(delineation_name_field, delineation_name,
-                                                                    discretization_name_field,
-                                                                    discretization_name,
-                                                                    parameterization_name_field,
-                                                                    parameterization_name)
-    arcpy.management.MakeTableView(parameters_hillslopes_table, table_view, expression)
-    arcpy.management.AddJoin(table_view, "HillslopeID", zonal_table, "HillslopeID")
-    mean_flow_length_field = "{}.MeanFlowLength".format(table_view)
-    zonal_mean_field = "!{}.MEAN!".format(zonal_table)
-    arcpy.management.CalculateField(table_view, mean_flow_length_field, zonal_mean_field)
-    arcpy.management.RemoveJoin(table_view, zonal_table)
+    fields = ["HillslopeID"] + list(value_rasters)
+    with arcpy.da.UpdateCursor(parameters_hillslopes_table, fields, expression) as cursor:
+        for row in cursor:
+            values = means.get(row[0])
+            if values is None:
+                continue
+            row[1:] = [None if math.isnan(value) else float(value) for value in values]
+            cursor.updateRow(row)
 
     if not save_intermediate_outputs:
-        arcpy.Delete_management(zonal_table)
+        arcpy.Delete_management(zone_raster)
 
 
 def calculate_centroids(workspace, delineation_name, discretization_name, parameterization_name,
@@ -492,12 +457,11 @@ def calculate_stream_length(workspace, delineation_name, discretization_name, pa
 
 
 def calculate_stream_sequence(workspace, delineation_name, discretization_name, parameterization_name,
-                            save_intermediate_outputs):    
+                            save_intermediate_outputs, channel_network=None):
     """
     Calculates and assigns a sequence number to each stream segment within a watershed based on hydrological flow paths. 
-    The process involves identifying the watershed outlet from the discretization nodes feature class, marking it with 
-    the highest sequence number. The function then iterates through the network of channels, assigning sequence numbers 
-    in a manner that reflects the natural flow of water from upstream to downstream within the watershed.
+    The channel network is traversed from the watershed outlet in post-order, so every channel is numbered after all
+    channels upstream of it and the outlet stream receives the highest sequence number.
 
     Args:
         workspace (str): The file path to the workspace directory where the feature classes are located.
@@ -505,227 +469,100 @@ def calculate_stream_sequence(workspace, delineation_name, discretization_name,
         discretization_name (str): The name of the discretization layer containing the stream segments to be sequenced.
         parameterization_name (str): The name associated with the specific parameterization of the channels.
         save_intermediate_outputs (bool): A flag indicating whether to save intermediate outputs generated during the process.
+        channel_network (ChannelNetwork): The channel topology of the discretization. Loaded from the
+            'contributing_channels' table and the channels feature class if not provided.
 
     The final sequence numbers are saved in a table named 'parameters_channels', with the outlet stream having the highest 
     sequence number. This table is part of the provided workspace and is used for further hydrological analysis and modeling.
-
-    Note:
-        - The function assumes the existence of 'contributing_channels' table which maps channels to their contributing upstream channels.
-        - Intermediate outputs are optional and controlled by the 'save_intermediate_outputs' flag.
     """
 
-    # Identify outlet using node_type = 'outlet'
-    discretization_nodes = f"{discretization_name}_nodes"
-    nodes_feature_class = os.path.join(workspace, discretization_nodes)
-    node_type_field = arcpy.AddFieldDelimiters(workspace, "node_type")
-    expression = f"{node_type_field} = 'outlet'"
-    fields = ["arcid", "grid_code", "from_node", "to_node"]   
-    attdict = {}
-    with arcpy.da.SearchCursor(nodes_feature_class, fields, expression) as nodes_cursor:
-        for nodes_row in nodes_cursor:
-            attdict["outlet"] = dict(zip(nodes_cursor.fields, nodes_row))
-
-    arcid_field = arcpy.AddFieldDelimiters(workspace, "arcid")
-    grid_code_field = arcpy.AddFieldDelimiters(workspace, "grid_code")
-    from_node_field = arcpy.AddFieldDelimiters(workspace, "from_node")
-    to_node_field = arcpy.AddFieldDelimiters(workspace, "to_node")
-
-    expression = (f"{arcid_field} = {attdict['outlet']['arcid']} And "
-            f"{grid_code_field} = {attdict['outlet']['grid_code']} And "
-            f"{from_node_field} = {attdict['outlet']['from_node']} And "
-            f"{to_node_field} = {attdict['outlet']['to_node']}")
-    
-    discretization_channels = f"{discretization_name}_channels"
-    channels_feature_class = os.path.join(workspace, discretization_channels)
-    channel_count = int(arcpy.management.GetCount(channels_feature_class).getOutput(0))
-    fields = ["ChannelID"]
-    channel_id = None
-    with arcpy.da.SearchCursor(channels_feature_class, fields, expression) as channels_cursor:
-        for channels_row in channels_cursor:
-            channel_id = channels_row[0]
-
-    contributing_channels_table_name = "contributing_channels"
-    contributing_channels_table = os.path.join(workspace, contributing_channels_table_name)
+    if channel_network is None:
+        channel_network = agwa_channel_network.ChannelNetwork.from_workspace(workspace, delineation_name,
+                                                                             discretization_name)
+
+    channel_ids = channel_network.channel_ids[channel_network.sequence()]
+    sequences = {int(channel_id): sequence for sequence, channel_id in enumerate(channel_ids, start=1)}
+
+    parameters_channels_table = os.path.join(workspace, "parameters_channels")
     delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
     discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    expression = (f"{delineation_name_field} = '{delineation_name}' And "
-                f"{discretization_name_field} = '{discretization_name}'")
-    
-    contrib_table_view = f"{contributing_channels_table_name}_tableview"
-    arcpy.management.MakeTableView(contributing_channels_table, contrib_table_view, expression)
-    channel_id_field = arcpy.AddFieldDelimiters(workspace, "ChannelID")
-
-    # Query for stream outlet and push on to unprocessedStack
-    # While unprocessedStack is not empty
-    #   peek at unprocessedStack to get streamID
-    #   If channelsList has current streamID
-    #       push stream ID on to processedStack
-    #   Add streamID to channelsList
-    #   query for channels contributing to streamID
-    #       If no contributing channels
-    #           push top of unprocessedStack onto processedStack
-    #       while contributing channels
-    #           push contributing stream onto unProcessedStack
-
-    fields = ["ContributingChannel"]
-    unprocessed_stack = deque()
-    unprocessed_stack.append(channel_id)
-    processed_stack = deque()
-    channels_list = []
-    while unprocessed_stack:
-        channel_id = unprocessed_stack[-1]
-        if channel_id in channels_list:
-            processed_stream = unprocessed_stack.pop()
-            processed_stack.append(processed_stream)
-            continue
-
-        channels_list.append(channel_id)
-
-        expression = f"{channel_id_field} = '{channel_id}'"
-        with arcpy.da.SearchCursor(contrib_table_view, fields, expression) as contrib_cursor:
-            contrib_row = None
-            for contrib_row in contrib_cursor:
-                contributing_channel_id = contrib_row[0]
-                unprocessed_stack.append(contributing_channel_id)
-            if contrib_row is None:
-                # No contributing channels so add to the processed stack
-                processed_stream = unprocessed_stack.pop()
-                processed_stack.append(processed_stream)
-
-    # The processed_stack is now in order with the watershed outlet stream at the top of the stack
-    table_name = "parameters_channels"
-    parameters_channels_table = os.path.join(workspace, table_name)
     parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    fields = ["Sequence"]
-    for sequence in range(1, channel_count+1):
-        channel_id = processed_stack.popleft()
-        expression = (f"{parameterization_name_field} = '{parameterization_name}' And "
-                      f"{channel_id_field} = {int(channel_id)}")
-        with arcpy.da.UpdateCursor(parameters_channels_table, fields, expression) as cursor:
-            for row in cursor:
-                row[0] = sequence
+    expression = (f"{delineation_name_field} = '{delineation_name}' And "
+                  f"{discretization_name_field} = '{discretization_name}' And "
+                  f"{parameterization_name_field} = '{parameterization_name}'")
+    with arcpy.da.UpdateCursor(parameters_channels_table, ["ChannelID", "Sequence"], expression) as cursor:
+        for row in cursor:
+            sequence = sequences.get(row[0])
+            if sequence is not None:
+                row[1] = sequence
                 cursor.updateRow(row)
 
-    arcpy.management.Delete(contrib_table_view)
-
 
 def calculate_contributing_area_k2(workspace, delineation_name, discretization_name, parameterization_name,
-                                save_intermediate_outputs):
-    # TODO: Replace function comments with docstring style comments
-    # Calculate contributing areas by starting at the top of the watershed
-    # and moving towards the outlet
-    # Iterate through parameters_channels by sequence number
-    # This results in the headwater areas being calculated first
-    # so moving towards the outlet the upstream contributing areas
-    # can be added
-    # you are here line 665, invalid SQL expression, likely wrong data type
-    parameters_channels_table_name = "parameters_channels"
-    parameters_channels_table = os.path.join(workspace, parameters_channels_table_name)
-    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
-    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'". \
-        format(delineation_name_field, delineation_name,
-            discretization_name_field, discretization_name,
-            parameterization_name_field, parameterization_name)
-    parameters_channels_table_view = "{}_tableview".format(parameters_channels_table)
-    arcpy.management.MakeTableView(parameters_channels_table, parameters_channels_table_view, expression)
-    channel_count = int(arcpy.management.GetCount(parameters_channels_table_view).getOutput(0))
+                                save_intermediate_outputs, channel_network=None):
+    """Calculate the lateral and upstream contributing areas of each channel and populate the parameters_channels
+    table. The lateral area of a channel is the area of its left and right hillslopes. The upstream area is the area
+    of its headwater hillslope if it has one, otherwise the sum of the lateral and upstream areas of its contributing
+    channels. Hillslope areas are read once and accumulated in a single sweep in stream sequence order, so all
+    channels upstream of a channel are finished before the channel itself."""
+
+    if channel_network is None:
+        channel_network = agwa_channel_network.ChannelNetwork.from_workspace(workspace, delineation_name,
+                                                                             discretization_name)
 
-    parameters_hillslopes_table_name = "parameters_hillslopes"
-    parameters_hillslopes_table = os.path.join(workspace, parameters_hillslopes_table_name)
-    expression = "{0} = '{1}' And {2} = '{3}' And {4} = '{5}'". \
-        format(delineation_name_field, delineation_name,
-            discretization_name_field, discretization_name,
-            parameterization_name_field, parameterization_name)
-    parameters_hillslopes_table_view = "{}_tableview".format(parameters_hillslopes_table)
-    arcpy.management.MakeTableView(parameters_hillslopes_table, parameters_hillslopes_table_view, expression)
-
-    contributing_channels_table_name = "contributing_channels"
-    contributing_channels_table = os.path.join(workspace, contributing_channels_table_name)
     delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
     discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
-    expression = "{0} = '{1}' And {2} = '{3}'".format(delineation_name_field, delineation_name,
-                                                    discretization_name_field, discretization_name)
-    contrib_table_view = "{}_tableview".format(contributing_channels_table_name)
-    arcpy.management.MakeTableView(contributing_channels_table, contrib_table_view, expression)
+    parameterization_name_field = arcpy.AddFieldDelimiters(workspace, "ParameterizationName")
+    expression = (f"{delineation_name_field} = '{delineation_name}' And "
+                  f"{discretization_name_field} = '{discretization_name}' And "
+                  f"{parameterization_name_field} = '{parameterization_name}'")
 
-    channel_id_field = arcpy.AddFieldDelimiters(workspace, "ChannelID")
-    sequence_field = arcpy.AddFieldDelimiters(workspace, "Sequence")
-    hillslope_id_field = arcpy.AddFieldDelimiters(workspace, "HillslopeID")
-    fields_cursor1 = ["ChannelID", "LateralArea", "UpstreamArea"]
-    fields_cursor2 = ["Area"]
-    fields_cursor3 = ["ContributingChannel"]
-    fields_cursor4 = ["LateralArea", "UpstreamArea"]
-    for sequence in range(1, channel_count + 1):
-        expression = "{0} = {1}".format(sequence_field, sequence)
-        with arcpy.da.UpdateCursor(parameters_channels_table_view, fields_cursor1, expression) as cursor:
-            for row in cursor:
-                channel_id = row[0]
-                left_lateral_id = channel_id - 1
-                right_lateral_id = channel_id - 2
-                headwater_id = channel_id - 3
-
-                lateral_area = 0
-                headwater_area = None
-                upstream_area = None
-
-                # Determine lateral_area
-                expression = "{0} = '{1}' And " \
-                            "{2} = '{3}' And " \
-                            "{4} = '{5}' And " \
-                            "{6} = {7} Or " \
-                            "{8} = {9}".format(delineation_name_field, delineation_name,
-                                                discretization_name_field, discretization_name,
-                                                parameterization_name_field, parameterization_name,
-                                                hillslope_id_field, left_lateral_id,
-                                                hillslope_id_field, right_lateral_id)
-
-                with arcpy.da.SearchCursor(parameters_hillslopes_table_view, fields_cursor2,
-                                        expression) as hillslopes_cursor:
-                    for hillslope_row in hillslopes_cursor:
-                        # print("lateral area: ", str(hillslope_row[0]))
-                        lateral_area += hillslope_row[0]
-                # Determine headwater_area
-                expression = "{0} = '{1}' And " \
-                            "{2} = '{3}' And " \
-                            "{4} = '{5}' And " \
-                            "{6} = {7}".format(delineation_name_field, delineation_name,
-                                                discretization_name_field, discretization_name,
-                                                parameterization_name_field, parameterization_name,
-                                                hillslope_id_field, headwater_id)
-                with arcpy.da.SearchCursor(parameters_hillslopes_table_view, fields_cursor2,
-                                        expression) as hillslopes_cursor:
-                    for hillslope_row in hillslopes_cursor:
-                        # print("headwater area: ", str(hillslope_row[0]))
-                        headwater_area = hillslope_row[0]
-
-                # Determine upstream_area
-                if headwater_area is None:
-                    expression = "{0} = '{1}'".format(channel_id_field, channel_id)
-                    expression2 = ""
-                    with arcpy.da.SearchCursor(contrib_table_view, fields_cursor3, expression) as contrib_cursor:
-                        for contrib_row in contrib_cursor:
-                            expression2 += "{0} = {1} Or ".format(channel_id_field, contrib_row[0])
-
-                    expression2 = expression2[:-4]
-                    upstream_area = 0
-                    with arcpy.da.SearchCursor(parameters_channels_table_view, fields_cursor4, expression2) as \
-                            contrib_cursor:
-                        for contrib_row in contrib_cursor:
-                            upstream_area += contrib_row[0] + contrib_row[1]
-
-                row[1] = lateral_area
-                if headwater_area:
-                    row[2] = headwater_area
-                elif upstream_area:
-                    row[2] = upstream_area
+    parameters_hillslopes_table = os.path.join(workspace, "parameters_hillslopes")
+    hillslopes = arcpy.da.TableToNumPyArray(parameters_hillslopes_table, ["HillslopeID", "Area"], expression,
+                                            null_value={"Area": 0})
+    lateral_area, upstream_area = accumulate_contributing_areas(channel_network, hillslopes["HillslopeID"],
+                                                                hillslopes["Area"])
 
+    areas = {int(channel_id): (float(lateral), float(upstream))
+             for channel_id, lateral, upstream in zip(channel_network.channel_ids, lateral_area, upstream_area)}
+    parameters_channels_table = os.path.join(workspace, "parameters_channels")
+    with arcpy.da.UpdateCursor(parameters_channels_table, ["ChannelID", "LateralArea", "UpstreamArea"],
+                               expression) as cursor:
+        for row in cursor:
+            channel_areas = areas.get(row[0])
+            if channel_areas is not None:
+                row[1], row[2] = channel_areas
                 cursor.updateRow(row)
 
-    arcpy.management.Delete(contrib_table_view)
-    arcpy.management.Delete(parameters_channels_table_view)
-    arcpy.management.Delete(parameters_hillslopes_table_view)
+
+def accumulate_contributing_areas(channel_network, hillslope_ids, hillslope_areas):
+    """Return the lateral and upstream contributing areas of the channels of channel_network, in its channel order,
+    from the ids and areas of the hillslopes. Called in calculate_contributing_area_k2."""
+
+    hillslope_order = np.argsort(hillslope_ids)
+    hillslope_ids = np.asarray(hillslope_ids)[hillslope_order].astype(np.int64)
+    hillslope_areas = np.asarray(hillslope_areas)[hillslope_order].astype(np.float64)
+
+    def lookup_areas(ids):
+        """Return the areas of the hillslopes with the given ids, NaN where the hillslope does not exist."""
+        if hillslope_ids.size == 0:
+            return np.full(ids.shape, np.nan)
+        position = np.minimum(np.searchsorted(hillslope_ids, ids), hillslope_ids.size - 1)
+        return np.where(hillslope_ids[position] == ids, hillslope_areas[position], np.nan)
+
+    channel_ids = channel_network.channel_ids
+    lateral_area = np.nan_to_num(lookup_areas(channel_ids - 1)) + np.nan_to_num(lookup_areas(channel_ids - 2))
+    headwater_area = lookup_areas(channel_ids - 3)
+    has_headwater = ~np.isnan(headwater_area)
+
+    upstream_area = np.where(has_headwater, headwater_area, 0.0)
+    downstream = channel_network.downstream.tolist()
+    for position in channel_network.sequence().tolist():
+        receiving_channel = downstream[position]
+        if receiving_channel >= 0 and not has_headwater[receiving_channel]:
+            upstream_area[receiving_channel] += lateral_area[position] + upstream_area[position]
+
+    return lateral_area, upstream_area
 
 
 def calculate_stream_slope(workspace, delineation_name, discretization_name, parameterization_name, dem_raster,
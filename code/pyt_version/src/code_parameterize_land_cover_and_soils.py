@@ -1,14 +1,31 @@
 import os
-import math
 import arcpy
 import tempfile
 import arcpy.analysis
 import numpy as np
 import pandas as pd
+import importlib
 from datetime import datetime
+import agwa_tracing
+import agwa_fingerprints
+import agwa_parameter_store
+import agwa_zonal_statistics
+import agwa_weighting
+import agwa_soil_parameter_cache
+importlib.reload(agwa_tracing)
+importlib.reload(agwa_fingerprints)
+importlib.reload(agwa_parameter_store)
+importlib.reload(agwa_zonal_statistics)
+importlib.reload(agwa_weighting)
+importlib.reload(agwa_soil_parameter_cache)
 
 t0 = datetime.now()
 
+HILLSLOPES_STEP = "Hillslope soil and land cover parameters"
+CHANNELS_STEP = "Channel soil and land cover parameters"
+# folder of the AGWA directory holding the compiled soil parameters of soils databases
+SOIL_PARAMETERS_FOLDER = "soil_parameters"
+
 def tweet(msg):
     """Produce a message for both arcpy and python"""
     m = "\n{}\n".format(msg)
@@ -48,6 +65,7 @@ def initialize_workspace(delineation_name, discretization_name, parameterization
                 cursor.updateRow(row)
 
 
+@agwa_tracing.traced("Parameterize land cover and soils", "workspace", tweet)
 def parameterize(prjgdb, workspace, delineation_name, discretization_name, parameterization_name, save_intermediate_outputs):
 
     """Parameterize land cover and soils for each hillslope and channel in the watershed. main function.
@@ -55,70 +73,120 @@ def parameterize(prjgdb, workspace, delineation_name, discretization_name, param
     intersect_weight_land_cover_by_area, parameterize_channels"""
 
     # Step 1. Extract parameters from the metadata tables 
+    agwa_tracing.stage("Reading parameters from metadata", tweet)
     (max_thickness, max_horizons, land_cover, land_cover_lut, soil_feature_class_path, soils_database_path, 
      AGWA_directory, channel_type) = extract_parameters(prjgdb, delineation_name, discretization_name, parameterization_name)  
     
     
+    # Fingerprints of the inputs of steps 2 and 3. A step whose fingerprint matches a previous parameterization of 
+    # this discretization reuses that parameterization's results instead of running again.
+    registry = agwa_fingerprints.FingerprintRegistry.for_workspace(workspace)
+    discretization_version = agwa_fingerprints.discretization_version(prjgdb, delineation_name, discretization_name)
+    lookup_tables = os.path.join(AGWA_directory, "lookup_tables.gdb")
+    hillslopes_fingerprint = registry.fingerprint(
+        [soil_feature_class_path, soils_database_path, land_cover, os.path.join(lookup_tables, land_cover_lut),
+         os.path.join(lookup_tables, "kin_lut")],
+        {"step": HILLSLOPES_STEP, "discretization": discretization_version, "max_thickness": max_thickness,
+         "max_horizons": max_horizons})
+    channels_fingerprint = registry.fingerprint(
+        [os.path.join(lookup_tables, "channel_types")],
+        {"step": CHANNELS_STEP, "discretization": discretization_version, "channel_type": channel_type,
+         "hillslopes": hillslopes_fingerprint})
+
     # Step 2. Get weighted soils and land cover. Merge with other hillslope parameters (17 or 33 parameters)
-    df_hillslope_parameters = parameterize_hillslopes(workspace, delineation_name, discretization_name, parameterization_name, 
-                                                      soil_feature_class_path, soils_database_path, AGWA_directory,
-                                                      max_thickness, max_horizons, land_cover, land_cover_lut, 
-                                                      save_intermediate_outputs)
+    agwa_tracing.stage("Parameterizing hillslope soils and land cover", tweet)
+    record = registry.find(delineation_name, discretization_name, HILLSLOPES_STEP, hillslopes_fingerprint,
+                           exclude=parameterization_name)
+    if record is None:
+        df_soil_cover = calculate_hillslope_soil_and_land_cover(workspace, delineation_name, discretization_name,
+                                                                parameterization_name, soil_feature_class_path,
+                                                                soils_database_path, AGWA_directory, max_thickness,
+                                                                max_horizons, land_cover, land_cover_lut,
+                                                                save_intermediate_outputs)
+    else:
+        tweet(f"Soil and land cover inputs unchanged, reusing the hillslope parameters of {record['ParameterizationName']}")
+        df_soil_cover = registry.read_fields(workspace, record)["parameters_hillslopes"]
+    df_hillslope_parameters = parameterize_hillslopes(workspace, delineation_name, discretization_name,
+                                                      parameterization_name, df_soil_cover)
+
     # Step 3. Get channel elements
-    df_channel_parameters = parameterize_channels(workspace, delineation_name, discretization_name, parameterization_name,
-                                                  channel_type, df_hillslope_parameters, AGWA_directory)  
+    agwa_tracing.stage("Parameterizing channels", tweet)
+    record = registry.find(delineation_name, discretization_name, CHANNELS_STEP, channels_fingerprint,
+                           exclude=parameterization_name)
+    if record is None:
+        df_channel_element_parameters = calculate_channel_parameters(workspace, delineation_name, discretization_name,
+                                                                     parameterization_name, channel_type,
+                                                                     df_hillslope_parameters, AGWA_directory)
+    else:
+        tweet(f"Channel inputs unchanged, reusing the channel parameters of {record['ParameterizationName']}")
+        df_channel_element_parameters = registry.read_fields(workspace, record)["parameters_channels"]
+    df_channel_parameters = parameterize_channels(workspace, delineation_name, discretization_name,
+                                                  parameterization_name, df_channel_element_parameters)
       
-    # Step 4. write the hillslope tables to the workspace gdb
+    # Step 4. write the current set to the parameter store and mirror it to the workspace gdb
+    agwa_tracing.stage("Writing parameter tables", tweet)
     for df, table_name in zip([df_hillslope_parameters, df_channel_parameters], ["parameters_hillslopes", "parameters_channels"]):
-        tweet(f"Writing {table_name} to the workspace geodatabase")     
-        with tempfile.TemporaryDirectory() as tempdir:
-            temp_csvfile = os.path.join(tempdir, F'tempfile_{table_name}.csv')
-            df.to_csv(temp_csvfile, index=False)            
-            if arcpy.Exists(os.path.join(workspace, table_name)):
-                arcpy.Delete_management(os.path.join(workspace, table_name))            
-            arcpy.TableToTable_conversion(temp_csvfile, workspace, table_name)
-
-
-def parameterize_hillslopes(workspace, delineation_name, discretization_name, parameterization_name, soil_feature_class_path,
-                    soils_database_path, agwa_directory, max_thickness, max_horizons, land_cover, land_cover_lut, 
-                    save_intermediate_outputs):
+        tweet(f"Writing {table_name} to the parameter store and the workspace geodatabase")
+        with agwa_tracing.span(f"Writing {table_name}", rows=len(df)):
+            agwa_parameter_store.write_parameter_set(workspace, table_name, delineation_name, discretization_name,
+                                                     parameterization_name, df)
+
+    registry.record(delineation_name, discretization_name, parameterization_name, HILLSLOPES_STEP,
+                    hillslopes_fingerprint, {"parameters_hillslopes": [column for column in df_soil_cover.columns
+                                                                       if column != "HillslopeID"]})
+    registry.record(delineation_name, discretization_name, parameterization_name, CHANNELS_STEP,
+                    channels_fingerprint, {"parameters_channels": [column for column in df_channel_element_parameters.columns
+                                                                   if column != "ChannelID"]})
+
+
+def calculate_hillslope_soil_and_land_cover(workspace, delineation_name, discretization_name, parameterization_name,
+                                            soil_feature_class_path, soils_database_path, agwa_directory, max_thickness,
+                                            max_horizons, land_cover, land_cover_lut, save_intermediate_outputs):
     
-    """Parameterize hillslopes. Results: 33 parameters.
+    """Calculate the area weighted soil and land cover parameters of each hillslope.
     Called in parameterize function."""
 
     # Step 1. intersect soils and land cover with hillslopes
-    intersect_soils(workspace, delineation_name, discretization_name, parameterization_name, soil_feature_class_path,
-                    soils_database_path, agwa_directory, max_thickness, max_horizons, save_intermediate_outputs)
+    with agwa_tracing.span("Intersecting soils"):
+        intersect_soils(workspace, delineation_name, discretization_name, parameterization_name, soil_feature_class_path,
+                        soils_database_path, agwa_directory, max_thickness, max_horizons, save_intermediate_outputs)
     
-    df_soil = weight_hillsope_parameters_by_area_fractions(workspace, delineation_name, discretization_name, parameterization_name, 
-                save_intermediate_outputs)
+    with agwa_tracing.span("Weighting soil parameters by area") as span:
+        df_soil = weight_hillsope_parameters_by_area_fractions(workspace, delineation_name, discretization_name, parameterization_name, 
+                    save_intermediate_outputs)
+        span.add_rows(len(df_soil))
     
     # Step 2. intersect land cover with hillslopes
-    df_cover = intersect_weight_land_cover_by_area(workspace, discretization_name, land_cover, land_cover_lut, agwa_directory)
+    with agwa_tracing.span("Weighting land cover by area") as span:
+        df_cover = intersect_weight_land_cover_by_area(workspace, delineation_name, discretization_name, land_cover,
+                                                       land_cover_lut, agwa_directory)
+        span.add_rows(len(df_cover))
     df_soiL_cover = pd.merge(df_soil, df_cover, left_on="HillslopeID", right_on="HillslopeID", how="left")
+
+    return df_soiL_cover
+
+
+def parameterize_hillslopes(workspace, delineation_name, discretization_name, parameterization_name, df_soil_cover):
     
-    # Step 3. read hillslope table and merge with soil and land cover parameters, while keep previous sets intact
-    df_hillslope = pd.DataFrame(arcpy.da.TableToNumPyArray(os.path.join(workspace, "parameters_hillslopes"), "*", null_value=-9999))
-    df_hillslope = df_hillslope.drop(columns=["OBJECTID"])
-    df_hillslope_current_set = df_hillslope[(df_hillslope["DelineationName"] == delineation_name) &
-                                            (df_hillslope["DiscretizationName"] == discretization_name) &
-                                            (df_hillslope["ParameterizationName"] == parameterization_name)]
-    df_hillslope_previous_sets = df_hillslope[~df_hillslope.index.isin(df_hillslope_current_set.index)]
+    """Parameterize hillslopes. Results: 33 parameters.
+    Called in parameterize function."""
+
+    # Step 3. read the current set of the hillslope table and merge with soil and land cover parameters
+    df_hillslope_current_set = agwa_parameter_store.read_parameter_set(workspace, "parameters_hillslopes", delineation_name,
+                                                                       discretization_name, parameterization_name,
+                                                                       null_value=-9999)
 
     df_hillslope_current_set.set_index("HillslopeID", inplace=True)
-    df_soiL_cover.set_index("HillslopeID", inplace=True)
-    for column in df_soiL_cover.columns:
-        df_hillslope_current_set.loc[:,column] = df_soiL_cover.loc[:, column]
+    df_soil_cover = df_soil_cover.set_index("HillslopeID")
+    for column in df_soil_cover.columns:
+        df_hillslope_current_set.loc[:,column] = df_soil_cover.loc[:, column]
     df_hillslope_current_set.reset_index(inplace=True)
-    
-    # Step 4. merge the current set with previous sets
-    df_hillslope_parameters = pd.concat([df_hillslope_previous_sets, df_hillslope_current_set], axis=0, ignore_index=True)
 
-    return df_hillslope_parameters
+    return df_hillslope_current_set
 
 
-def parameterize_channels(workspace, delineation_name, discretization_name, parameterization_name, channel_type, df_hillslope_parameters, agwa_directory):
-    """Parameterize channel elements. Note: it is important to make sure parameters match in this function.
+def calculate_channel_parameters(workspace, delineation_name, discretization_name, parameterization_name, channel_type, df_hillslope_parameters, agwa_directory):
+    """Calculate the soil and land cover parameters of channel elements. Note: it is important to make sure parameters match in this function.
     Called in parameterize function."""    
 
     def get_channel_parameters_based_on_adj_hillslopes(workspace, delineation_name, discretization_name, parameterization_name,
@@ -136,16 +204,13 @@ def parameterize_channels(workspace, delineation_name, discretization_name, para
         df_channels = pd.DataFrame(arcpy.da.TableToNumPyArray(os.path.join(workspace, f"{discretization_name}_channels"), 
                                                             ["ChannelID"]))
 
-        for channel_id in df_channels.ChannelID:
-            hillslope_ids = [channel_id-1, channel_id-2, channel_id-3]
-            hillslope_ids = [hid for hid in hillslope_ids if hid in df_hillslope_parameters.HillslopeID.values]
-            # print(channel_id, hillslope_ids) ## remove this when testing is done
-
-            df_hillslopes_filtered = df_hillslope_parameters[df_hillslope_parameters.HillslopeID.isin(hillslope_ids)]
-            total_area = df_hillslopes_filtered.Area.sum()
-            for parameter in parameters:
-                weighted_value = (df_hillslopes_filtered[parameter] * df_hillslopes_filtered.Area).sum() / total_area
-                df_channels.loc[df_channels.ChannelID == channel_id, parameter] = weighted_value
+        # the hillslopes adjacent to a channel are numbered channel_id-1 to channel_id-3
+        df_adjacent = pd.DataFrame({"ChannelID": np.repeat(df_channels.ChannelID.values, 3)})
+        df_adjacent["HillslopeID"] = df_adjacent.ChannelID - np.tile([1, 2, 3], len(df_channels))
+        df_adjacent = pd.merge(df_adjacent, df_hillslope_parameters[["HillslopeID", "Area"] + parameters],
+                               on="HillslopeID", how="inner")
+        df_weighted = agwa_weighting.weighted_means(df_adjacent, "ChannelID", parameters, "Area")
+        df_channels = pd.merge(df_channels, df_weighted, on="ChannelID", how="left")
 
         # Weight the texture factions, so that they sum to 1. When the sum of Sand, Silt, and Clay is 0, set them to 0.
         df_channels[["Sand", "Clay", "Silt"]] = df_channels[["Sand", "Clay", "Silt"]].div(
@@ -171,72 +236,89 @@ def parameterize_channels(workspace, delineation_name, discretization_name, para
             df_channel_parameters = df_channel_parameters.assign(Ksat=ksat, Manning=manning, Pave=pave)
     else:
         tweet(f"Channel type {channel_type} not found in the Lookup table.")
+
+    return df_channel_parameters
+
+
+def parameterize_channels(workspace, delineation_name, discretization_name, parameterization_name, df_channel_parameters):
+    """Merge the channel parameters with the current set of the channels table. Called in parameterize function."""    
         
-    # Step 2. get current set of channel parameters separated from the previous sets (38 parameters in total)
-    # df_channel and df_channel_previous_sets have 21 or 38 parameters, excluding OBJECTID. 21+18-1(ChannelID)=38 parameters
-    df_channel = pd.DataFrame(arcpy.da.TableToNumPyArray(os.path.join(workspace, "parameters_channels"), "*"))
-    df_channel = df_channel.drop(columns=["OBJECTID"])
-    df_channel_current_set = df_channel[(df_channel["DelineationName"] == delineation_name) &
-                                                        (df_channel["DiscretizationName"] == discretization_name) &
-                                                        (df_channel["ParameterizationName"] == parameterization_name)]
-    df_channel_previous_sets = df_channel[~df_channel.index.isin(df_channel_current_set.index)]
-
-    # update df_channel_previous_sets with the new channel parameters
+    # Step 2. get current set of channel parameters (38 parameters in total)
+    # df_channel_current_set has 21 or 38 parameters. 21+18-1(ChannelID)=38 parameters
+    df_channel_current_set = agwa_parameter_store.read_parameter_set(workspace, "parameters_channels", delineation_name,
+                                                                     discretization_name, parameterization_name)
+
+    # update df_channel_current_set with the new channel parameters
     df_channel_current_set.set_index("ChannelID", inplace=True)
-    df_channel_parameters.set_index("ChannelID", inplace=True)
+    df_channel_parameters = df_channel_parameters.set_index("ChannelID")
     for column in df_channel_parameters.columns:
         df_channel_current_set.loc[:,column] = df_channel_parameters.loc[:, column]
     df_channel_current_set.reset_index(inplace=True)
 
-    # Step 4. merge the current set with previous sets
-    df_channel_parameters = pd.concat([df_channel_previous_sets, df_channel_current_set], axis=0, ignore_index=True)
+    return df_channel_current_set
 
 
-    return df_channel_parameters
+def intersect_weight_land_cover_by_area(workspace, delineation_name, discretization_name, land_cover, land_cover_lut,
+                                        agwa_directory):
 
-
-def intersect_weight_land_cover_by_area(workspace, discretization_name, land_cover, land_cover_lut, agwa_directory):
-
-    """Intersect land cover with hillslopes and calculate weighted parameters for each hillslope.
+    """Cross-tabulate land cover with hillslopes and calculate area weighted parameters for each hillslope.
     called in parameterize function."""
 
-    # convert land cover raster to polygon, then intersect with hillslopes
+    # rasterize the hillslopes on the finer of the land cover grid and the grid they were delineated on, then count
+    # the cells of each land cover class in each hillslope. A land cover coarser than the delineation (e.g. 30 m NLCD
+    # over a 10 m DEM) is resampled to the delineation grid, so hillslopes narrower than a land cover cell still get
+    # cells.
     hillslope_feature_class = os.path.join(workspace, f"{discretization_name}_hillslopes")
-    land_cover_feature_class = os.path.join(workspace, f"{discretization_name}_land_cover")
-    intersect_feature_class = os.path.join(workspace, f"{discretization_name}_land_cover_PairwiseIntersect")
-
-    if arcpy.Exists(land_cover_feature_class):
-        arcpy.Delete_management(land_cover_feature_class) ## delete this when testing is done
-    if arcpy.Exists(intersect_feature_class):
-        arcpy.Delete_management(intersect_feature_class) ## delete this when testing is done
-    land_cover = arcpy.sa.Int(land_cover)
-    arcpy.RasterToPolygon_conversion(land_cover, land_cover_feature_class, "NO_SIMPLIFY", "VALUE")
-    arcpy.analysis.PairwiseIntersect(f"'{land_cover_feature_class}'; '{hillslope_feature_class}'", intersect_feature_class, "ALL", None, "INPUT")
+    delineation_raster = os.path.join(workspace, f"{delineation_name}_raster")
+    zone_raster = os.path.join(workspace, f"intermediate_{discretization_name}_land_cover_zones")
+    class_raster = land_cover
+    if arcpy.Raster(delineation_raster).meanCellWidth < arcpy.Raster(land_cover).meanCellWidth:
+        class_raster = os.path.join(workspace, f"intermediate_{discretization_name}_land_cover_resampled")
+        with arcpy.EnvManager(snapRaster=delineation_raster, extent=hillslope_feature_class):
+            arcpy.management.Resample(land_cover, class_raster, delineation_raster, "NEAREST")
+    with arcpy.EnvManager(snapRaster=class_raster, cellSize=class_raster, extent=hillslope_feature_class):
+        arcpy.conversion.PolygonToRaster(hillslope_feature_class, "HillslopeID", zone_raster, "CELL_CENTER")
+    hillslopes = arcpy.da.FeatureClassToNumPyArray(hillslope_feature_class, ["HillslopeID", "SHAPE@X", "SHAPE@Y"])
+    hillslope_ids = hillslopes["HillslopeID"].astype(np.int64)
+    classes, counts, zone_cells = agwa_zonal_statistics.cross_tabulate(zone_raster, hillslope_ids, class_raster)
+
+    # a hillslope too small or thin to hold a cell center takes the land cover class at its centroid
+    without_cells = np.flatnonzero(zone_cells == 0)
+    if without_cells.size:
+        tweet(f"{without_cells.size} hillslopes hold no land cover cell center and take the land cover class at "
+              f"their centroid")
+        centroid_classes = agwa_zonal_statistics.point_classes(class_raster, hillslopes["SHAPE@X"][without_cells],
+                                                               hillslopes["SHAPE@Y"][without_cells])
+        found = centroid_classes >= 0
+        all_classes = np.union1d(classes, centroid_classes[found])
+        all_counts = np.zeros((hillslope_ids.size, all_classes.size), dtype=np.int64)
+        all_counts[:, np.searchsorted(all_classes, classes)] = counts
+        all_counts[without_cells[found], np.searchsorted(all_classes, centroid_classes[found])] = 1
+        classes, counts = all_classes, all_counts
+
+    without_cover = hillslope_ids[counts.sum(axis=1) == 0]
+    if without_cover.size:
+        raise Exception(f"The land cover {land_cover} is NoData under all cells (or at the centroid) of "
+                        f"{without_cover.size} hillslopes, e.g. HillslopeID "
+                        f"{', '.join(str(hillslope_id) for hillslope_id in without_cover[:10])}. "
+                        f"The land cover must cover the whole watershed.")
 
-    
     df_cover_lut = pd.DataFrame(arcpy.da.TableToNumPyArray(
         os.path.join(agwa_directory, "lookup_tables.gdb", land_cover_lut), "*"))
 
     cover_lut_fields = ["CLASS", "NAME", "COVER", "INT", "N", "IMPERV"]
     df_cover_lut = df_cover_lut[cover_lut_fields]
     df_cover_lut = df_cover_lut.rename(columns={"NAME": "LandCoverClass", "COVER": "Canopy",
-                                                "INT": "Interception", "N": "Manning", "IMPERV": "Imperviousness"}) 
-    df_hillslope_cover = pd.DataFrame(arcpy.da.TableToNumPyArray(intersect_feature_class, ["HillslopeID", "gridcode", "Shape_Area"]))
-    df_merge = pd.merge(df_hillslope_cover, df_cover_lut, left_on="gridcode", right_on="CLASS", how="left")  
+                                                "INT": "Interception", "N": "Manning", "IMPERV": "Imperviousness"})
 
+    # weight the parameters of the classes by their area fraction in each hillslope: (hillslopes x classes) @
+    # (classes x parameters). Classes missing from the look up table add area but no parameter values.
     parameters = ["Canopy", "Interception", "Manning", "Imperviousness"]
-    def weight_parameters(group, weight_column):
-        weighted_par = pd.Series()
-        for param in parameters:
-            weighted_par[param] =  (group[param] * group[weight_column]).sum() / group[weight_column].sum()
-        return pd.DataFrame([weighted_par])
-        
-    df_weighted = pd.DataFrame()
-    for hillslope_id in df_merge.HillslopeID.unique():
-        df_hillslope = df_merge[df_merge.HillslopeID == hillslope_id]
-        df_weighted_values = weight_parameters(df_hillslope, "Shape_Area")
-        df_weighted_values.insert(0, "HillslopeID", hillslope_id)
-        df_weighted = pd.concat([df_weighted, df_weighted_values], axis=0, ignore_index=True)
+    class_parameters = df_cover_lut.drop_duplicates("CLASS").set_index("CLASS")[parameters].astype(float)
+    class_parameters = class_parameters.reindex(classes).fillna(0).values
+    area_fractions = counts / counts.sum(axis=1, keepdims=True)
+    df_weighted = pd.DataFrame(area_fractions @ class_parameters, columns=parameters)
+    df_weighted.insert(0, "HillslopeID", hillslope_ids)
 
     return df_weighted
 
@@ -258,104 +340,28 @@ def intersect_soils(workspace, delineation_name, discretization_name, parameteri
                                      intersect_feature_class, "ALL", None, "INPUT")
     
     
-    # reading tables from AGWA directory and gSSURGO database
-    component_table = os.path.join(gssurgo_gdb, "component")
-    horizon_table = os.path.join(gssurgo_gdb, "chorizon")
-    texture_table = os.path.join(gssurgo_gdb, "chtexture")
-    texture_group_table = os.path.join(gssurgo_gdb, "chtexturegrp")
-    kin_lut_table = os.path.join(agwa_directory, "lookup_tables.gdb", "kin_lut")
-    
-    # define fields needed and read tables into dataframes
-    component_fields = ["cokey", "comppct_r", "mukey"]
-    horizon_fields = ["cokey", "chkey", "hzdept_r", "hzdepb_r", "ksat_r", "sandtotal_r", "silttotal_r", "claytotal_r",
-                      "dbthirdbar_r", "partdensity", "sieveno10_r", "kwfact"]
-    texture_group_fields = ["chkey", "chtgkey", "texture"]
-    texture_fields = ["chtgkey", "texcl", "lieutex"]
-    kin_lut_fields = ["TextureName", "KS", "G", "POR", "SMAX", "CV", "SAND", "SILT", "CLAY", "DIST", "KFF", "BPressure"]
     df_mapunit = pd.DataFrame(arcpy.da.TableToNumPyArray(intersect_feature_class, ["mukey"]))
-    df_component = pd.DataFrame(arcpy.da.TableToNumPyArray(component_table, component_fields, skip_nulls=False))
-    df_horizon = pd.DataFrame(arcpy.da.TableToNumPyArray(horizon_table, horizon_fields))
-    df_texture_group = pd.DataFrame(arcpy.da.TableToNumPyArray(texture_group_table, texture_group_fields))
-    df_texture = pd.DataFrame(arcpy.da.TableToNumPyArray(texture_table, texture_fields))
-    df_kin_lut = pd.DataFrame(arcpy.da.TableToNumPyArray(kin_lut_table, kin_lut_fields))
 
-    # start processing each mukey found in the intersection feature class
-    df_horizon_parameters_with_soil_textures = pd.DataFrame()
-    df_horizon_parameters = pd.DataFrame()
-    
-    # Loop 1: process each mukey
-    df_component.mukey = df_component.mukey.astype(str)
-    df_mapunit.mukey = df_mapunit.mukey.astype(str)
-    unique_mukeys = df_mapunit["mukey"].unique()
-    for mukey in unique_mukeys:
-        
-        df_component_filtered = df_component[df_component["mukey"] == mukey]
-        
-        # Loop 2: process each component
-        for _, row in df_component_filtered.iterrows():
-            component_id = row.cokey
-            ComponentPercentage = row.comppct_r           
-
-            # Loop 3: process each horizon
-            df_horizon_filtered = df_horizon[(df_horizon["cokey"] == component_id) & (df_horizon["hzdept_r"] < max_thickness)].reset_index(drop=True)
-            if df_horizon_filtered.empty:
-                continue
-            horizon_count = 0            
-            for _, row in df_horizon_filtered.iterrows():    
-                horizon_count += 1
-                if not (max_horizons == 0 or horizon_count <= max_horizons):
-                    break
-                horizon_id = row.chkey
-                horizon_parameters = query_soil_horizon_parameters(row, horizon_count, max_horizons)
-                horizon_parameters["MapUnitKey"] = mukey
-                horizon_parameters["ComponentId"] = component_id
-                horizon_parameters["ComponentPercentage"] = ComponentPercentage
-
-                # Loop 4: process texture group  
-                # there is a potential issue here: from the gSSURGO tables, 1 horizon can have multiple texture groups
-                df_texture_group_filtered = df_texture_group[df_texture_group["chkey"] == horizon_id]
-                for _, row in df_texture_group_filtered.iterrows():
-                    texture_group_id, texture_in_group_table = row.chtgkey, row.texture
-
-                    # Loop 5: process texture (Loop 5 is not used in VB file?)
-                    for _, row in df_texture[df_texture["chtgkey"] == texture_group_id].iterrows():
-                        texture = row.texcl if row.texcl != "None" else row.lieutex
-                        # print(mukey, component_id, horizon_id, texture_group_id,texture_in_group_table, texture) ### remove this when testing is done              
-                        new_row = {"MapUnitKey": mukey, "ComponentId": component_id, "HorizonId": horizon_id,
-                                   "TextureGroupId": texture_group_id, "Texture": texture} 
-                        df_horizon_parameters_with_soil_textures = pd.concat([df_horizon_parameters_with_soil_textures, pd.DataFrame([new_row])], axis=0, ignore_index=True)
-                
-                # Query the kin_lut table based on soil texture with the last "texture".
-                texture_in_kinlut_flag, horizon_parameters = query_kin_lut_update_horizon_parameters(df_kin_lut, texture, horizon_parameters)
-                if texture_in_kinlut_flag: 
-                    horizon_parameters["TextureGroupId"] = texture_group_id
-                    horizon_parameters["Texture"] = texture_in_group_table
-                    horizon_parameters["Texture_texcl"] = texture
-                    # The following code is from the original VB code, which assigns Pave = 1 when the texture is one of ["WB", "UWB", "ICE", "CEM", "IND", "GYP"].
-                    # "BR" and "CEM_BR", both of which represent bedrock in the gSSURGO_CA database, are added to the list.
-                    # "VAR", which means "variable" in the gSSURGO_CA database, is also added, but it needs to be confirmed if Pave=1 is correct for this type.
-                    # The list could potentially be updated or expanded based on gSSURGO database in other states.
-                    if texture_in_group_table in ["WB", "UWB", "ICE", "CEM", "IND", "GYP", "BR", "CEM_BR", "VAR"]:
-                        horizon_parameters["Pave"] = 1
-                        # When Pave=1, Sand, Clay and Silt are set to 0.33, 0.33, and 0.34, respectively. 
-                        # The values do not matter, but they need to sum to 1, so K2 can be executed.
-                        # Also, they will be excluded from the calculation of the weighted parameters.
-                        horizon_parameters["Sand"] = 0.33
-                        horizon_parameters["Clay"] = 0.33
-                        horizon_parameters["Silt"] = 0.34
-
-                    else:
-                        horizon_parameters["Pave"] = 0
-
-                    # Update horizon_parameters with the texture group and texture
-                    df_horizon_parameters = pd.concat([df_horizon_parameters, pd.DataFrame([horizon_parameters])], axis=0, ignore_index=True)
-                else:
-                    # Note: If the 'texture_in_kinlut_flag' is False, the variables SMax, CV, Distribution, and BPressure will not hold any values.
-                    # As a result, the execution of K2 will not be possible under this condition.
-                    tweet(f"Texture {texture} is not found in the AGWA lookup table.") ### Should this be a warning or an error?
-                    continue
+    # look up the map units in the compiled soil parameters of the soils database (see compile_soil_parameters), or
+    # calculate them from the gSSURGO tables when the database has not been compiled with these settings
+    soil_parameter_cache = agwa_soil_parameter_cache.SoilParameterCache(os.path.join(agwa_directory, SOIL_PARAMETERS_FOLDER))
+    cached_tables = None
+    if not save_intermediate_outputs:
+        cache_key = soil_parameter_cache.key(gssurgo_gdb, os.path.join(agwa_directory, "lookup_tables.gdb"),
+                                             max_thickness, max_horizons)
+        cached_tables = soil_parameter_cache.fetch(cache_key, df_mapunit.mukey)
+    if cached_tables is not None:
+        tweet(f"Using the compiled soil parameters of {gssurgo_gdb}")
+        df_weighted_by_horizon = cached_tables["weighted_by_horizon"]
+        df_weighted_by_component = cached_tables["weighted_by_component"]
+    else:
+        df_component, df_horizon, df_texture_group, df_texture, df_kin_lut = read_soil_tables(gssurgo_gdb, agwa_directory)
 
-    df_weighted_by_horizon, df_weighted_by_component = calculate_weighted_hillslope_soil_parameters(df_horizon_parameters)
+        # join map units -> components -> horizons -> texture groups -> textures -> kin_lut
+        df_horizon_parameters_with_soil_textures, df_horizon_parameters = calculate_horizon_soil_parameters(
+            df_mapunit, df_component, df_horizon, df_texture_group, df_texture, df_kin_lut, max_thickness, max_horizons)
+
+        df_weighted_by_horizon, df_weighted_by_component = calculate_weighted_hillslope_soil_parameters(df_horizon_parameters)
 
     # Add the remaining columns to the all tables. Save them to the workspace gdb, combined with previous sets
     if save_intermediate_outputs:
@@ -387,81 +393,174 @@ def intersect_soils(workspace, delineation_name, discretization_name, parameteri
             arcpy.TableToTable_conversion(temp_csvfile, workspace, table_name)
 
 
-def query_soil_horizon_parameters(row, horizon_count, max_horizons):
-    """Query soil horizon parameters. Called in intersect_soils function."""
-    
-    if not (max_horizons == 0 or horizon_count <= max_horizons):
-        return pd.Series()
-
-    try: 
-        # calculate horizon thickness and total thickness
-        horizon_id = row.chkey
-        # Horizon thickness=Bottom depth-Top depth (from gSSURGO chorizon table, bottom depth is always greater than top depth)
-        horizon_thickness = row.hzdepb_r - row.hzdept_r 
-        # SSURGO table has ksat in micrometers per second, which needs to be converted to mm/hr
-        # 1 mm / 1000 mm * 3600 seconds / 1 hour
-        horizon_ksat = row.ksat_r * 1 / 1000 * 3600 / 1
-        # Calculate G based on ksat using relationship derived by Goodrich, 1990 dissertation
-        # G = 4.83 * (1 / ksat) * 0.326
-        # Note his calculation are in English units, so conversions from Ks in mm/hr to in/hr
-        # is used in the equation to derive G in inches, which is then converted back to
-        # Alternate calculate derived by Haiyan Wei 2016 is G = 362.41 * KS ^ -0.378
-        horizon_g = 25.4 * (4.83 * (1 / (horizon_ksat / 25.4)) ** 0.326)
+def read_soil_tables(gssurgo_gdb, agwa_directory):
+    """Read the component, chorizon, chtexturegrp, and chtexture tables of the gSSURGO database and the kin_lut
+    table of the AGWA lookup tables into dataframes. Called in intersect_soils and compile_soil_parameters
+    functions."""
 
-        horizon_sand = row.sandtotal_r / 100
-        horizon_silt = row.silttotal_r / 100
-        horizon_clay = row.claytotal_r / 100
-        kwfact = row.kwfact
-        if kwfact == 'None':
-            kwfact = 0.2 # from VB code
-        #TODO from Shea: update the reference for the following equations
-        horizon_splash = 422 * float(kwfact) * 0.8
-        if horizon_clay <= 0.22:
-            horizon_cohesion = 5.6 * float(kwfact) / (188 - (468 * horizon_clay)
-                                        + (907 * (horizon_clay ** 2))) * 0.5
-        else:
-            horizon_cohesion = 5.6 * float(kwfact) / 130 * 0.5
-        bulk_density = row.dbthirdbar_r # dbthirdbar_r is moist bulk density
-        specific_gravity = row.partdensity
-        # sieve_no_10 is soil fraction passing a number 10 sieve (2.00mm square opening) as a weight
-        # percentage of the less than 3 inch (76.4mm) fraction.
-        # effectively percent soil
-        sieve_no_10 = row.sieveno10_r
-        horizon_rock = 1 - (sieve_no_10 / 100)
-        # reference: https://water.usgs.gov/GIS/metadata/usgswrd/XML/ds866_ssurgo_variables.xml
-        # porosity = 1 - ((bulk density) / (particle density))
-        # bulk density = dbthirdbar_r from SSURGO chorizon table
-        # particle density = partdensity from SSURGO chorizon table
-        if not(math.isnan(bulk_density) or math.isnan(specific_gravity)):
-            horizon_porosity = 1 - (bulk_density / specific_gravity)
-        else:
-            horizon_porosity = np.nan            
-        # rock_by_weight = ((1 - horizon_porosity) * (1 - horizon_rock)) /
-        # (1 - (horizon_porosity * (1 - horizon_rock)))
-
-        new_row = {
-            "HorizonId": horizon_id,
-            "HorizonNumber": horizon_count,
-            "HorizonTopDepth": row.hzdept_r,
-            "HorizonBottomDepth": row.hzdepb_r,
-            "HorizonThickness": horizon_thickness,
-            "Ksat": horizon_ksat,
-            "G": horizon_g,
-            "Porosity": horizon_porosity,
-            "Rock": horizon_rock,
-            "Sand": horizon_sand,
-            "Silt": horizon_silt,
-            "Clay": horizon_clay,
-            "kwfact": kwfact,
-            "Splash": horizon_splash,
-            "Cohesion": horizon_cohesion} # 15 parameters in total
-        
-        horizon_parameters = pd.DataFrame([new_row]).squeeze()
-    
-    except Exception as e:
-        horizon_parameters = pd.Series()
+    # reading tables from AGWA directory and gSSURGO database
+    component_table = os.path.join(gssurgo_gdb, "component")
+    horizon_table = os.path.join(gssurgo_gdb, "chorizon")
+    texture_table = os.path.join(gssurgo_gdb, "chtexture")
+    texture_group_table = os.path.join(gssurgo_gdb, "chtexturegrp")
+    kin_lut_table = os.path.join(agwa_directory, "lookup_tables.gdb", "kin_lut")
+
+    # define fields needed and read tables into dataframes
+    component_fields = ["cokey", "comppct_r", "mukey"]
+    horizon_fields = ["cokey", "chkey", "hzdept_r", "hzdepb_r", "ksat_r", "sandtotal_r", "silttotal_r", "claytotal_r",
+                      "dbthirdbar_r", "partdensity", "sieveno10_r", "kwfact"]
+    texture_group_fields = ["chkey", "chtgkey", "texture"]
+    texture_fields = ["chtgkey", "texcl", "lieutex"]
+    kin_lut_fields = ["TextureName", "KS", "G", "POR", "SMAX", "CV", "SAND", "SILT", "CLAY", "DIST", "KFF", "BPressure"]
+    df_component = pd.DataFrame(arcpy.da.TableToNumPyArray(component_table, component_fields, skip_nulls=False))
+    df_horizon = pd.DataFrame(arcpy.da.TableToNumPyArray(horizon_table, horizon_fields))
+    df_texture_group = pd.DataFrame(arcpy.da.TableToNumPyArray(texture_group_table, texture_group_fields))
+    df_texture = pd.DataFrame(arcpy.da.TableToNumPyArray(texture_table, texture_fields))
+    df_kin_lut = pd.DataFrame(arcpy.da.TableToNumPyArray(kin_lut_table, kin_lut_fields))
+
+    return df_component, df_horizon, df_texture_group, df_texture, df_kin_lut
+
+
+@agwa_tracing.traced("Compile soil parameters", "agwa_directory", tweet)
+def compile_soil_parameters(gssurgo_gdb, agwa_directory, max_thickness, max_horizons):
+    """Calculate the weighted soil parameters of every map unit of a gSSURGO database once and store them in the
+    soil parameter cache of the AGWA directory, so parameterizations with the same database, lookup tables,
+    max_thickness, and max_horizons look them up instead of reading the database tables (see intersect_soils)."""
 
-    return horizon_parameters
+    soil_parameter_cache = agwa_soil_parameter_cache.SoilParameterCache(os.path.join(agwa_directory, SOIL_PARAMETERS_FOLDER))
+    cache_key = soil_parameter_cache.key(gssurgo_gdb, os.path.join(agwa_directory, "lookup_tables.gdb"),
+                                         max_thickness, max_horizons)
+    if soil_parameter_cache.exists(cache_key):
+        tweet(f"The soil parameters of {gssurgo_gdb} are already compiled with these settings")
+        return
+
+    agwa_tracing.stage("Reading the soils database", tweet)
+    df_component, df_horizon, df_texture_group, df_texture, df_kin_lut = read_soil_tables(gssurgo_gdb, agwa_directory)
+
+    agwa_tracing.stage("Calculating the soil parameters of every map unit", tweet)
+    df_mapunit = pd.DataFrame({"mukey": df_component.mukey.astype(str).unique()})
+    _, df_horizon_parameters = calculate_horizon_soil_parameters(
+        df_mapunit, df_component, df_horizon, df_texture_group, df_texture, df_kin_lut, max_thickness, max_horizons)
+    df_weighted_by_horizon, df_weighted_by_component = calculate_weighted_hillslope_soil_parameters(df_horizon_parameters)
+
+    agwa_tracing.stage("Storing the soil parameters", tweet)
+    soil_parameter_cache.store(cache_key, {"weighted_by_horizon": df_weighted_by_horizon,
+                                           "weighted_by_component": df_weighted_by_component},
+                               {"soils_database": gssurgo_gdb, "max_thickness": max_thickness,
+                                "max_horizons": max_horizons})
+    agwa_tracing.add_rows(len(df_weighted_by_component))
+    tweet(f"Compiled the soil parameters of {len(df_weighted_by_component)} map units")
+
+
+def calculate_horizon_soil_parameters(df_mapunit, df_component, df_horizon, df_texture_group, df_texture, df_kin_lut,
+                                      max_thickness, max_horizons):
+    """Join the components of the map units in df_mapunit with their horizons, texture groups, textures, and the
+    kin_lut table, and calculate the parameters of each horizon. Horizons starting below max_thickness are
+    left out, and only the first max_horizons horizons of each component are used (all when max_horizons is 0).
+    Returns the horizons with all their textures and the parameters of each horizon whose texture is in kin_lut.
+    Called in intersect_soils function."""
+
+    # components of the map units, in order of the map units in the intersection
+    df_component = df_component.assign(mukey=df_component.mukey.astype(str))
+    mukeys = pd.Series(df_mapunit.mukey.astype(str).unique())
+    df = pd.merge(pd.DataFrame({"mukey": mukeys, "MapUnitOrder": np.arange(mukeys.size)}),
+                  df_component.assign(ComponentOrder=np.arange(len(df_component))), on="mukey")
+
+    # horizons of the components above max_thickness, numbered in table order within each component
+    df_horizon = df_horizon[df_horizon.hzdept_r < max_thickness]
+    df = pd.merge(df, df_horizon.assign(HorizonOrder=np.arange(len(df_horizon))), on="cokey")
+    df = df.sort_values(["MapUnitOrder", "ComponentOrder", "HorizonOrder"], kind="stable").reset_index(drop=True)
+    df["HorizonNumber"] = df.groupby(["MapUnitOrder", "ComponentOrder"]).cumcount() + 1
+    if max_horizons != 0:
+        df = df[df.HorizonNumber <= max_horizons].reset_index(drop=True)
+
+    # textures of the horizons, in table order within each texture group
+    df_textures = pd.merge(df[["mukey", "cokey", "chkey"]].assign(HorizonIndex=np.arange(len(df))),
+                           df_texture_group.assign(TextureGroupOrder=np.arange(len(df_texture_group))), on="chkey")
+    df_textures = pd.merge(df_textures, df_texture.assign(TextureOrder=np.arange(len(df_texture))), on="chtgkey")
+    df_textures = df_textures.sort_values(["HorizonIndex", "TextureGroupOrder", "TextureOrder"], kind="stable")
+    df_textures["Texture"] = df_textures.texcl.where(df_textures.texcl != "None", df_textures.lieutex)
+    df_horizon_parameters_with_soil_textures = pd.DataFrame({
+        "MapUnitKey": df_textures.mukey.values, "ComponentId": df_textures.cokey.values,
+        "HorizonId": df_textures.chkey.values, "TextureGroupId": df_textures.chtgkey.values,
+        "Texture": df_textures.Texture.values})
+
+    # a horizon takes its texture group from its last group and its texture from its last texture
+    df_last_texture = df_textures.drop_duplicates("HorizonIndex", keep="last").set_index("HorizonIndex")
+    df_horizon_parameters = calculate_horizon_parameters(df)
+    df_horizon_parameters["MapUnitKey"] = df.mukey.values
+    df_horizon_parameters["ComponentId"] = df.cokey.values
+    df_horizon_parameters["ComponentPercentage"] = df.comppct_r.values
+    df_horizon_parameters["TextureGroupId"] = df_last_texture.chtgkey.reindex(df.index).values
+    df_horizon_parameters["Texture"] = df_last_texture.texture.reindex(df.index).values
+    df_horizon_parameters["Texture_texcl"] = df_last_texture.Texture.reindex(df.index).values
+
+    # Note: horizons whose texture is not in kin_lut have no values for SMax, CV, Distribution, and BPressure,
+    # so K2 could not be executed with them. They are left out.
+    in_kin_lut = df_horizon_parameters.Texture_texcl.isin(df_kin_lut.TextureName)
+    missing_textures = df_horizon_parameters.Texture_texcl[~in_kin_lut].unique()
+    if missing_textures.size > 0:
+        tweet(f"Textures {', '.join(map(str, missing_textures))} are not found in the AGWA lookup table.")
+    df_horizon_parameters = update_horizon_parameters_from_kin_lut(
+        df_horizon_parameters[in_kin_lut].reset_index(drop=True), df_kin_lut)
+
+    return df_horizon_parameters_with_soil_textures, df_horizon_parameters
+
+
+def calculate_horizon_parameters(df):
+    """Calculate the parameters of each horizon of df, a chorizon table with HorizonNumber. Called in
+    calculate_horizon_soil_parameters function."""
+
+    # Horizon thickness=Bottom depth-Top depth (from gSSURGO chorizon table, bottom depth is always greater than top depth)
+    horizon_thickness = df.hzdepb_r - df.hzdept_r
+    # SSURGO table has ksat in micrometers per second, which needs to be converted to mm/hr
+    # 1 mm / 1000 mm * 3600 seconds / 1 hour
+    horizon_ksat = df.ksat_r * 1 / 1000 * 3600 / 1
+    # Calculate G based on ksat using relationship derived by Goodrich, 1990 dissertation
+    # G = 4.83 * (1 / ksat) * 0.326
+    # Note his calculation are in English units, so conversions from Ks in mm/hr to in/hr
+    # is used in the equation to derive G in inches, which is then converted back to
+    # Alternate calculate derived by Haiyan Wei 2016 is G = 362.41 * KS ^ -0.378
+    with np.errstate(divide="ignore"):
+        horizon_g = 25.4 * (4.83 * (1 / (horizon_ksat / 25.4)) ** 0.326)
+
+    horizon_sand = df.sandtotal_r / 100
+    horizon_silt = df.silttotal_r / 100
+    horizon_clay = df.claytotal_r / 100
+    kwfact = pd.to_numeric(df.kwfact.where(df.kwfact.astype(str) != "None", 0.2), errors="coerce") # 0.2 from VB code
+    #TODO from Shea: update the reference for the following equations
+    horizon_splash = 422 * kwfact * 0.8
+    horizon_cohesion = np.where(horizon_clay <= 0.22,
+                                5.6 * kwfact / (188 - (468 * horizon_clay) + (907 * (horizon_clay ** 2))) * 0.5,
+                                5.6 * kwfact / 130 * 0.5)
+    # sieve_no_10 is soil fraction passing a number 10 sieve (2.00mm square opening) as a weight
+    # percentage of the less than 3 inch (76.4mm) fraction.
+    # effectively percent soil
+    horizon_rock = 1 - (df.sieveno10_r / 100)
+    # reference: https://water.usgs.gov/GIS/metadata/usgswrd/XML/ds866_ssurgo_variables.xml
+    # porosity = 1 - ((bulk density) / (particle density))
+    # bulk density = dbthirdbar_r (moist bulk density) from SSURGO chorizon table
+    # particle density = partdensity from SSURGO chorizon table
+    horizon_porosity = 1 - (df.dbthirdbar_r / df.partdensity)
+    # rock_by_weight = ((1 - horizon_porosity) * (1 - horizon_rock)) /
+    # (1 - (horizon_porosity * (1 - horizon_rock)))
+
+    return pd.DataFrame({
+        "HorizonId": df.chkey.values,
+        "HorizonNumber": df.HorizonNumber.values,
+        "HorizonTopDepth": df.hzdept_r.values,
+        "HorizonBottomDepth": df.hzdepb_r.values,
+        "HorizonThickness": horizon_thickness.values,
+        "Ksat": horizon_ksat.values,
+        "G": horizon_g.values,
+        "Porosity": horizon_porosity.values,
+        "Rock": horizon_rock.values,
+        "Sand": horizon_sand.values,
+        "Silt": horizon_silt.values,
+        "Clay": horizon_clay.values,
+        "kwfact": kwfact.values,
+        "Splash": horizon_splash.values,
+        "Cohesion": horizon_cohesion}) # 15 parameters in total
 
 
 def calculate_weighted_hillslope_soil_parameters(df):
@@ -492,114 +591,80 @@ def calculate_weighted_hillslope_soil_parameters(df):
 
     parameters = ["Ksat", "G", "Porosity", "Rock", "Sand", "Silt", "Clay", "Splash", "Cohesion", "Pave", "SMax", "CV", "Distribution", "BPressure"]
 
-    df_weighted_horizon = pd.DataFrame()
-    df_weighted_component = pd.DataFrame()
-
-    def weight_parameters(group, weight_column):
-        weighted_par = pd.Series()
-        for param in parameters:
-            weighted_par[param] = (group[param] * group[weight_column]).sum() / group[weight_column].sum()
-        # weight the texture factions, so that they sum to 1
-        total_particle = weighted_par['Sand'] + weighted_par['Silt'] + weighted_par['Clay']
-        if total_particle != 0:
-            weighted_par['Sand'] /= total_particle
-            weighted_par['Silt'] /= total_particle
-            weighted_par['Clay'] /= total_particle            
-        return pd.DataFrame([weighted_par])
-        
-    for mukey in df.MapUnitKey.unique():
-        df_soil = df[df.MapUnitKey == mukey]
-        for component_id in df.ComponentId.unique():
-            df_component = df_soil[df_soil.ComponentId == component_id]
-            for horizon_id in df_component.HorizonId.unique():
-                df_horizon = df_component[df_component.HorizonId == horizon_id]
-                df_weighted_values = weight_parameters(df_horizon, "HorizonThickness")
-                df_weighted_values.insert(0, "MapUnitKey", mukey)
-                df_weighted_values.insert(1, "ComponentId", component_id)
-                df_weighted_values.insert(2, "HorizonId", horizon_id)
-                df_weighted_values.insert(3, "TotalHorizonThickness", df_horizon["HorizonThickness"].sum())                
-                df_weighted_values.insert(4, "ComponentPercentage", df_horizon["ComponentPercentage"].values[0])
-                df_weighted_horizon = pd.concat([df_weighted_horizon, df_weighted_values], axis=0, ignore_index=True)
+    # weight by horizon thickness within each horizon, then by component percentage within each map unit
+    horizon_keys = ["MapUnitKey", "ComponentId", "HorizonId"]
+    df_weighted_horizon = agwa_weighting.weighted_means(df, horizon_keys, parameters, "HorizonThickness",
+                                                        normalize_texture=True)
+    df_horizon_groups = df.groupby(horizon_keys, sort=False, dropna=False)
+    df_weighted_horizon.insert(3, "TotalHorizonThickness", df_horizon_groups["HorizonThickness"].sum().values)
+    df_weighted_horizon.insert(4, "ComponentPercentage",
+                               df.drop_duplicates(horizon_keys)["ComponentPercentage"].values)
 
-    
-    for mukey in df_weighted_horizon.MapUnitKey.unique():
-        df_component = df_weighted_horizon[df_weighted_horizon.MapUnitKey == mukey]
-        df_weighted_values = weight_parameters(df_component, "ComponentPercentage")
-        df_weighted_values.insert(0, "MapUnitKey", mukey)
-        df_weighted_values.insert(1, "TotalComponentPercentage", df_component["ComponentPercentage"].sum())   
-        df_weighted_component = pd.concat([df_weighted_component, df_weighted_values], axis=0, ignore_index=True)
-    
-    return df_weighted_horizon, df_weighted_component
+    df_weighted_component = agwa_weighting.weighted_means(df_weighted_horizon, "MapUnitKey", parameters,
+                                                          "ComponentPercentage", normalize_texture=True)
+    df_weighted_component.insert(1, "TotalComponentPercentage", df_weighted_horizon.groupby(
+        "MapUnitKey", sort=False, dropna=False)["ComponentPercentage"].sum().values)
 
+    return df_weighted_horizon, df_weighted_component
 
-def query_kin_lut_update_horizon_parameters(df_kin_lut, texture, horizon_parameters):  
-    """This function queries 'kin' parameters and updates 'horizon' values. It is called within the 'intersect_soils' function.
-        Additionally, it computes 'cohesion' based on the 'clay' values from the 'kin_lut' table.
-        Note: the 'kin_lut' table is prioritized over the SSURGO 'chorizon' table."""
 
-    kin_par = df_kin_lut[df_kin_lut.TextureName == texture].squeeze()
-    if kin_par.empty: 
-        # this means the texture type from SSURGO is not found in the kin_lut table
-        # in this case, there won't be values for SMax, CV, Distribution, and BPressure
-        horizon_parameters["comment"] = "Texture not found in kin_lut table"
-        return False, horizon_parameters
+def update_horizon_parameters_from_kin_lut(df, df_kin_lut):
+    """Update the parameters of the horizons of df with the 'kin' parameters of their textures (Texture_texcl),
+    which must all be in the kin_lut table. Additionally, computes 'splash' and 'cohesion' based on the 'clay' values
+    from the 'kin_lut' table. Called in calculate_horizon_soil_parameters function.
+    Note: the 'kin_lut' table is prioritized over the SSURGO 'chorizon' table."""
 
+    kin_par = pd.merge(df[["Texture_texcl"]], df_kin_lut.drop_duplicates("TextureName"), how="left",
+                       left_on="Texture_texcl", right_on="TextureName")
 
     # 13 parameters from kin_lut table
-    kin_ksat = kin_par.KS
-    kin_g = kin_par.G
-    kin_porosity = kin_par.POR
-    kin_smax = kin_par.SMAX
-    kin_cv = kin_par.CV 
-    kin_sand = kin_par.SAND/100
-    kin_silt = kin_par.SILT/100
-    kin_clay = kin_par.CLAY/100
-    kin_distribution = kin_par.DIST
-    kin_kff = kin_par.KFF  # used to calculate cohesion
-    kin_bpressure = kin_par.BPressure  # need to confirm with Shea, the purpose of this parameter
-
-    # TODO from Shea: document the splash and cohesion equations by adding references    
+    kin_sand = kin_par.SAND.values / 100
+    kin_silt = kin_par.SILT.values / 100
+    kin_clay = kin_par.CLAY.values / 100
+    kin_kff = kin_par.KFF.values  # used to calculate cohesion
+
+    # TODO from Shea: document the splash and cohesion equations by adding references
     # calculate cohesion based on kff (kwfact). modify if kf is 0 or kin_kff is negative
-    kf = float(horizon_parameters["kwfact"])
-    if kf == 0:
-        if kin_kff <= 0:
-            kf = 0.2
-        else:
-            kf = kin_kff
-    splash = 422 * float(kf) * 0.8
+    kf = df.kwfact.values.astype(float)
+    kf = np.where(kf == 0, np.where(kin_kff <= 0, 0.2, kin_kff), kf)
+    splash = 422 * kf * 0.8
 
     # calculate cohension
-    # option 1: calculate cohesion based on clay content from SSURGO chorizon table
-    if False: # use option 2
-        if math.isnan(horizon_parameters["Clay"]):
-            clay = kin_clay
-        else:
-            clay = horizon_parameters["Clay"]
+    # option 1: calculate cohesion based on clay content from SSURGO chorizon table (not used)
     # option 2: calculate cohesion based on clay content from kin_lut
     clay = kin_clay
-
-    if clay <= 0.22:
-        cohesion = 5.6 * kf / (188 - (468 * clay) + (907 * (clay ** 2))) * 0.5
-    else:
-        cohesion = 5.6 * kf / 130 * 0.5
+    cohesion = np.where(clay <= 0.22, 5.6 * kf / (188 - (468 * clay) + (907 * (clay ** 2))) * 0.5,
+                        5.6 * kf / 130 * 0.5)
 
     # The following 8 parameters are computable from SSURGO
     # Use values from kin_lut unless parameter from kin_lut is null
-    kin_values_to_use = {"Ksat": kin_ksat, "G": kin_g, "Sand": kin_sand,
+    df = df.copy()
+    kin_values_to_use = {"Ksat": kin_par.KS.values, "G": kin_par.G.values, "Sand": kin_sand,
                          "Silt": kin_silt, "Clay": kin_clay, "Splash": splash,
-                         "Cohesion": cohesion, "Porosity": kin_porosity}
-    for key, value in kin_values_to_use.items():
-        if value is not None and not math.isnan(value):
-            horizon_parameters[key] = value
+                         "Cohesion": cohesion, "Porosity": kin_par.POR.values}
+    for key, values in kin_values_to_use.items():
+        values = values.astype(float)
+        df[key] = np.where(np.isnan(values), df[key].values, values)
 
     # the following 4 parameters are not computable from SSURGO, so they must come from kin_lut
     # these are required parameters for KINEROS2
-    kin_values_to_add ={"SMax": kin_smax, "CV": kin_cv, 
-                        "Distribution": kin_distribution, "BPressure": kin_bpressure}        
-    for key, value in kin_values_to_add.items():
-        horizon_parameters[key] = value
-    
-    return True, horizon_parameters
+    kin_values_to_add = {"SMax": kin_par.SMAX.values, "CV": kin_par.CV.values,
+                         "Distribution": kin_par.DIST.values, "BPressure": kin_par.BPressure.values}
+    for key, values in kin_values_to_add.items():
+        df.insert(df.columns.get_loc("TextureGroupId"), key, values)
+
+    # The following code is from the original VB code, which assigns Pave = 1 when the texture is one of ["WB", "UWB", "ICE", "CEM", "IND", "GYP"].
+    # "BR" and "CEM_BR", both of which represent bedrock in the gSSURGO_CA database, are added to the list.
+    # "VAR", which means "variable" in the gSSURGO_CA database, is also added, but it needs to be confirmed if Pave=1 is correct for this type.
+    # The list could potentially be updated or expanded based on gSSURGO database in other states.
+    # When Pave=1, Sand, Clay and Silt are set to 0.33, 0.33, and 0.34, respectively.
+    # The values do not matter, but they need to sum to 1, so K2 can be executed.
+    # Also, they will be excluded from the calculation of the weighted parameters.
+    paved = df.Texture.isin(["WB", "UWB", "ICE", "CEM", "IND", "GYP", "BR", "CEM_BR", "VAR"])
+    df.loc[paved, ["Sand", "Clay", "Silt"]] = [0.33, 0.33, 0.34]
+    df["Pave"] = paved.astype(int)
+
+    return df
 
 
 def weight_hillsope_parameters_by_area_fractions(workspace, delineation_name, discretization_name, parameterization_name, save_intermediate_outputs):
@@ -616,6 +681,14 @@ def weight_hillsope_parameters_by_area_fractions(workspace, delineation_name, di
     intersection_table = os.path.join(workspace, f"{discretization_name}_MUPOLYGON_intersection")
     df_intersections = pd.DataFrame(arcpy.da.TableToNumPyArray(intersection_table, ["HillslopeID", "MUKEY", "Shape_Area"])) 
 
+    return weight_soil_parameters_by_area(df_intersections, df_soils)
+
+
+def weight_soil_parameters_by_area(df_intersections, df_soils):
+    """Weight the soil parameters of the map units intersecting each hillslope by their intersection areas.
+    df_intersections has the HillslopeID, MUKEY, and Shape_Area of each intersection polygon, and df_soils the
+    weighted parameters of each MapUnitKey. Called in weight_hillsope_parameters_by_area_fractions function."""
+
     # Step 2: Merge intersection polygons with soils
     df_soils.MapUnitKey = df_soils.MapUnitKey.astype(str)
     df_intersections.MUKEY = df_intersections.MUKEY.astype(str)
@@ -626,24 +699,14 @@ def weight_hillsope_parameters_by_area_fractions(workspace, delineation_name, di
     
     # Step 3: Weight soil parameters by area fractions
     parameters = ["Ksat", "G", "Porosity", "Rock", "Sand", "Silt", "Clay", "Splash", "Cohesion", "Pave", "SMax", "CV", "Distribution", "BPressure"]
-    df_weighted_by_area = pd.DataFrame().assign(HillslopeID=df_intersections_soils.HillslopeID.unique())
-    for hillsope_id in df_intersections_soils.HillslopeID.unique():
-        # print(hillsope_id) ### remove this when testing is done
-        df_hillslope = df_intersections_soils[df_intersections_soils.HillslopeID == hillsope_id]
-        
-        # For now: area with Pave = 1 will be excluded from the calculation
-        pave_unique = df_hillslope.Pave.unique()
-        if len(pave_unique) >= 2:
-            df_hillslope = df_hillslope[df_hillslope.Pave != 1]
-        
-        #TODO: will there be a case where Pave=0 but Sand, Clay and Silt are all 0?
 
-        total_area = df_hillslope.Shape_Area.sum()        
-        for param in parameters:
-            weighted_value = (df_hillslope[param] * df_hillslope.Shape_Area).sum() / total_area
-            df_weighted_by_area.loc[df_weighted_by_area.HillslopeID == hillsope_id, param] = weighted_value
+    # For now: area with Pave = 1 will be excluded from the calculation in hillslopes with more than one Pave value
+    mixed_pave = df_intersections_soils.groupby("HillslopeID")["Pave"].transform("nunique", dropna=False) >= 2
+    df_intersections_soils = df_intersections_soils[~(mixed_pave & (df_intersections_soils.Pave == 1))]
 
-    return df_weighted_by_area
+    #TODO: will there be a case where Pave=0 but Sand, Clay and Silt are all 0?
+
+    return agwa_weighting.weighted_means(df_intersections_soils, "HillslopeID", parameters, "Shape_Area")
 
 
 def extract_parameters(prjgdb, delineation_name, discretization_name, parameterization_name):
@@ -683,45 +746,24 @@ def copy_parameterization(workspace, delineation_name, discretization_name, prev
     """Copy parameterization from previous to new parameterization. Called in parameterize function.
     Note: element parameterization should be done before this step. Therefore, all element parameters should be kept intact for 
     the targe parameterization, and do not copy them from the previous parameterization.
+    The target parameterization is layered on the previous one in the parameter store, so the copied fields are
+    inherited rather than stored again.
     """
 
 
     tables = ["parameters_hillslopes", "parameters_channels"]
-    index_fields = ["HillslopeID", "ChannelID"]
     hillslope_fields_copy = ["Ksat", "G", "Porosity", "Rock", "Sand", "Silt", "Clay", "Splash", "Cohesion", "Pave", "SMax", "CV", 
                         "Distribution", "BPressure", "Canopy", "Interception", "Manning", "Imperviousness"]
     channel_feilds_copy = ["Ksat", "Manning", "Pave", "Imperviousness", "SMax", "CV", "G", "Porosity", 
                       "Rock", "Sand", "Silt", "Clay", "Splash", "Cohesion", "Distribution", "BPressure", "Woolhiser"]
 
     
-    for table, fields_to_copy, index_field in zip(tables, [hillslope_fields_copy, channel_feilds_copy], index_fields):
+    for table, fields_to_copy in zip(tables, [hillslope_fields_copy, channel_feilds_copy]):
 
         try:
-            table_path = arcpy.os.path.join(workspace, table)
-            field_objects = arcpy.ListFields(table_path)
-            all_fields = [field.name for field in field_objects if field.type != 'OID']
-            cols_to_load = [index_field] + fields_to_copy + ["DelineationName", "DiscretizationName", "ParameterizationName"]
-            df = pd.DataFrame(arcpy.da.TableToNumPyArray(table_path, cols_to_load))
-            
-            previous_data_set = df[(df["DelineationName"] == delineation_name) & 
-                                   (df["DiscretizationName"] == discretization_name) &
-                                   (df["ParameterizationName"] == previous_parameterization_name)]
-            previous_data_set = previous_data_set.set_index(index_field)[fields_to_copy].to_dict(orient='index')
-
-            field_indices = {field: all_fields.index(field) for field in fields_to_copy}
-
-            where_clause = (f"DelineationName = '{delineation_name}' AND "
-                            f"DiscretizationName = '{discretization_name}' AND "
-                            f"ParameterizationName = '{parameterization_name}'")
-
-            with arcpy.da.UpdateCursor(table_path, all_fields, where_clause) as cursor:
-                for row in cursor:
-                    hillslope_id = row[0]
-                    if hillslope_id in previous_data_set:
-                        for field in fields_to_copy:
-                            row[field_indices[field]] = previous_data_set[hillslope_id][field]
-                        cursor.updateRow(row)
+            agwa_parameter_store.inherit_parameters(workspace, table, delineation_name, discretization_name,
+                                                    parameterization_name, previous_parameterization_name,
+                                                    fields_to_copy)
             tweet(f"Update complete for table {table}.")
         except Exception as e:
             tweet(f"Failed to update table {table} due to error: {e}")
-
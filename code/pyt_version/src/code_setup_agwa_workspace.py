@@ -1,9 +1,33 @@
 # Import arcpy module
 import os
+import time
 import arcpy
 import datetime
+import tempfile
+import importlib
+import numpy as np
 import arcpy.management
 from arcpy._mp import Table
+import agwa_tiles
+import agwa_pipeline
+import agwa_raster_cache
+import agwa_raster_arrays
+importlib.reload(agwa_tiles)
+importlib.reload(agwa_pipeline)
+importlib.reload(agwa_raster_cache)
+importlib.reload(agwa_raster_arrays)
+
+
+# The terrain products created by prepare_rasters: the output file, the operation and its parameters, and the
+# raster it is derived from. "surface" is the unfilled DEM when there is one and the filled DEM otherwise.
+TERRAIN_PRODUCTS = {
+    "filled_dem": ("filled_DEM.tif", "Fill", {}, "unfilled_dem"),
+    "flow_direction": ("fd.tif", "FlowDirection", {"force_flow": "NORMAL"}, "filled_dem"),
+    "flow_accumulation": ("fa.tif", "FlowAccumulation", {"data_type": "FLOAT"}, "flow_direction"),
+    "flow_length_upstream": ("flup.tif", "FlowLength", {"direction_measurement": "UPSTREAM"}, "flow_direction"),
+    "slope": ("slope.tif", "Slope", {"output_measurement": "PERCENT_RISE"}, "surface"),
+    "aspect": ("aspect.tif", "Aspect", {}, "surface"),
+}
 
 
 def tweet(msg):
@@ -13,87 +37,220 @@ def tweet(msg):
     print(m)
     print(arcpy.GetMessages())
 
+# The metaWorkspace fields documenting the seconds taken to create each terrain product
+ELAPSED_TIME_FIELDS = {"filled_dem": "FilledDEMSeconds", "flow_direction": "FDSeconds",
+                       "flow_accumulation": "FASeconds", "flow_length_upstream": "FlUpSeconds",
+                       "slope": "SlopeSeconds", "aspect": "AspectSeconds"}
+
 
 def prepare_rasters(prjgdb, filled_dem, unfilled_dem, flow_direction, flow_accumulation, flow_length_upstream,
-                    slope, aspect, agwa_directory):
+                    slope, aspect, agwa_directory, memory_budget_mb=None, cache_directory=None, cache_size_gb=50,
+                    max_workers=None):
     try:
         arcpy.env.workspace = prjgdb
         rasters_folder = os.path.join(prjgdb, "input_rasters")
         if not os.path.exists(rasters_folder):
             os.makedirs(rasters_folder)
+        # the rasters may be layer names of the map, which the worker processes cannot resolve
+        filled_dem, unfilled_dem, flow_direction, flow_accumulation, flow_length_upstream, slope, aspect = [
+            arcpy.Describe(raster).catalogPath if raster else raster
+            for raster in [filled_dem, unfilled_dem, flow_direction, flow_accumulation, flow_length_upstream, slope,
+                           aspect]]
+        rasters = {"filled_dem": filled_dem, "unfilled_dem": unfilled_dem, "flow_direction": flow_direction,
+                   "flow_accumulation": flow_accumulation, "flow_length_upstream": flow_length_upstream,
+                   "slope": slope, "aspect": aspect}
+        elapsed_times = {}
 
-        # Process: Fill
-        # Add validation of output dataset name
-        if not filled_dem:
-            tweet("Filling DEM")
-            filled_dem_output = os.path.join(rasters_folder, "filled_DEM.tif")
-            filled_dem_raster = arcpy.sa.Fill(unfilled_dem, "#")
-            filled_dem_raster.save(filled_dem_output)
-        else:
-            filled_dem_raster = filled_dem
-
-        # Process: Flow Direction
-        # Add validation of output dataset name
-        if not flow_direction:
-            tweet("Creating flow direction raster")
-            fd_output = os.path.join(rasters_folder, "fd.tif")
-            fd_raster = filled_dem_raster = arcpy.sa.FlowDirection(filled_dem_raster, "NORMAL", "#")
-            fd_raster.save(fd_output)
-        else:
-            fd_raster = flow_direction
-
-        # Process: Flow Accumulation
-        # Add validation of output dataset name
-        if not flow_accumulation:
-            tweet("Creating flow accumulation raster")
-            fa_raster_output = os.path.join(rasters_folder, "fa.tif")
-            fa_raster = arcpy.sa.FlowAccumulation(fd_raster, "#", "FLOAT")
-            fa_raster.save(fa_raster_output)
-        else:
-            fa_raster = flow_accumulation
+        # Terrain products already derived from the same DEM, for this or another project, are taken from the cache
+        cache = None
+        if cache_directory:
+            cache = agwa_raster_cache.RasterCache(cache_directory, cache_size_gb * 1024 ** 3)
+            cache_keys = terrain_cache_keys(cache, rasters, bool(memory_budget_mb))
+            created = fetch_cached_rasters(cache, rasters_folder, rasters, cache_keys)
 
-        if not flow_length_upstream:
-            tweet("Creating flow length (upstream) raster")
-            flup_raster_output = os.path.join(rasters_folder, "flup.tif")
-            flup_raster = arcpy.sa.FlowLength(fd_raster, direction_measurement="UPSTREAM")
-            flup_raster.save(flup_raster_output)
-        else:
-            flup_raster = flow_length_upstream
+        # Very large DEMs are processed tile by tile within the memory budget, into the same output rasters
+        if memory_budget_mb:
+            (rasters["filled_dem"], rasters["flow_direction"], rasters["flow_accumulation"], rasters["slope"],
+             rasters["aspect"]) = prepare_rasters_tiled(rasters_folder, rasters["filled_dem"], unfilled_dem,
+                                                        rasters["flow_direction"], rasters["flow_accumulation"],
+                                                        rasters["slope"], rasters["aspect"],
+                                                        memory_budget_mb * 1024 ** 2, elapsed_times)
 
-        if not slope:
-            tweet("Creating slope raster")
-            slope_raster_output = os.path.join(rasters_folder, "slope.tif")
-            if unfilled_dem:
-                slope_raster = arcpy.sa.Slope(unfilled_dem, "PERCENT_RISE")
-            else:
-                slope_raster = arcpy.sa.Slope(filled_dem_raster, "PERCENT_RISE")
-            slope_raster.save(slope_raster_output)
-        else:
-            slope_raster = slope
+        # The other products are derived as a graph of steps in a process pool: slope and aspect depend only on the
+        # DEM and upstream flow length only on flow direction, so they run alongside the flow chain
+        pipeline = agwa_pipeline.Pipeline("Terrain products", tweet,
+                                          environment={"workspace": prjgdb,
+                                                       "overwriteOutput": arcpy.env.overwriteOutput})
+        steps = {}
+        for name, (file_name, _, _, source) in TERRAIN_PRODUCTS.items():
+            if rasters[name]:
+                continue
+            if source == "surface":
+                source = "unfilled_dem" if unfilled_dem else "filled_dem"
+            output_path = os.path.join(rasters_folder, file_name)
+            steps[name] = pipeline.add(f"Creating {file_name}", create_terrain_product,
+                                       (name, rasters[source], output_path), inputs=[rasters[source]],
+                                       outputs=[output_path])
+            rasters[name] = output_path
+        if steps:
+            pipeline.run(max_workers)
+        elapsed_times.update({name: step.duration for name, step in steps.items()})
 
-        if not aspect:
-            tweet("Creating aspect raster")
-            aspect_raster_output = os.path.join(rasters_folder, "aspect.tif")
-            if unfilled_dem:
-                aspect_raster = arcpy.sa.Aspect(unfilled_dem)
-            else:
-                aspect_raster = arcpy.sa.Aspect(filled_dem_raster)
-            aspect_raster.save(aspect_raster_output)
-        else:
-            aspect_raster = aspect
+        if cache is not None:
+            store_cached_rasters(cache, rasters_folder, created, cache_keys)
 
         # Update metadata and add the metaWorkspace table to the map
-        update_metadata(prjgdb, filled_dem_raster, unfilled_dem, fd_raster, fa_raster, flup_raster, slope_raster,
-                        aspect_raster, agwa_directory)
-        
+        update_metadata(prjgdb, rasters["filled_dem"], unfilled_dem, rasters["flow_direction"],
+                        rasters["flow_accumulation"], rasters["flow_length_upstream"], rasters["slope"],
+                        rasters["aspect"], agwa_directory, elapsed_times)
 
     except Exception as e:
+        # the tool fails instead of leaving a workspace without its terrain products
         tweet(e)
+        raise
+
+
+def create_terrain_product(name, source, output_path):
+    """Create a terrain product of TERRAIN_PRODUCTS from its source raster and save it at output_path. Runs in a
+    worker process of the pipeline of prepare_rasters."""
+
+    arcpy.CheckOutExtension("Spatial")
+    _, operation, parameters, _ = TERRAIN_PRODUCTS[name]
+    raster = getattr(arcpy.sa, operation)(source, **parameters)
+    raster.save(output_path)
+    return output_path
+
+
+def terrain_cache_keys(cache, rasters, tiled):
+    """Return the cache keys of the terrain products missing from rasters, a dictionary of the arguments of
+    prepare_rasters by TERRAIN_PRODUCTS name. A supplied raster is keyed by its content and a derived one by the key
+    of its source, its operation, and the operation's parameters, so a product is found in the cache whenever the
+    DEM it comes from is the same. Products of tiled processing (see prepare_rasters_tiled) are keyed apart."""
+
+    keys = {}
+
+    def key(name):
+        if name == "surface":
+            name = "unfilled_dem" if rasters["unfilled_dem"] else "filled_dem"
+        if name not in keys:
+            if rasters[name]:
+                keys[name] = cache.content_hash(rasters[name])
+            else:
+                _, operation, parameters, source = TERRAIN_PRODUCTS[name]
+                parameters = dict(parameters, tiled=tiled and name != "flow_length_upstream")
+                keys[name] = cache.key(operation, parameters, [key(source)])
+        return keys[name]
+
+    return {name: key(name) for name in TERRAIN_PRODUCTS if not rasters[name]}
 
 
+def fetch_cached_rasters(cache, rasters_folder, rasters, cache_keys):
+    """Place the cached terrain products of cache_keys in rasters_folder and in rasters, and return the names of the
+    products that still have to be created."""
+
+    created = []
+    for name, key in cache_keys.items():
+        output_path = os.path.join(rasters_folder, TERRAIN_PRODUCTS[name][0])
+        if cache.fetch(key, output_path):
+            tweet(f"Reusing {os.path.basename(output_path)} from the terrain cache")
+            rasters[name] = output_path
+        else:
+            created.append(name)
+    return created
+
+
+def store_cached_rasters(cache, rasters_folder, created, cache_keys):
+    """Add the created terrain products to the cache."""
+    for name in created:
+        output_path = os.path.join(rasters_folder, TERRAIN_PRODUCTS[name][0])
+        if os.path.isfile(output_path):
+            cache.store(cache_keys[name], output_path)
+
+
+def prepare_rasters_tiled(rasters_folder, filled_dem, unfilled_dem, flow_direction, flow_accumulation, slope,
+                          aspect, memory_budget, elapsed_times):
+    """Create the filled DEM, flow direction, flow accumulation, slope, and aspect rasters that were not supplied,
+    tile by tile over memory-mapped arrays so that the working memory stays within memory_budget bytes. Returns
+    the supplied or created rasters in the same order as the arguments, and adds the seconds taken by each created
+    raster to elapsed_times."""
+
+    with tempfile.TemporaryDirectory(dir=arcpy.env.scratchFolder) as directory:
+        # the memory maps are closed when tile_terrain returns, before the directory is removed
+        return tile_terrain(directory, rasters_folder, filled_dem, unfilled_dem, flow_direction, flow_accumulation,
+                            slope, aspect, memory_budget, elapsed_times)
+
+
+def tile_terrain(directory, rasters_folder, filled_dem, unfilled_dem, flow_direction, flow_accumulation, slope,
+                 aspect, memory_budget, elapsed_times):
+    dem = unfilled_dem or filled_dem
+    frame = agwa_raster_arrays.RasterFrame(dem)
+    grid = agwa_tiles.TileGrid.for_budget(frame.shape, memory_budget)
+    tweet(f"Processing the DEM in {len(grid)} tiles of up to {grid.tile_size} x {grid.tile_size} cells")
+    if grid.memory() > memory_budget:
+        tweet(f"The tiles need about {grid.memory() / 2 ** 20:.0f} MB of memory with the tile boundaries kept for the "
+              f"whole DEM, more than the tile memory budget of {memory_budget / 2 ** 20:.0f} MB")
+
+    def read(raster, name, dtype, nodata_to_value):
+        array = agwa_tiles.create_array(directory, name, frame.shape, dtype, nodata_to_value)
+        frame.read_tiled(raster, array, grid, nodata_to_value)
+        return array
+
+    def write(array, name, pixel_type, value_to_nodata=None):
+        tweet(f"Writing {name}")
+        return frame.write_tiled(array, os.path.join(rasters_folder, name), grid, pixel_type, directory,
+                                 value_to_nodata)
+
+    # slope and aspect are computed from the unfilled DEM when there is one, as in prepare_rasters
+    dem_array = read(dem, "dem", np.float64, np.nan)
+    if not filled_dem:
+        tweet("Filling DEM")
+        start_time = time.perf_counter()
+        filled = agwa_tiles.create_array(directory, "filled", frame.shape, np.float64, np.inf)
+        runs = agwa_tiles.fill(dem_array, filled, grid)
+        tweet(f"Filled the DEM in {runs} tile runs")
+        filled_dem = write(filled, "filled_DEM.tif", "32_BIT_FLOAT")
+        elapsed_times["filled_dem"] = time.perf_counter() - start_time
+    elif not flow_direction:
+        filled = read(filled_dem, "filled", np.float64, np.nan) if unfilled_dem else dem_array
+
+    if not flow_direction:
+        tweet("Creating flow direction raster")
+        start_time = time.perf_counter()
+        directions = agwa_tiles.create_array(directory, "fd", frame.shape, np.uint8, 0)
+        flat_distance = agwa_tiles.create_array(directory, "flat_distance", frame.shape, np.int64, -1)
+        agwa_tiles.flow_direction(filled, directions, flat_distance, grid, frame.cell_width, frame.cell_height)
+        flow_direction = write(directions, "fd.tif", "8_BIT_UNSIGNED", 0)
+        elapsed_times["flow_direction"] = time.perf_counter() - start_time
+    elif not flow_accumulation:
+        directions = read(flow_direction, "fd", np.uint8, 0)
+
+    if not flow_accumulation:
+        tweet("Creating flow accumulation raster")
+        start_time = time.perf_counter()
+        accumulation = agwa_tiles.create_array(directory, "fa", frame.shape, np.float32, -1)
+        agwa_tiles.flow_accumulation(directions, accumulation, grid, -1)
+        flow_accumulation = write(accumulation, "fa.tif", "32_BIT_FLOAT", -1)
+        elapsed_times["flow_accumulation"] = time.perf_counter() - start_time
+
+    if not slope or not aspect:
+        tweet("Creating slope and aspect rasters")
+        start_time = time.perf_counter()
+        slope_array = agwa_tiles.create_array(directory, "slope", frame.shape, np.float32, np.nan)
+        aspect_array = agwa_tiles.create_array(directory, "aspect", frame.shape, np.float32, np.nan)
+        agwa_tiles.slope_and_aspect(dem_array, slope_array, aspect_array, grid, frame.cell_width, frame.cell_height)
+        # slope and aspect are computed together, so each is reported with the time of both
+        if not slope:
+            slope = write(slope_array, "slope.tif", "32_BIT_FLOAT")
+            elapsed_times["slope"] = time.perf_counter() - start_time
+        if not aspect:
+            aspect = write(aspect_array, "aspect.tif", "32_BIT_FLOAT")
+            elapsed_times["aspect"] = time.perf_counter() - start_time
+
+    return filled_dem, flow_direction, flow_accumulation, slope, aspect
+
 
 def update_metadata(prjgdb, filled_dem, unfilled_dem, flow_direction, flow_accumulation, flow_length_upstream,
-                    slope, aspect, agwa_directory):
+                    slope, aspect, agwa_directory, elapsed_times=None):
 
     # Get the paths of the rasters
     desc = arcpy.Describe(unfilled_dem)
@@ -123,6 +280,16 @@ def update_metadata(prjgdb, filled_dem, unfilled_dem, flow_direction, flow_accum
     row = [prjgdb, agwa_directory, unfilled_dem_path, filled_dem_path,
            fd_path, fa_path, flup_path, slope_path, aspect_path,
            creation_date, agwa_version_at_creation, agwa_gdb_version_at_creation]
+
+    # Document the seconds taken to create each terrain product, empty for supplied or cached rasters
+    elapsed_times = elapsed_times or {}
+    for name, field in ELAPSED_TIME_FIELDS.items():
+        fields.append(field)
+        if name in elapsed_times:
+            tweet(f"Created {TERRAIN_PRODUCTS[name][0]} in {elapsed_times[name]:.1f} s")
+            row.append(f"{elapsed_times[name]:.1f}")
+        else:
+            row.append("")
     
     
     meta_workspace_table = os.path.join(prjgdb, "metaWorkspace")
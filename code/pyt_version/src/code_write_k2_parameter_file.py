@@ -1,8 +1,11 @@
 import os
 import arcpy
+import importlib
 import pandas as pd
 from arcpy._mp import Table
 from datetime import datetime
+import agwa_parameter_store
+importlib.reload(agwa_parameter_store)
 
 def tweet(msg):
     """Produce a message for both arcpy and python"""
@@ -135,21 +138,16 @@ def write_file(output_file, agwa_version_at_creation, agwa_gbd_version_at_creati
     f.close()
 
 def read_parameter_tables(workspace, delineation, discretization, parameterization):    
-    df_hilllslopes = pd.DataFrame(arcpy.da.TableToNumPyArray(
-        os.path.join(workspace, "parameters_hillslopes"), "*", null_value=-9999))
-    df_channels = pd.DataFrame(arcpy.da.TableToNumPyArray(
-        os.path.join(workspace, "parameters_channels"), "*", null_value=-9999))        
+    df_hillslopes_filtered = agwa_parameter_store.read_parameter_set(
+        workspace, "parameters_hillslopes", delineation, discretization, parameterization, null_value=-9999)
+    df_channels_filtered = agwa_parameter_store.read_parameter_set(
+        workspace, "parameters_channels", delineation, discretization, parameterization, null_value=-9999)
+
+    delineation_name_field = arcpy.AddFieldDelimiters(workspace, "DelineationName")
+    discretization_name_field = arcpy.AddFieldDelimiters(workspace, "DiscretizationName")
+    expression = f"{delineation_name_field} = '{delineation}' And {discretization_name_field} = '{discretization}'"
     df_contributing_channels = pd.DataFrame(arcpy.da.TableToNumPyArray(
-        os.path.join(workspace, "contributing_channels"), "*", null_value=-9999))
-    
-    df_hillslopes_filtered = df_hilllslopes[(df_hilllslopes.DelineationName == delineation) &
-                                            (df_hilllslopes.DiscretizationName == discretization) &
-                                            (df_hilllslopes.ParameterizationName == parameterization)]                                            
-    df_channels_filtered = df_channels[(df_channels.DelineationName == delineation) &
-                                        (df_channels.DiscretizationName == discretization) &
-                                        (df_channels.ParameterizationName == parameterization)]
-    df_contributing_channels = df_contributing_channels[(df_contributing_channels.DelineationName == delineation) &
-                                                        (df_contributing_channels.DiscretizationName == discretization)]
+        os.path.join(workspace, "contributing_channels"), "*", expression, null_value=-9999))
     
     return df_hillslopes_filtered, df_channels_filtered, df_contributing_channels
 
@@ -30,12 +30,6 @@ class IdentifyPondsDem(object):
                                        datatype="GPRasterLayer",
                                        parameterType="Required",
                                        direction="Input")
-        # optional filled DEM
-        filled_dem = arcpy.Parameter(displayName="Filled DEM",
-                                     name="Filled_DEM",
-                                     datatype="GPRasterLayer",
-                                     parameterType="Optional",
-                                     direction="Input")
         # optional flow accumulation input
         fa_raster = arcpy.Parameter(displayName="Flow Accumulation Raster",
                                     name="Flow_Accumulation_Raster",
@@ -102,7 +96,7 @@ class IdentifyPondsDem(object):
         outlet_type.filter.type = "ValueList"
         outlet_type.filter.list = ["18 inch CMP", "24 inch CMP", "No pipe"]
 
-        params = [unfilled_dem, filled_dem, fa_raster, pond_points,
+        params = [unfilled_dem, fa_raster, pond_points,
                   pond_id_field, pond_size, delta_h, spillway_type, outlet_type, workspace]
         return params
 
@@ -133,17 +127,16 @@ class IdentifyPondsDem(object):
 
         # Variables from tool
         unfilled_dem = parameters[0].valueAsText
-        filled_dem = parameters[1].valueAsText
-        fa_raster = parameters[2].valueAsText
-        ponds_points = parameters[3].valueAsText
-        pond_id_field = parameters[4].valueAsText
-        min_pond_size = parameters[5].valueAsText
-        delta_h = parameters[6].valueAsText
-        spillway_type = parameters[7].valueAsText
-        outlet_type = parameters[8].valueAsText
-        out_fill_dir = parameters[9].valueAsText
+        fa_raster = parameters[1].valueAsText
+        ponds_points = parameters[2].valueAsText
+        pond_id_field = parameters[3].valueAsText
+        min_pond_size = parameters[4].valueAsText
+        delta_h = parameters[5].valueAsText
+        spillway_type = parameters[6].valueAsText
+        outlet_type = parameters[7].valueAsText
+        out_fill_dir = parameters[8].valueAsText
 
-        agwa.characterize_storage(unfilled_dem, filled_dem, fa_raster, ponds_points, pond_id_field, min_pond_size,
+        agwa.characterize_storage(unfilled_dem, fa_raster, ponds_points, pond_id_field, min_pond_size,
                                   delta_h,
                                   spillway_type, outlet_type, out_fill_dir)
 
@@ -0,0 +1,84 @@
+import os
+import sys
+import arcpy
+import importlib
+sys.path.append(os.path.dirname(__file__))
+import code_parameterize_land_cover_and_soils as agwa
+importlib.reload(agwa)
+
+
+class CompileSoilParameters(object):
+    def __init__(self):
+        """Define the tool (tool name is the name of the class)."""
+        self.label = "Compile Soil Parameters"
+        self.description = ("Calculates the weighted K2 soil parameters of every map unit of a gSSURGO database once, "
+                            "so Step 5 - Parameterize Land Cover and Soils looks them up instead of reading the "
+                            "database tables on every run.")
+        self.category = "Soil Tools"
+        self.canRunInBackground = False
+
+    def getParameterInfo(self):
+        """Define parameter definitions"""
+
+        param0 = arcpy.Parameter(displayName="Soils Database",
+                                 name="Soils_Database",
+                                 datatype="DEWorkspace",
+                                 parameterType="Required",
+                                 direction="Input")
+
+        param1 = arcpy.Parameter(displayName="AGWA Directory",
+                                 name="AGWA_Directory",
+                                 datatype="DEFolder",
+                                 parameterType="Required",
+                                 direction="Input")
+
+        param2 = arcpy.Parameter(displayName="Maximum Number of Soil Horizons",
+                                 name="Max_horizons",
+                                 datatype="GPLong",
+                                 parameterType="Required",
+                                 direction="Input")
+
+        param3 = arcpy.Parameter(displayName="Maximum Soil Depth (cm)",
+                                 name="Max_thickness",
+                                 datatype="GPDouble",
+                                 parameterType="Required",
+                                 direction="Input")
+
+        params = [param0, param1, param2, param3]
+        return params
+
+    def isLicensed(self):
+        """Set whether tool is licensed to execute."""
+        return True
+
+    def updateParameters(self, parameters):
+        """Modify the values and properties of parameters before internal
+        validation is performed.  This method is called whenever a parameter
+        has been changed."""
+        return
+
+    def updateMessages(self, parameters):
+        """Modify the messages created by internal validation for each tool
+        parameter.  This method is called after internal validation."""
+
+        if parameters[1].value:
+            lookup_tables = os.path.join(parameters[1].valueAsText, "lookup_tables.gdb")
+            if not arcpy.Exists(lookup_tables):
+                parameters[1].setErrorMessage(f"The AGWA lookup tables were not found at {lookup_tables}.")
+        return
+
+    def execute(self, parameters, messages):
+        """The source code of the tool."""
+        arcpy.AddMessage("Script source: " + __file__)
+        soils_database = parameters[0].valueAsText
+        agwa_directory = parameters[1].valueAsText
+        max_horizons = int(parameters[2].valueAsText)
+        max_thickness = float(parameters[3].valueAsText)
+
+        agwa.compile_soil_parameters(soils_database, agwa_directory, max_thickness, max_horizons)
+        return
+
+    def postExecute(self, parameters):
+        """This method takes place after outputs are processed and
+        added to the display."""
+        return
@@ -68,7 +68,22 @@ class DelineateWatershed(object):
                                  direction="Input")
         param6.value = False
 
-        params = [param0, param1, param2, param3, param4, param5, param6]
+        param7 = arcpy.Parameter(displayName="Delineate Each Outlet",
+                                 name="Delineate_Each_Outlet",
+                                 datatype="GPBoolean",
+                                 parameterType="Optional",
+                                 direction="Input")
+        param7.value = False
+
+        param8 = arcpy.Parameter(displayName="Outlet Name Field",
+                                 name="Outlet_Name_Field",
+                                 datatype="Field",
+                                 parameterType="Optional",
+                                 direction="Input")
+        param8.parameterDependencies = [param1.name]
+        param8.enabled = False
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8]
         return params
 
     def isLicensed(self):
@@ -80,6 +95,9 @@ class DelineateWatershed(object):
         validation is performed.  This method is called whenever a parameter
         has been changed."""
 
+        # Each outlet is delineated separately, named after the delineation name and its name field or ObjectID
+        parameters[8].enabled = bool(parameters[7].value)
+
         return
 
     def updateMessages(self, parameters):
@@ -87,7 +105,7 @@ class DelineateWatershed(object):
         parameter.  This method is called after internal validation."""
         
         # SetError if a feature class containing multiple features with no selection
-        if parameters[1].altered:
+        if parameters[1].altered and not parameters[7].value:
             outlet_feature_class = parameters[1].valueAsText
             if outlet_feature_class:
                 outlet_count = int(arcpy.GetCount_management(outlet_feature_class).getOutput(0))
@@ -121,6 +139,26 @@ class DelineateWatershed(object):
             if re.match("^[A-Za-z][A-Za-z0-9_]*$", delineation_name) is None:
                 parameters[3].setErrorMessage("The delineation name must start with a letter and contain only letters, numbers, and underscores.")
 
+        # Require new and distinct delineation names for all the outlets of a batch
+        if parameters[7].value and parameters[0].value and parameters[1].value and parameters[3].value:
+            prjgdb = parameters[0].valueAsText
+            delineation_name = parameters[3].valueAsText.strip()
+            name_field = parameters[8].valueAsText or "OID@"
+            names = [agwa.batch_delineation_name(delineation_name, row[0])
+                     for row in arcpy.da.SearchCursor(parameters[1].valueAsText, [name_field])]
+            duplicates = sorted({name for name in names if names.count(name) > 1})
+            if duplicates:
+                parameters[8].setErrorMessage(f"The outlets would create delineations with the same name: "
+                                              f"{', '.join(duplicates[:5])}.")
+            meta_delineation_table = os.path.join(prjgdb, "metaDelineation")
+            if arcpy.Exists(meta_delineation_table):
+                df_delineation = pd.DataFrame(arcpy.da.TableToNumPyArray(meta_delineation_table, 'DelineationName'))
+                existing = sorted(set(names) & set(df_delineation.DelineationName))
+                if existing:
+                    msg = (f"The selected geodatabase already has AGWA delineations named {', '.join(existing[:5])}. "
+                           f"Please enter a unique name for the delineations to be created.")
+                    parameters[3].setErrorMessage(msg)
+
         return
 
 
@@ -136,9 +174,17 @@ class DelineateWatershed(object):
         environment = arcpy.GetParameterAsText(4)
         save_intermediate_outputs = arcpy.GetParameterAsText(6).lower() == 'true'
 
+        delineate_each_outlet = arcpy.GetParameterAsText(7).lower() == 'true'
+        name_field = parameters[8].valueAsText
+
         delineation_name = delineation_name.strip()
-        agwa.initialize_workspace(prj_gdb, delineation_name, outlet_feature_set, snap_radius)
-        agwa.delineate(prj_gdb, delineation_name, save_intermediate_outputs)
+        if delineate_each_outlet:
+            delineation_names = agwa.initialize_batch_workspace(prj_gdb, delineation_name, outlet_feature_set,
+                                                                snap_radius, name_field)
+            agwa.delineate_batch(prj_gdb, delineation_names, save_intermediate_outputs)
+        else:
+            agwa.initialize_workspace(prj_gdb, delineation_name, outlet_feature_set, snap_radius)
+            agwa.delineate(prj_gdb, delineation_name, save_intermediate_outputs)
 
         return
 
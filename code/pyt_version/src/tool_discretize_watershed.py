@@ -58,11 +58,12 @@ class DiscretizeWatershed(object):
         param3.filter.list = ["Flow length (unit: m)", "Flow accumulation (unit: %)"]
         param3.enabled = False
 
-        param4 = arcpy.Parameter(displayName="Threshold Value",
+        param4 = arcpy.Parameter(displayName="Threshold Value(s)",
                                 name="Threshold",
                                 datatype="GPDouble",
                                 parameterType="Optional",
-                                direction="Input")
+                                direction="Input",
+                                multiValue=True)
         param4.enabled = False
 
         param5 = arcpy.Parameter(displayName="Existing channel network",
@@ -230,6 +231,13 @@ class DiscretizeWatershed(object):
                 parameters[12].setWarningMessage(msg)
                 parameters[12].value = valid_name
 
+        # each threshold value of a sweep makes a discretization named after it, so the names must differ
+        if parameters[4].enabled and parameters[4].valueAsText and parameters[12].value:
+            threshold_values = parameters[4].valueAsText.split(";")
+            names = [agwa.threshold_discretization_name(parameters[12].valueAsText, value) for value in threshold_values]
+            if len(set(names)) != len(names):
+                parameters[4].setErrorMessage("Each threshold value can only be entered once.")
+
         # check if the discretization name is unique
         if parameters[0].value and parameters[12].value:
             delineation_name = parameters[0].valueAsText
@@ -238,9 +246,14 @@ class DiscretizeWatershed(object):
             if arcpy.Exists(meta_discretization_table):
                 df_discretization = pd.DataFrame(arcpy.da.TableToNumPyArray(meta_discretization_table,
                                                                             ["DelineationName", "DiscretizationName"]))               
+                discretization_names = [discretization_name]
+                if parameters[4].enabled and parameters[4].valueAsText and len(parameters[4].valueAsText.split(";")) > 1:
+                    discretization_names = [agwa.threshold_discretization_name(discretization_name, value)
+                                            for value in parameters[4].valueAsText.split(";")]
                 df_filtered = df_discretization[(df_discretization.DelineationName == delineation_name) &
-                                                (df_discretization.DiscretizationName == discretization_name)]
+                                                (df_discretization.DiscretizationName.isin(discretization_names))]
                 if len(df_filtered) != 0:
+                    discretization_name = ", ".join(df_filtered.DiscretizationName)
                     msg = f"The selected geodatabase already has an AGWA discretization named {discretization_name}.\n" 
                     msg += f"Please enter a unique name for the discretization to be created."
                     parameters[12].setErrorMessage(msg)
@@ -272,7 +285,7 @@ class DiscretizeWatershed(object):
 
         # Parameters that are conditionally enabled
         threshold_method_par = parameters[3].valueAsText if parameters[3].enabled else None
-        threshold_value_par = float(parameters[4].valueAsText) if parameters[4].enabled and parameters[4].valueAsText else None
+        threshold_values_par = [float(value) for value in parameters[4].valueAsText.split(";")] if parameters[4].enabled and parameters[4].valueAsText else [None]
         existing_stream_network_feature_par = parameters[5].valueAsText if parameters[5].enabled else None
         existing_stream_network_snap_distance_par = float(parameters[6].valueAsText) if parameters[6].enabled and parameters[6].valueAsText else None
         channel_inition_points_feature_par = parameters[7].valueAsText if parameters[7].enabled else None
@@ -282,13 +295,25 @@ class DiscretizeWatershed(object):
         internal_pour_points_snapping_distance_par = parameters[11].valueAsText if parameters[11].enabled else None
 
 
-        agwa.initialize_workspace(delineation_par, model_par, methodology_par, threshold_method_par, threshold_value_par,
-                    existing_stream_network_feature_par, existing_stream_network_snap_distance_par,
-                    channel_inition_points_feature_par, channel_inition_points_snap_distance_par,
-                    internal_pour_points_method_par, internal_pour_points_feature_par, internal_pour_points_snapping_distance_par,
-                    discretization_name_par, environment_par, prjgdb_par)
-        
-        agwa.discretize(prjgdb_par, workspace_par, delineation_par, discretization_name_par, save_intermediate_outputs_par)
+        # Several threshold values make a sweep with one discretization per threshold, named after the threshold.
+        # Duplicate threshold values are rejected in updateMessages.
+        if len(threshold_values_par) > 1:
+            discretization_names = [agwa.threshold_discretization_name(discretization_name_par, threshold_value_par)
+                                    for threshold_value_par in threshold_values_par]
+        else:
+            discretization_names = [discretization_name_par]
+
+        for threshold_value_par, name in zip(threshold_values_par, discretization_names):
+            agwa.initialize_workspace(delineation_par, model_par, methodology_par, threshold_method_par, threshold_value_par,
+                        existing_stream_network_feature_par, existing_stream_network_snap_distance_par,
+                        channel_inition_points_feature_par, channel_inition_points_snap_distance_par,
+                        internal_pour_points_method_par, internal_pour_points_feature_par, internal_pour_points_snapping_distance_par,
+                        name, environment_par, prjgdb_par)
+
+        if len(discretization_names) > 1:
+            agwa.discretize_thresholds(prjgdb_par, workspace_par, delineation_par, discretization_names, save_intermediate_outputs_par)
+        else:
+            agwa.discretize(prjgdb_par, workspace_par, delineation_par, discretization_name_par, save_intermediate_outputs_par)
         
         return
 
@@ -116,7 +116,16 @@ class ParameterizeElements(object):
                                  parameterType="Optional",
                                  direction="Input")
 
-        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11, param12]
+        param13 = arcpy.Parameter(displayName="Maximum Parallel Steps",
+                                  name="Maximum_Parallel_Steps",
+                                  datatype="GPLong",
+                                  parameterType="Optional",
+                                  direction="Input")
+        param13.filter.type = "Range"
+        param13.filter.list = [1, 64]
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11, param12,
+                  param13]
 
         return params
 
@@ -276,6 +285,7 @@ class ParameterizeElements(object):
         prjgdb = parameters[10].valueAsText
         debug = parameters[11].valueAsText
         save_intermediate_outputs = (parameters[12].valueAsText or '').lower() == 'true'
+        max_workers = parameters[13].value
 
         agwa.initialize_workspace(delineation_name, prjgdb, discretization, parameterization_name, slope,
                                   flow_length, hgr)
@@ -285,7 +295,7 @@ class ParameterizeElements(object):
                           previous_parameterization)
         else:
             agwa.parameterize(prjgdb, workspace, delineation_name, discretization, parameterization_name,
-                          save_intermediate_outputs)
+                          save_intermediate_outputs, max_workers)
 
         return
     
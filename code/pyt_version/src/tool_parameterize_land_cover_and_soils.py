@@ -345,7 +345,8 @@ class ParameterizeLandCoverAndSoils(object):
                                   lookup_table, soils, soils_database, max_horizons, max_thickness, channel_type)
         
         if use_previous_parameterization: 
-            agwa.copy_parameterization(prjgdb, workspace, delineation, discretization, previous_parameterization)
+            agwa.copy_parameterization(workspace, delineation, discretization, previous_parameterization,
+                                       parameterization_name)
         else:
             agwa.parameterize(prjgdb, workspace, delineation, discretization, parameterization_name, save_intermediate_outputs)
 
@@ -97,7 +97,35 @@ class SetupAgwaWorkspace(object):
                                   parameterType="Optional",
                                   direction="Input")
 
-        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11]
+        param12 = arcpy.Parameter(displayName="Tile Memory Budget (MB)",
+                                  name="Tile_Memory_Budget",
+                                  datatype="GPLong",
+                                  parameterType="Optional",
+                                  direction="Input")
+
+        param13 = arcpy.Parameter(displayName="Terrain Cache Folder",
+                                  name="Terrain_Cache_Folder",
+                                  datatype="DEFolder",
+                                  parameterType="Optional",
+                                  direction="Input")
+
+        param14 = arcpy.Parameter(displayName="Terrain Cache Size (GB)",
+                                  name="Terrain_Cache_Size",
+                                  datatype="GPDouble",
+                                  parameterType="Optional",
+                                  direction="Input")
+        param14.value = 50
+
+        param15 = arcpy.Parameter(displayName="Maximum Parallel Steps",
+                                  name="Maximum_Parallel_Steps",
+                                  datatype="GPLong",
+                                  parameterType="Optional",
+                                  direction="Input")
+        param15.filter.type = "Range"
+        param15.filter.list = [1, 64]
+
+        params = [param0, param1, param2, param3, param4, param5, param6, param7, param8, param9, param10, param11,
+                  param12, param13, param14, param15]
         return params
 
 
@@ -170,6 +198,10 @@ class SetupAgwaWorkspace(object):
                 msg = ("The selected raster has a Geographic spatial reference and a Projected spatial reference is " 
                       "required. Please select a raster with a Projected coordinate system. ")
                 parameters[6].setErrorMessage(msg)
+        if parameters[12].value is not None and parameters[12].value <= 0:
+            parameters[12].setErrorMessage("The tile memory budget must be a positive number of megabytes.")
+        if parameters[14].value is not None and parameters[14].value <= 0:
+            parameters[14].setErrorMessage("The terrain cache size must be a positive number of gigabytes.")
 
         return
 
@@ -194,9 +226,14 @@ class SetupAgwaWorkspace(object):
         flup_par = parameters[7].valueAsText
         slope_par = parameters[8].valueAsText
         aspect_par = parameters[9].valueAsText
+        memory_budget_par = parameters[12].value
+        cache_directory_par = parameters[13].valueAsText
+        cache_size_par = parameters[14].value or 50
+        max_workers_par = parameters[15].value
 
         agwa.prepare_rasters(project_gdb_par, filled_dem_par, unfilled_dem_par, fd_par, fa_par, flup_par, slope_par,
-                             aspect_par, agwa_directory_par)
+                             aspect_par, agwa_directory_par, memory_budget_par, cache_directory_par, cache_size_par,
+                             max_workers_par)
 
         return
 